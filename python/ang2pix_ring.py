@@ -62,7 +62,7 @@ def ang2pix_ring(nside, theta, phi):
         ir = (nside + 1) + jp - jm
         k = ((ir % 2) == 0).astype('int')
         
-        ip = ((jp+jm+k+(1-nside))/2) + 1
+        ip = ((jp+jm+k+(1-nside))//2) + 1
         ip = ip - nl4*((ip > nl4).astype('int'))
 
         ipring[pix_eqt] = ncap + nl4*(ir-1) + ip - 1
@@ -101,3 +101,131 @@ def ang2pix_ring(nside, theta, phi):
 
     ipring = ipring.reshape(sh)
     return ipring
+
+def ang2pix_ring_blocked(nside, theta, phi, block=65536, out=None):
+    """
+    Convert from polar coordinates to ring order HEALPix pixel indices.
+
+    Inputs:
+        nside - HEALPix nside parameter
+        theta - polar angle relative to North pole, RADIANS
+        phi   - azimuthal angle, RADIANS
+
+    Keyword inputs:
+        block - number of coordinates processed at a time, default 65536
+        out   - optional contiguous int64 array, shaped like theta,
+                receiving the pixel indices
+
+    Outputs:
+        ipring - HEALPix ring order pixel indices corresponding to input coords
+
+    Comments:
+        Returns exactly the pixel indices of ang2pix_ring, whose arithmetic
+        is reproduced operation for operation, with the slow floating point
+        remainders replaced by exactly equivalent fmod and floor operations
+        and integer division by 2 done as a bit shift. Rather than splitting
+        the input into equatorial and polar cap subsets, each block of
+        coordinates goes through both the equatorial and the polar cap
+        formulae in preallocated block-sized buffers, and the applicable
+        result is selected per coordinate. With block small enough for the
+        buffers to stay in cache, this avoids the index gathers and
+        scatters and the full-length temporaries of ang2pix_ring.
+    """
+
+    theta = numpy.asarray(theta, dtype='float64')
+    phi = numpy.asarray(phi, dtype='float64')
+    if out is None:
+        out = numpy.zeros(theta.shape, dtype='int64')
+    ipring = out.reshape(-1)
+    theta = theta.reshape(-1)
+    phi = phi.reshape(-1)
+
+    np = len(theta)
+    pion2 = numpy.pi/2.
+    twopi = numpy.pi*2.
+    nl4 = 4*nside
+    npix = 12*nside*nside
+    ncap = 2*nside*(nside-1)
+    cth0 = 2./3.
+
+    fbuf = numpy.zeros((5, min(block, np)))
+    ibuf = numpy.zeros((5, min(block, np)), dtype='int64')
+    for i in range(0, np, block):
+        j = min(i+block, np)
+        cth, tt, f1, f2, f3 = [b[0:j-i] for b in fbuf]
+        jp, jm, ir, ip, cap = [b[0:j-i] for b in ibuf]
+        pix = ipring[i:j]
+
+        numpy.cos(theta[i:j], out=cth)
+        # ----- phi % twopi as fmod plus sign fix-up, which is much faster
+        numpy.fmod(phi[i:j], twopi, out=tt)
+        numpy.add(tt, twopi, out=tt, where=(tt < 0.))
+        numpy.add(tt, twopi, out=tt, where=(phi[i:j] <= 0.))
+        tt /= pion2
+
+        # ----- equatorial formulae
+        numpy.multiply(cth, 0.75, out=f2)
+        numpy.add(tt, 0.5, out=f1)
+        f1 -= f2
+        f1 *= nside
+        jp[:] = f1
+        numpy.add(tt, 0.5, out=f1)
+        f1 += f2
+        f1 *= nside
+        jm[:] = f1
+
+        numpy.subtract(jp, jm, out=ir)
+        ir += nside + 1
+        numpy.add(jp, jm, out=ip)
+        ip += 1
+        ip -= numpy.bitwise_and(ir, 1, out=cap)
+        ip += 1 - nside
+        numpy.right_shift(ip, 1, out=ip)
+        ip += 1
+        numpy.greater(ip, nl4, out=cap)
+        cap *= nl4
+        ip -= cap
+        ir -= 1
+        ir *= nl4
+        numpy.add(ir, ip, out=pix)
+        pix += ncap - 1
+
+        # ----- polar cap formulae, tt is positive so tt % 1. == tt - floor(tt)
+        numpy.floor(tt, out=f1)
+        numpy.subtract(tt, f1, out=f1)
+        numpy.abs(cth, out=f2)
+        numpy.subtract(1., f2, out=f2)
+        f2 *= 3.
+        numpy.sqrt(f2, out=f2)
+        numpy.multiply(f1, nside, out=f3)
+        f3 *= f2
+        jp[:] = f3
+        numpy.subtract(1., f1, out=f1)
+        f1 *= nside
+        f1 *= f2
+        jm[:] = f1
+
+        numpy.add(jp, jm, out=ir)
+        ir += 1
+        numpy.multiply(tt, ir, out=f1)
+        ip[:] = f1
+        ip += 1
+        numpy.greater(ip, 4*ir, out=cap)
+        cap *= 4*ir
+        ip -= cap
+        ip -= 1
+
+        # ----- north cap 2*ir*(ir-1) + ip - 1
+        numpy.subtract(ir, 1, out=cap)
+        cap *= 2*ir
+        cap += ip
+        numpy.copyto(pix, cap, where=(cth > cth0))
+
+        # ----- south cap npix - 2*ir*(ir+1) + ip - 1
+        numpy.add(ir, 1, out=cap)
+        cap *= -2*ir
+        cap += npix
+        cap += ip
+        numpy.copyto(pix, cap, where=(cth <= -cth0))
+
+    return out
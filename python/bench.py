@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the WSSA coordinate and sampling code paths.
+
+Run as a script to time each benchmarked function against each scenario of
+the comp/ harness, e.g.
+
+    python bench.py --json bench.json
+    python bench.py --json new.json --compare bench.json
+
+"""
+import os
+import sys
+import time
+import json
+import platform
+import numpy as np
+import wssa_utils
+from ang2pix_ring import ang2pix_ring, ang2pix_ring_blocked
+from pix2ang_ring import pix2ang_ring
+
+# functions benchmarked by run_suite, those needing tiles listed separately
+FUNCS = ['ang2pix_ring', 'ang2pix_ring_blocked', 'issa_proj_gnom',
+         'coord_to_tile', 'tile_val_interp', 'wssa_getval']
+TILE_FUNCS = ['tile_val_interp', 'wssa_getval']
+# coordinate sets of the comp/ harness, see scenario_coords
+SCENARIOS = ['single', 'many', 'rect', 'heal16', 'heal64', 'heal256']
+
+def random_coords(nsam, seed=0):
+    """nsam (ra, dec) pairs uniformly distributed on the sky, degrees"""
+    rng = np.random.RandomState(seed)
+    ra = 360.*rng.rand(nsam)
+    dec = (180./np.pi)*np.arcsin(2.*rng.rand(nsam) - 1.)
+    return ra, dec
+
+def scenario_coords(name):
+    """
+    Return (ra, dec) of one benchmark scenario, degrees.
+
+    Inputs:
+        name - 'single' or 'many', the coordinates of comp.test_xy_single
+               and comp.test_xy_many; 'rect', the grid of rect.fits in
+               WISE_DATA when present, otherwise a 1000 x 1000 grid 10
+               degrees on a side; 'heal<nside>', all HEALPix pixel centers
+               at that nside; 'random<n>', n uniformly random coordinates
+    """
+
+    if name == 'single':
+        return np.array([308.49839]), np.array([-30.757660])
+    if name == 'many':
+        return (np.array([228.06533, 336.88487, 132.85047, 296.63675,
+                          174.24343, 304.68113]),
+                np.array([9.6944888, 25.149593, -29.273778, 11.994469,
+                          43.651411, -10.985369]))
+    if name == 'rect':
+        fname = os.path.join(os.path.dirname(
+            wssa_utils.tile_par_struc()['indexfile']), 'rect.fits')
+        if os.path.exists(fname):
+            import pyfits
+            hdus = pyfits.open(fname)
+            return hdus[0].data.astype('float64'), hdus[1].data.astype('float64')
+        return np.meshgrid(np.linspace(120., 130., 1000),
+                           np.linspace(-5., 5., 1000))
+    if name.startswith('heal'):
+        nside = int(name[4:])
+        theta, phi = pix2ang_ring(nside, np.arange(12*nside*nside))
+        return (180./np.pi)*phi, 90. - (180./np.pi)*theta
+    if name.startswith('random'):
+        return random_coords(int(float(name[6:])))
+    raise ValueError('unknown scenario ' + name)
+
+def read_bytes():
+    """
+    Bytes read by this process so far through read() type system calls,
+    None where /proc is missing.
+
+    Comments:
+        Pages faulted in through memory maps are not counted, so this
+        misses most of the reads of the mmap, cache, fz and shared store
+        paths; see bench_case for the bytes of pixel data read.
+    """
+    try:
+        for line in open('/proc/self/io'):
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+    except IOError:
+        return None
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, None if unknown."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss*(1 if sys.platform == 'darwin' else 1024)
+
+class OpenCounter(object):
+    """Context manager counting calls of pyfits.open, i.e. tile opens."""
+
+    def __enter__(self):
+        import pyfits
+        self.nopen = 0
+        self._open = pyfits.open
+        def counted(*args, **kwargs):
+            self.nopen += 1
+            return self._open(*args, **kwargs)
+        pyfits.open = counted
+        return self
+
+    def __exit__(self, *exc):
+        import pyfits
+        pyfits.open = self._open
+        return False
+
+def measure(func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) once, timing it and tracing its allocations.
+
+    Outputs:
+        dictionary with the wall clock 'time' in seconds and 'peak' bytes of
+        memory allocated while running func, None where tracemalloc is not
+        available
+    """
+
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    if tracemalloc is not None: tracemalloc.start()
+    t0 = time.time()
+    func(*args, **kwargs)
+    dt = time.time() - t0
+    peak = None
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {'time' : dt, 'peak' : peak}
+
+def setup_case(func, ra, dec, large=True, tilepath=None):
+    """
+    Return (function, args, kwargs) running func on (ra, dec).
+
+    Comments:
+        Inputs of the lower level functions, such as the tile numbers and
+        tile coordinates needed by tile_val_interp, are computed here, so
+        that only func itself is timed.
+    """
+
+    radeg = wssa_utils.radeg
+    ra = np.asarray(ra, dtype='float64').ravel()
+    dec = np.asarray(dec, dtype='float64').ravel()
+    theta = (90. - dec)/radeg
+    phi = ra/radeg
+    if func == 'ang2pix_ring':
+        return ang2pix_ring, (64, theta, phi), {}
+    if func == 'ang2pix_ring_blocked':
+        return ang2pix_ring_blocked, (64, theta, phi), {}
+    if func == 'coord_to_tile':
+        return wssa_utils.coord_to_tile, (ra, dec), {'large' : large}
+    tnum, x, y = wssa_utils.coord_to_tile(ra, dec, large=large)
+    if func == 'issa_proj_gnom':
+        par = wssa_utils.tile_par_struc(large=large)
+        return (wssa_utils.issa_proj_gnom,
+                (phi, dec/radeg, wssa_utils.com_tiles['RA'][tnum-1]/radeg,
+                 wssa_utils.com_tiles['DEC'][tnum-1]/radeg,
+                 (par['pix']/par['sidelen'])*radeg), {})
+    if func == 'tile_val_interp':
+        return (wssa_utils.tile_val_interp, (tnum, x, y),
+                {'large' : large, 'tpath' : tilepath})
+    if func == 'wssa_getval':
+        return (wssa_utils.wssa_getval, (ra, dec),
+                {'large' : large, 'tilepath' : tilepath})
+    raise ValueError('unknown function ' + func)
+
+def bench_case(func, scenario, large=True, tilepath=None, mintime=0.2):
+    """
+    Benchmark one function against one scenario.
+
+    Inputs:
+        func     - name of the function, one of FUNCS
+        scenario - name of the coordinate set, see scenario_coords
+
+    Keyword inputs:
+        large    - set for 8k x 8k tiles, default is 3k x 3k
+        tilepath - directory containing WSSA tiles
+        mintime  - calls are repeated until this many seconds have passed,
+                   and the fastest call is reported
+
+    Outputs:
+        res - dictionary with the number of points 'npts', the fastest
+              call 'time' in seconds, 'pts_per_sec', peak traced 'alloc'
+              and process 'rss' in bytes, and per call 'tile_opens',
+              'tiles_read', 'bytes_read' and 'bytes_per_tile', the pixel
+              data read as reported to a tile_stats.TileStats, and
+              'syscall_bytes', see read_bytes
+    """
+
+    ra, dec = scenario_coords(scenario)
+    npts = int(np.size(ra))
+    f, args, kwargs = setup_case(func, ra, dec, large=large,
+                                 tilepath=tilepath)
+    # first call outside of the timed region reads the lookup tables and
+    # imports pyfits and scipy, as a long-running process would have
+    f(*args, **kwargs)
+    stats = None
+    if func in TILE_FUNCS:
+        from tile_stats import TileStats
+        stats = TileStats(keep=False)
+        kwargs = dict(kwargs, stats=stats)
+    times = []
+    with OpenCounter() as counter:
+        nbytes = read_bytes()
+        t0 = time.time()
+        while (len(times) == 0) or (time.time() - t0 < mintime):
+            t1 = time.time()
+            f(*args, **kwargs)
+            times.append(time.time() - t1)
+        if nbytes is not None: nbytes = read_bytes() - nbytes
+    ntile = (stats.ntile if stats is not None else 0)
+    pixbytes = (stats.totals['bytes_read'] if stats is not None else 0)
+    # allocations are traced in a separate call, tracing slows it down
+    alloc = measure(f, *args, **kwargs)['peak']
+
+    ncall = len(times)
+    best = min(times)
+    opens = counter.nopen/float(ncall)
+    res = {'func'        : func,
+           'scenario'    : scenario,
+           'large'       : bool(large),
+           'npts'        : npts,
+           'ncall'       : ncall,
+           'time'        : best,
+           'pts_per_sec' : (npts/best if best > 0 else None),
+           'alloc'       : alloc,
+           'rss'         : peak_rss(),
+           'tile_opens'  : opens,
+           'tiles_read'  : ntile/float(ncall),
+           'bytes_read'  : pixbytes/float(ncall),
+           'bytes_per_tile' : (pixbytes/float(ntile) if ntile else None),
+           'syscall_bytes' : (nbytes/float(ncall) if nbytes is not None
+                              else None)}
+    return res
+
+def _bench_case_task(task):
+    """Run bench_case on argument tuple, for isolated child processes."""
+    return bench_case(*task)
+
+def run_suite(funcs=None, scenarios=None, large=True, tilepath=None,
+              isolate=True):
+    """
+    Benchmark every function in funcs against every scenario in scenarios.
+
+    Keyword inputs:
+        funcs     - list of function names, default FUNCS; functions
+                    reading tiles are skipped when no tile path is available
+        scenarios - list of scenario names, default SCENARIOS
+        large     - set for 8k x 8k tiles, default is 3k x 3k
+        tilepath  - directory containing WSSA tiles, default WISE_TILE
+        isolate   - run each case in a fresh child process, so that the
+                    reported peak RSS belongs to that case alone
+
+    Outputs:
+        doc - dictionary holding machine and version information under
+              'meta' and the list of bench_case results under 'results'
+    """
+
+    if funcs is None: funcs = FUNCS
+    if scenarios is None: scenarios = SCENARIOS
+    if tilepath is None: tilepath = wssa_utils.tile_par_struc()['tpath']
+    tasks = [(func, scenario, large, tilepath)
+             for func in funcs for scenario in scenarios
+             if (tilepath is not None) or (func not in TILE_FUNCS)]
+
+    results = []
+    for task in tasks:
+        if isolate:
+            from multiprocessing import Pool
+            pool = Pool(1)
+            res = pool.apply(_bench_case_task, (task,))
+            pool.close()
+            pool.join()
+        else:
+            res = _bench_case_task(task)
+        print(format_result(res))
+        results.append(res)
+
+    meta = {'python'   : platform.python_version(),
+            'numpy'    : np.__version__,
+            'machine'  : platform.machine(),
+            'node'     : platform.node(),
+            'time'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'isolate'  : bool(isolate)}
+    return {'meta' : meta, 'results' : results}
+
+def format_result(res):
+    """One line summary of a bench_case result."""
+    line = ('%-21s %-10s %9d pts %10.4f s %12.4g pts/s' %
+            (res['func'], res['scenario'], res['npts'], res['time'],
+             res['pts_per_sec'] or 0))
+    if res['rss'] is not None:
+        line += '  rss %7.1f MB' % (res['rss']/1.e6)
+    if res.get('tiles_read'):
+        line += '  %.1f tiles, %.1f opens' % (res['tiles_read'],
+                                               res['tile_opens'])
+        if res['bytes_per_tile'] is not None:
+            line += ', %.1f kB/tile' % (res['bytes_per_tile']/1.e3)
+    return line
+
+def compare(doc, baseline, tol=0.2):
+    """
+    Report cases at least tol (fractional) slower than in baseline.
+
+    Inputs:
+        doc      - dictionary returned by run_suite
+        baseline - earlier run_suite dictionary, e.g. read from JSON
+
+    Outputs:
+        slower - list of (func, scenario, baseline time, time) tuples
+    """
+
+    old = dict([((r['func'], r['scenario'], r['large']), r['time'])
+                for r in baseline['results']])
+    slower = []
+    for r in doc['results']:
+        key = (r['func'], r['scenario'], r['large'])
+        if (key in old) and (r['time'] > (1. + tol)*old[key]):
+            slower.append((r['func'], r['scenario'], old[key], r['time']))
+    return slower
+
+def coord_to_tile_unfused(ra, dec, large=True):
+    """reference coord_to_tile, via coord_to_tnum and issa_proj_gnom"""
+    tlist = wssa_utils.coord_to_tnum(ra, dec)
+    par = wssa_utils.tile_par_struc(large=large)
+    radeg = wssa_utils.radeg
+    tiles = wssa_utils.com_tiles
+    scale = (par['pix']/par['sidelen'])*radeg
+    x, y = wssa_utils.issa_proj_gnom(ra/radeg, dec/radeg,
+                                     (tiles['RA'])[tlist-1]/radeg,
+                                     (tiles['DEC'])[tlist-1]/radeg, scale)
+    x += par['crpix']
+    y += par['crpix']
+    return tlist, x, y
+
+def bench_coord_to_tile(nsam=10**7):
+    """compare fused coord_to_tile against the unfused reference"""
+    ra, dec = random_coords(nsam)
+    # load lookup tables outside of the timed region
+    wssa_utils.coord_to_tile(ra[0:1], dec[0:1])
+
+    res = {}
+    res['unfused'] = measure(coord_to_tile_unfused, ra, dec)
+    res['fused'] = measure(wssa_utils.coord_to_tile, ra, dec)
+    out = (np.zeros(nsam, dtype='int16'), np.zeros(nsam), np.zeros(nsam))
+    res['fused_out'] = measure(wssa_utils.coord_to_tile, ra, dec, out=out)
+    for name in ['unfused', 'fused', 'fused_out']:
+        print(name + ': ' + str(nsam) + ' coordinates in ' +
+              ('%.3f' % res[name]['time']) + ' s, peak allocation ' +
+              ('%.1f MB' % (res[name]['peak']/1.e6)
+               if res[name]['peak'] is not None else 'unknown'))
+    return res
+
+if __name__ == '__main__':
+    """run the benchmark suite"""
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--funcs', nargs='+', default=None,
+                        help='functions to benchmark, default all of ' +
+                        ' '.join(FUNCS))
+    parser.add_argument('--scenarios', nargs='+', default=None,
+                        help='coordinate sets, default ' + ' '.join(SCENARIOS))
+    parser.add_argument('--small', action='store_true',
+                        help='use 3k x 3k tiles rather than 8k x 8k')
+    parser.add_argument('--tilepath', default=None,
+                        help='tile directory, default WISE_TILE')
+    parser.add_argument('--no-isolate', action='store_true',
+                        help='run all cases in this process')
+    parser.add_argument('--json', default=None,
+                        help='write results to this JSON file')
+    parser.add_argument('--compare', default=None,
+                        help='baseline JSON file to check for regressions')
+    parser.add_argument('--tol', type=float, default=0.2,
+                        help='fractional slowdown reported as a regression')
+    parser.add_argument('--coord-to-tile', type=float, default=None,
+                        metavar='N', help='only compare fused and unfused '
+                        'coord_to_tile on N random coordinates')
+    opts = parser.parse_args()
+
+    if opts.coord_to_tile is not None:
+        bench_coord_to_tile(int(opts.coord_to_tile))
+        sys.exit(0)
+
+    doc = run_suite(funcs=opts.funcs, scenarios=opts.scenarios,
+                    large=not opts.small, tilepath=opts.tilepath,
+                    isolate=not opts.no_isolate)
+    if opts.json is not None:
+        fp = open(opts.json, 'w')
+        json.dump(doc, fp, indent=1, sort_keys=True)
+        fp.close()
+    if opts.compare is not None:
+        slower = compare(doc, json.load(open(opts.compare)), tol=opts.tol)
+        for func, scenario, told, tnew in slower:
+            print('REGRESSION ' + func + ' ' + scenario + ': ' +
+                  ('%.4f s -> %.4f s' % (told, tnew)))
+        sys.exit(1 if len(slower) else 0)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Rewrite WSSA tiles as FITS tile-compressed files with row-block tiling."""
+
+import os
+import sys
+import numpy as np
+import wssa_utils
+
+def compress_tile(fin, fout, rows=64, clobber=False):
+    """
+    Rewrite one WSSA tile as a lossless FITS tile-compressed file.
+
+    Inputs:
+        fin  - WSSA tile file name, optionally gzipped
+        fout - output file name, conventionally fin with suffix .fz
+
+    Keyword inputs:
+        rows    - number of image rows per compressed block, default 64
+        clobber - set to overwrite fout if it already exists
+
+    Comments:
+        The output has an empty primary HDU, followed by one compressed
+        image HDU per tile extension, in the original order. Each image is
+        split into blocks of rows full-width rows, which are compressed
+        independently, so that a section read only decompresses the blocks
+        overlapping the section. Floating point extensions are GZIP_2
+        compressed without quantization, integer bit-masks are RICE_1
+        compressed, so that the decompressed images are identical to the
+        originals. Data-less extensions are kept as empty image HDUs.
+    """
+
+    import pyfits
+    if os.path.exists(fout):
+        if not clobber:
+            raise IOError('output file ' + fout + ' already exists')
+        os.remove(fout)
+
+    hdus = pyfits.open(fin)
+    out = [pyfits.PrimaryHDU()]
+    for hdu in hdus:
+        if hdu.data is None:
+            out.append(pyfits.ImageHDU())
+            continue
+        data = np.asarray(hdu.data)
+        ismsk = (data.dtype.kind in 'iu')
+        ctype = ('RICE_1' if ismsk else 'GZIP_2')
+        ny, nx = data.shape
+        try:
+            comp = pyfits.CompImageHDU(data, header=hdu.header,
+                                       compression_type=ctype,
+                                       tile_shape=(min(rows, ny), nx),
+                                       quantize_level=0.)
+        except TypeError:
+            # versions predating tile_shape take the FITS ordered tile_size
+            comp = pyfits.CompImageHDU(data, header=hdu.header,
+                                       compression_type=ctype,
+                                       tile_size=(nx, min(rows, ny)),
+                                       quantize_level=0.)
+        out.append(comp)
+    pyfits.HDUList(out).writeto(fout)
+    hdus.close()
+
+def compress_tiles(tpath, outpath=None, tiles=None, gz=False, rows=64,
+                   clobber=False):
+    """
+    Write tile-compressed copies of WSSA tiles, read with fz=True.
+
+    Inputs:
+        tpath - directory containing WSSA tiles
+
+    Keyword inputs:
+        outpath - output directory, default is tpath
+        tiles   - list of tile numbers, [1, 430], default is all tiles
+                  present in tpath
+        gz      - set to read gzipped *.fits.gz input tiles
+        rows    - number of image rows per compressed block, default 64
+        clobber - set to overwrite existing outputs
+
+    Outputs:
+        fouts - list of output file names
+
+    Comments:
+        Output files are named as the uncompressed tiles, with suffix
+        .fits.fz, which is where wssa_getval(fz=True) looks for them.
+    """
+
+    if outpath is None: outpath = tpath
+    fname = wssa_utils.com_tiles['FNAME']
+    if tiles is None: tiles = range(1, len(fname)+1)
+
+    fouts = []
+    for tnum in tiles:
+        fin = os.path.join(tpath, fname[tnum-1]) + ('.gz' if gz else '')
+        if not os.path.exists(fin): continue
+        fout = os.path.join(outpath, fname[tnum-1]) + '.fz'
+        print('Compressing: ' + fin + ' -> ' + fout)
+        compress_tile(fin, fout, rows=rows, clobber=clobber)
+        fouts.append(fout)
+    return fouts
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: compress_tiles.py tpath [outpath]')
+        sys.exit(1)
+    compress_tiles(sys.argv[1], outpath=(sys.argv[2] if len(sys.argv) > 2
+                                         else None))
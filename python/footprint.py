@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""Plan and stage the WSSA tiles needed by a catalog or a set of regions,
+for jobs run against a partial tile set."""
+
+import os
+import shutil
+import numpy as np
+import wssa_utils
+from wssa_utils import tile_par_struc
+
+# bytes of the eight header blocks of a tile, besides the image data
+HEADER_BYTES = 8*2*2880
+
+class Footprint(object):
+    """
+    Tiles and extensions read by a job, see catalog_footprint and
+    region_footprint.
+
+    Inputs:
+        tiles - array of tile numbers, [1, 430]
+        nsamp - number of samples, or regions, read from each tile
+
+    Keyword inputs:
+        exten - extension, or list of extensions, as for wssa_getval
+        All other keywords are as for wssa_getval.
+
+    Comments:
+        The tile files are named by the tile index table, with the suffix
+        of the compression selected by gz or fz.
+    """
+
+    def __init__(self, tiles, nsamp, exten=0, release='1.0', large=True,
+                 gz=False, fz=False):
+        self.par = tile_par_struc(large=large, release=release)
+        self.tiles = np.asarray(tiles, dtype='int64')
+        self.nsamp = np.asarray(nsamp, dtype='int64')
+        self.extens, self.names = wssa_utils.exten_list(exten, self.par)
+        self.large = large
+        self.suffix = ('.fz' if fz else ('.gz' if gz else ''))
+
+    def tilepath(self, tilepath=None):
+        """Return tilepath, default WISE_TILE."""
+        if tilepath is None: tilepath = self.par['tpath']
+        if tilepath is None:
+            raise ValueError('no tile path given and WISE_TILE is not set')
+        return tilepath
+
+    def files(self, tilepath=None):
+        """Return list of the tile file names in tilepath."""
+        tilepath = self.tilepath(tilepath)
+        fname = wssa_utils.com_tiles['FNAME']
+        return [os.path.join(tilepath, fname[tnum-1]) + self.suffix
+                for tnum in self.tiles]
+
+    def missing(self, tilepath=None):
+        """
+        Return list of the tile files missing from tilepath, including
+        staged subsets lacking one of the extensions.
+        """
+
+        missing = []
+        for f in self.files(tilepath):
+            if not os.path.exists(f):
+                missing.append(f)
+            elif (self.suffix == '') and \
+                 not set(self.extens) <= set(present_extens(f)):
+                missing.append(f)
+        return missing
+
+    def check(self, tilepath=None):
+        """Raise IOError listing the missing files, see missing."""
+        missing = self.missing(tilepath)
+        if len(missing) > 0:
+            raise IOError('%d of %d tiles needed are missing from %s: %s' %
+                          (len(missing), len(self.tiles),
+                           self.tilepath(tilepath),
+                           ', '.join([os.path.basename(f)
+                                      for f in missing])))
+
+    def image_bytes(self):
+        """Bytes of the decoded images of the needed extensions."""
+        return len(self.tiles)*len(self.extens)*int(self.par['pix'])**2*4
+
+    def file_bytes(self, tilepath=None, subset=True):
+        """
+        Bytes copied by stage from tilepath, see stage.
+
+        Comments:
+            Files missing from tilepath are counted at their uncompressed
+            size.
+        """
+
+        nbytes = 0
+        for f in self.files(tilepath):
+            if not os.path.exists(f):
+                nbytes += (len(self.extens) if subset else 8)* \
+                          int(self.par['pix'])**2*4 + HEADER_BYTES
+            elif subset and (self.suffix == ''):
+                nbytes += subset_bytes(f, self.extens)
+            else:
+                nbytes += os.path.getsize(f)
+        return nbytes
+
+    def summary(self, tilepath=None):
+        """One line summary of the tiles and bytes needed."""
+        return ('%d tiles, extension%s %s, %d samples; %.1f MB of images, '
+                '%.1f MB to stage' %
+                (len(self.tiles), 's'*int(len(self.names) > 1),
+                 ', '.join(self.names), np.sum(self.nsamp),
+                 self.image_bytes()/1.e6, self.file_bytes(tilepath)/1.e6))
+
+    def stage(self, dest, tilepath=None, subset=True, workers=None):
+        """
+        Copy the needed tile files from tilepath into directory dest.
+
+        Inputs:
+            dest - local tile directory, passed as tilepath to later calls
+
+        Keyword inputs:
+            tilepath - source tile directory, default WISE_TILE
+            subset   - set (default) to copy only the needed extensions of
+                       uncompressed tiles, writing the others as empty
+                       HDUs so that extension numbers are kept
+            workers  - number of files copied concurrently
+
+        Outputs:
+            nbytes - bytes copied
+
+        Comments:
+            Files already staged with the needed extensions are skipped,
+            so that staging can be resumed, or shared by several jobs.
+            Each file is written under a temporary name and renamed into
+            place, so that an interrupted copy is never taken for a tile.
+        """
+
+        src = self.tilepath(tilepath)
+        self.check(src)
+        if not os.path.isdir(dest): os.makedirs(dest)
+        extens = (self.extens if subset and (self.suffix == '') else None)
+        tasks = [(os.path.join(src, os.path.basename(f)), f, extens)
+                 for f in self.missing(dest)]
+        if (workers is None) or (workers <= 1) or (len(tasks) <= 1):
+            nbytes = [_stage_file_task(task) for task in tasks]
+        else:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(workers, len(tasks)))
+            try:
+                nbytes = pool.map(_stage_file_task, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        return sum(nbytes)
+
+def present_extens(f):
+    """List of the extensions of uncompressed tile f holding an image."""
+    return wssa_utils.image_extens(f)
+
+def hdu_spans(f):
+    """Return list of (header start, data start, end) in bytes of each HDU."""
+    spans = []
+    start = 0
+    for offset, shape, dtype, bscale, bzero in wssa_utils.fits_image_layout(f):
+        nbytes = int(np.prod(shape))*dtype.itemsize if len(shape) else 0
+        end = offset + 2880*((nbytes + 2879)//2880)
+        spans.append((start, offset, end))
+        start = end
+    return spans
+
+def subset_bytes(f, extens):
+    """Bytes of the copy of uncompressed tile f written by copy_subset."""
+    spans = hdu_spans(f)
+    return sum([(end - start if e in extens else 2880)
+                for e, (start, data, end) in enumerate(spans)])
+
+def copy_subset(f, fout, extens):
+    """
+    Copy uncompressed tile f to fout, keeping only extensions extens.
+
+    Comments:
+        The other HDUs are written as headers without data, so that the
+        kept extensions keep their numbers.
+    """
+
+    from synth_tiles import header_block
+    layout = wssa_utils.fits_image_layout(f)
+    fin = open(f, 'rb')
+    out = open(fout, 'wb')
+    nbytes = 0
+    for e, (start, data, end) in enumerate(hdu_spans(f)):
+        if e in extens:
+            fin.seek(start)
+            todo = end - start
+            while todo > 0:
+                buf = fin.read(min(todo, 2**24))
+                out.write(buf)
+                todo -= len(buf)
+            nbytes += end - start
+        else:
+            dtype = layout[e][2]
+            bitpix = (8*dtype.itemsize)*(-1 if dtype.kind == 'f' else 1)
+            cards = ([('SIMPLE', True)] if e == 0 else
+                     [('XTENSION', 'IMAGE')])
+            cards += [('BITPIX', bitpix), ('NAXIS', 0)]
+            cards += ([('EXTEND', True)] if e == 0 else
+                      [('PCOUNT', 0), ('GCOUNT', 1)])
+            out.write(header_block(cards))
+            nbytes += 2880
+    fin.close()
+    out.close()
+    return nbytes
+
+def _stage_file_task(task):
+    """Copy one tile file, task is (source, destination, extens)."""
+    f, fout, extens = task
+    wssa_utils.log.info('Staging: %s', f)
+    if (extens is not None) and os.path.exists(fout):
+        # widen the subset already staged
+        extens = sorted(set(extens) | set(present_extens(fout)))
+    tmp = fout + '.tmp.' + str(os.getpid())
+    if extens is None:
+        shutil.copyfile(f, tmp)
+        nbytes = os.path.getsize(tmp)
+    else:
+        nbytes = copy_subset(f, tmp, extens)
+    os.rename(tmp, fout)
+    return nbytes
+
+def catalog_footprint(ra, dec, exten=0, release='1.0', large=True, gz=False,
+                      fz=False, chunksize=1000000):
+    """
+    Find the tiles wssa_getval reads to sample (ra, dec).
+
+    Inputs:
+        ra  - array of RA coordinates, assumed degrees J2000
+        dec - array of DEC coordinates, assumed degrees J2000
+
+    Keyword inputs:
+        chunksize - number of coordinates looked up at a time
+        All other keywords are as for wssa_getval.
+
+    Outputs:
+        footprint - Footprint instance
+
+    Comments:
+        Tiles are found with the HEALPix pixel lookup used by wssa_getval,
+        chunk by chunk, so ra and dec may be memory maps of a catalog
+        larger than memory.
+    """
+
+    ra = np.asarray(ra).ravel()
+    dec = np.asarray(dec).ravel()
+    counts = np.zeros(tile_par_struc()['ntile'] + 1, dtype='int64')
+    for i in range(0, len(ra), chunksize):
+        r = np.array(ra[i:i+chunksize], dtype='float64')
+        d = np.array(dec[i:i+chunksize], dtype='float64')
+        good = np.isfinite(r) & np.isfinite(d) & (np.abs(d) <= 90)
+        tnum = wssa_utils.coord_to_tnum(r[good] % 360., d[good])
+        counts += np.bincount(tnum, minlength=len(counts))
+    tiles = np.flatnonzero(counts)
+    return Footprint(tiles, counts[tiles], exten=exten, release=release,
+                     large=large, gz=gz, fz=fz)
+
+def region_footprint(regions, exten=0, release='1.0', large=True, gz=False,
+                     fz=False):
+    """
+    Find the tiles region_stats reads for a list of regions.
+
+    Inputs:
+        regions - list of region_stats.Disk and Polygon instances
+
+    Keyword inputs:
+        All keywords are as for wssa_getval.
+
+    Outputs:
+        footprint - Footprint instance, nsamp counting the regions
+                    overlapping each tile
+    """
+
+    from region_stats import region_tiles
+    groups = region_tiles(regions, large=large, release=release)
+    return Footprint([tnum for tnum, regs in groups],
+                     [len(regs) for tnum, regs in groups], exten=exten,
+                     release=release, large=large, gz=gz, fz=fz)
+
+if __name__ == '__main__':
+    """plan, and optionally stage, the tiles of a catalog"""
+    import argparse
+    import logging
+    from wssa_sample import read_coords
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('catalog', help='FITS, CSV or .npy catalog')
+    parser.add_argument('--ra', default='ra', help='RA column, default ra')
+    parser.add_argument('--dec', default='dec', help='DEC column, default dec')
+    parser.add_argument('--hdu', type=int, default=1,
+                        help='FITS table extension, default 1')
+    parser.add_argument('--exten', nargs='+', default=['clean'],
+                        help='extension names, default clean')
+    parser.add_argument('--tilepath', default=None,
+                        help='source tile directory, default WISE_TILE')
+    parser.add_argument('--stage', default=None,
+                        help='local directory to copy the needed tiles to')
+    parser.add_argument('--full', action='store_true',
+                        help='stage whole tile files, not only the needed '
+                        'extensions')
+    parser.add_argument('--small', action='store_true',
+                        help='3k x 3k tiles rather than 8k x 8k')
+    parser.add_argument('--gz', action='store_true', help='gzipped tiles')
+    parser.add_argument('--fz', action='store_true',
+                        help='tile-compressed tiles')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of files copied concurrently')
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    spill = opts.catalog + '.coords.npy'
+    ra, dec = read_coords(opts.catalog, racol=opts.ra, deccol=opts.dec,
+                          ext=opts.hdu, spill=spill)
+    exten = [(int(e) if e.isdigit() else e) for e in opts.exten]
+    fp = catalog_footprint(ra, dec, exten=exten, large=not opts.small,
+                           gz=opts.gz, fz=opts.fz)
+    del ra, dec
+    if os.path.exists(spill): os.remove(spill)
+    print(fp.summary(opts.tilepath))
+    missing = fp.missing(opts.tilepath)
+    if len(missing) > 0:
+        print('missing: ' + ' '.join([os.path.basename(f) for f in missing]))
+    if opts.stage is not None:
+        nbytes = fp.stage(opts.stage, tilepath=opts.tilepath,
+                          subset=not opts.full, workers=opts.workers)
+        print('staged %.1f MB to %s' % (nbytes/1.e6, opts.stage))
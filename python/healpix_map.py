@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""Precomputed full-sky HEALPix maps of the WSSA tiles, for approximate
+lookups without tile I/O."""
+
+import os
+import re
+import glob
+import numpy as np
+import wssa_utils
+from wssa_utils import tile_par_struc, radeg
+from ang2pix_ring import ang2pix_ring_blocked
+
+# memory maps of HEALPix map files, keyed on file name
+healpix_maps = {}
+
+def map_name(exten, nside, large=True):
+    """File name of the HEALPix map of extension name exten."""
+    return ('wssa-healpix-' + exten + '-' + ('8k' if large else '3k') +
+            '-nside' + str(int(nside)) + '.npy')
+
+def find_map(exten, path, large=True):
+    """
+    Locate the finest HEALPix map of extension name exten in directory path.
+
+    Outputs:
+        fname - map file name, None if there is no map
+
+    Comments:
+        The sidecar files reproject writes next to a map are skipped, as
+        are maps that still have any of them, whose build by build_map is
+        unfinished.
+    """
+
+    from reproject import sidecar_names
+    prefix = map_name(exten, 0, large=large)[:-len('0.npy')]
+    nsides = {}
+    for f in glob.glob(os.path.join(path, prefix + '*.npy')):
+        m = re.match(re.escape(prefix) + r'(\d+)\.npy$', os.path.basename(f))
+        if (m is None) or any([os.path.exists(sidecar)
+                               for sidecar in sidecar_names(f).values()]):
+            continue
+        nsides[f] = int(m.group(1))
+    if len(nsides) == 0: return None
+    return max(nsides, key=nsides.get)
+
+def build_map(nside=4096, exten=0, tilepath=None, outpath=None,
+              release='1.0', large=True, gz=False, fz=False, workers=None,
+              backend='thread', chunksize=2**22, resume=True):
+    """
+    Reproject WSSA tiles onto full-sky HEALPix maps, read with approx=True.
+
+    Keyword inputs:
+        nside   - HEALPix nside of the maps, default 4096
+        exten   - extension, or list of extensions, one map is written for
+                  each, as for wssa_utils.wssa_getval
+        outpath - output directory, default is tilepath
+        All other keywords are as for reproject.reproject.
+
+    Outputs:
+        fnames - list of map file names
+
+    Comments:
+        Each map is a RING ordered, equatorial HEALPix map holding the
+        value of wssa_getval, in DN, at every pixel center, written by
+        reproject.reproject. It is named as by map_name, which is where
+        wssa_getval(approx=True) looks for it. At nside 4096, a map takes
+        805 MB, at nside 8192, 3.2 GB.
+    """
+
+    from reproject import HealpixGrid, reproject
+    par = tile_par_struc(large=large, release=release)
+    if tilepath is None: tilepath = par['tpath']
+    if outpath is None: outpath = tilepath
+    names = wssa_utils.exten_list(exten, par)[1]
+
+    fnames = []
+    for name in names:
+        fname = os.path.join(outpath, map_name(name, nside, large=large))
+        reproject(HealpixGrid(nside), fname, exten=name, tilepath=tilepath,
+                  release=release, large=large, gz=gz, fz=fz,
+                  workers=workers, backend=backend, chunksize=chunksize,
+                  resume=resume)
+        healpix_maps.pop(fname, None)
+        fnames.append(fname)
+    return fnames
+
+def load_map(fname):
+    """
+    Return read-only memory map of HEALPix map file fname, and its nside.
+
+    Comments:
+        Each file is mapped once and kept in the healpix_maps global.
+    """
+
+    if fname not in healpix_maps:
+        hmap = np.load(fname, mmap_mode='r')
+        nside = int(round(np.sqrt(len(hmap)/12.)))
+        if 12*nside*nside != len(hmap):
+            raise ValueError(fname + ' is not a full-sky HEALPix map')
+        healpix_maps[fname] = (hmap, nside)
+    return healpix_maps[fname]
+
+def map_getval(ra, dec, exten=0, path=None, release='1.0', large=True,
+               block=65536):
+    """
+    Look up the HEALPix map pixels containing (ra, dec).
+
+    Inputs:
+        ra  - array of RA coordinates, degrees J2000
+        dec - array of DEC coordinates, degrees J2000
+
+    Keyword inputs:
+        exten - extension, or list of extensions, as for wssa_getval
+        path  - directory holding maps written by build_map, default
+                WISE_TILE, or the name of a single map file
+        block - number of coordinates looked up at a time
+
+    Outputs:
+        vals - map values in DN, shaped like ra; for a list exten, a
+               structured array with one field per extension
+
+    Comments:
+        Values are those of wssa_getval at the center of the HEALPix pixel
+        containing each coordinate, so the error is set by the map's
+        resolution, 51" at nside 4096 and 26" at nside 8192. Pixels are
+        gathered from a memory map, block by block, without tile I/O.
+    """
+
+    par = tile_par_struc(large=large, release=release)
+    if path is None: path = par['tpath']
+    if path is None:
+        raise ValueError('no map path given and WISE_TILE is not set')
+    extens, names = wssa_utils.exten_list(exten, par)
+    ra = np.asarray(ra, dtype='float64')
+    dec = np.asarray(dec, dtype='float64')
+
+    if os.path.isdir(path):
+        fnames = [find_map(name, path, large=large) for name in names]
+    elif len(names) == 1:
+        fnames = [path]
+    else:
+        raise ValueError('a map directory is needed for a list of extensions')
+    for name, fname in zip(names, fnames):
+        if fname is None:
+            raise IOError('no HEALPix map of extension ' + name + ' in ' +
+                          path + ', see healpix_map.build_map')
+    maps = [load_map(fname) for fname in fnames]
+
+    vals = np.zeros(ra.size, dtype=[(name, hmap.dtype) for name, (hmap, _)
+                                    in zip(names, maps)])
+    theta = (90. - dec.ravel())/radeg
+    phi = ra.ravel()/radeg
+    ipix = {}
+    for i in range(0, ra.size, block):
+        for name, (hmap, nside) in zip(names, maps):
+            if nside not in ipix:
+                ipix[nside] = ang2pix_ring_blocked(nside, theta[i:i+block],
+                                                   phi[i:i+block])
+            vals[name][i:i+block] = hmap[ipix[nside]]
+        ipix.clear()
+
+    vals = vals.reshape(ra.shape)
+    if isinstance(exten, (list, tuple, np.ndarray)):
+        return vals
+    return vals[names[0]]
+
+if __name__ == '__main__':
+    """build HEALPix maps from the command line"""
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nside', type=int, default=4096,
+                        help='HEALPix nside, default 4096')
+    parser.add_argument('--extens', nargs='+', default=['clean'],
+                        help='extension names, default clean')
+    parser.add_argument('--tilepath', default=None,
+                        help='tile directory, default WISE_TILE')
+    parser.add_argument('--outpath', default=None,
+                        help='output directory, default tilepath')
+    parser.add_argument('--small', action='store_true',
+                        help='build from 3k x 3k tiles rather than 8k x 8k')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of tiles reprojected in parallel')
+    opts = parser.parse_args()
+    build_map(nside=opts.nside, exten=opts.extens, tilepath=opts.tilepath,
+              outpath=opts.outpath, large=not opts.small,
+              workers=opts.workers)
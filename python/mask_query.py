@@ -0,0 +1,331 @@
+"""Queries of the amsk/omsk bit-mask extensions by bit name."""
+
+import os
+import numpy as np
+import wssa_utils
+from wssa_utils import tile_par_struc
+from tile_cache import TileCache
+
+# bit numbers of the mask bits, see Meisner & Finkbeiner Table 2
+MASK_BITS = {'ps_core'        : 0,
+             'ps_ghost'       : 1,
+             'ps_bright'      : 2,
+             'latent1'        : 3,
+             'psf_residual'   : 4,
+             'ghost_bright'   : 5,
+             'sso'            : 6,
+             'compact_source' : 7,
+             'latent2'        : 8,
+             'latent3'        : 9,
+             'latent4'        : 10,
+             'sso_ghost'      : 11,
+             'sso_latent'     : 12,
+             'spike'          : 13,
+             'saturated'      : 14,
+             'moon'           : 15,
+             'rc3_galaxy'     : 16,
+             'big_object'     : 17,
+             'planet'         : 18,
+             'ref_failure'    : 19,
+             'line_defect'    : 20,
+             'low_coverage'   : 21,
+             'ecliptic'       : 22 }
+
+# OR pyramids of mask tile extensions, see mask_within
+pyramid_cache = TileCache(maxbytes=2**30)
+
+def bit_list(bits):
+    """
+    Parse bit name or number, or a list of these, into (names, numbers).
+
+    Comments:
+        None selects all 23 bits. Names are keys of MASK_BITS; numbers
+        are named 'bit<n>'.
+    """
+
+    if bits is None: bits = sorted(MASK_BITS, key=MASK_BITS.get)
+    if not isinstance(bits, (list, tuple, np.ndarray)): bits = [bits]
+    numbers = []
+    for b in bits:
+        if isinstance(b, (int, np.integer)):
+            n = int(b)
+        elif b in MASK_BITS:
+            n = MASK_BITS[b]
+        elif b.startswith('bit') and b[3:].isdigit():
+            n = int(b[3:])
+        else:
+            raise ValueError('unknown mask bit ' + str(b) + ', see MASK_BITS')
+        if (n < 0) or (n > 22):
+            raise ValueError('mask bits are numbered 0 to 22')
+        numbers.append(n)
+    names = dict([(v, k) for k, v in MASK_BITS.items()])
+    return [names[n] for n in numbers], numbers
+
+def bit_mask(bits):
+    """Integer with the bits named by bits set, see bit_list."""
+    mask = 0
+    for n in bit_list(bits)[1]:
+        mask |= (1 << n)
+    return mask
+
+def unpack_bits(vals, bits=None):
+    """
+    Split raw mask values into one boolean field per bit.
+
+    Inputs:
+        vals - integer array of amsk or omsk values
+
+    Keyword inputs:
+        bits - bit names or numbers, default all bits
+
+    Outputs:
+        flags - structured boolean array shaped like vals, one field per
+                bit, named as by bit_list
+    """
+
+    vals = np.asarray(vals)
+    names, numbers = bit_list(bits)
+    flags = np.zeros(vals.shape, dtype=[(name, 'bool') for name in names])
+    for name, n in zip(names, numbers):
+        flags[name] = (vals & (1 << n)) != 0
+    return flags
+
+def mask_getval(ra, dec, bits=None, exten='amsk', mode='any', **kwargs):
+    """
+    Sample mask bits at specified celestial coordinates.
+
+    Inputs:
+        ra  - array of RA coordinates, assumed degrees J2000
+        dec - array of DEC coordinates, assumed degrees J2000
+
+    Keyword inputs:
+        bits  - bit name or number, or a list of these, e.g.
+                ['moon', 'ecliptic', 'big_object'], default all bits
+        exten - 'amsk' (default) or 'omsk'
+        mode  - 'any' for a boolean array set where any of bits is set,
+                'all' where all of them are, 'packed' for the mask values
+                restricted to bits, or 'split' for a structured boolean
+                array with one field per bit
+        All other keywords are passed to wssa_utils.wssa_getval.
+
+    Outputs:
+        flags - array shaped like ra, as selected by mode
+    """
+
+    if exten not in ['amsk', 'omsk', 5, 6]:
+        raise ValueError('exten must be amsk or omsk')
+    mask = bit_mask(bits)
+    vals = wssa_utils.wssa_getval(ra, dec, exten=exten, **kwargs)
+    if not isinstance(vals, np.ndarray): return vals
+    if mode == 'any': return (vals & mask) != 0
+    if mode == 'all': return (vals & mask) == mask
+    if mode == 'packed': return vals & mask
+    if mode == 'split': return unpack_bits(vals, bits)
+    raise ValueError('mode must be any, all, packed or split')
+
+class MaskPyramid(object):
+    """
+    OR pyramid of one mask tile extension image.
+
+    Inputs:
+        image - integer mask image
+
+    Comments:
+        Level k holds the bitwise OR of each 2^k x 2^k block of image, so a
+        cell with none of the queried bits set rules out all of its
+        pixels at once. All levels, down to a single cell, are built
+        here, 4/3 of the size of image, so that nbytes is final once a
+        pyramid is kept in a TileCache.
+    """
+
+    def __init__(self, image):
+        self.levels = [np.asarray(image)]
+        while self.levels[-1].shape != (1, 1):
+            lev = self.levels[-1]
+            ny, nx = lev.shape
+            pad = np.zeros((ny + ny % 2, nx + nx % 2), dtype=lev.dtype)
+            pad[0:ny, 0:nx] = lev
+            self.levels.append(pad[0::2, 0::2] | pad[1::2, 0::2] |
+                               pad[0::2, 1::2] | pad[1::2, 1::2])
+
+    @property
+    def nbytes(self):
+        return sum([lev.nbytes for lev in self.levels])
+
+    def level(self, k):
+        """Return level k, the single cell top level for any k beyond it."""
+        return self.levels[min(k, len(self.levels)-1)]
+
+    def any_within(self, x, y, radius, mask):
+        """
+        Test for pixels with any bit of mask set within radius of (x, y).
+
+        Inputs:
+            x      - array of x pixel coordinates
+            y      - array of y pixel coordinates
+            radius - radius in pixels
+            mask   - integer with the bits of interest set
+
+        Outputs:
+            hit - boolean array, set where some pixel whose center lies
+                  within radius of (x, y) has a bit of mask set
+
+        Comments:
+            The search starts at the level with cells of about radius, and
+            only the cells straddling the circle are refined, so the work
+            per source does not grow with the area of the circle.
+        """
+
+        x = np.asarray(x, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+        hit = np.zeros(x.shape, dtype='bool')
+        k = (int(np.floor(np.log2(radius))) if radius >= 1 else 0)
+        size = 2**k
+        r2 = float(radius)**2
+
+        # cells at level k overlapping the bounding box of each circle
+        cx0 = np.floor(np.ceil(x - radius)/size).astype('int64')
+        cy0 = np.floor(np.ceil(y - radius)/size).astype('int64')
+        cx1 = np.floor(np.floor(x + radius)/size).astype('int64')
+        cy1 = np.floor(np.floor(y + radius)/size).astype('int64')
+        nmax = int(np.floor(2*radius/size)) + 2
+        src, cy, cx = [], [], []
+        for dy in range(nmax):
+            for dx in range(nmax):
+                good = np.flatnonzero((cy0 + dy <= cy1) & (cx0 + dx <= cx1))
+                src.append(good)
+                cy.append(cy0[good] + dy)
+                cx.append(cx0[good] + dx)
+        src = np.concatenate(src)
+        cy = np.concatenate(cy)
+        cx = np.concatenate(cx)
+
+        while len(src) > 0:
+            lev = self.level(k)
+            good = ((cy >= 0) & (cy < lev.shape[0]) & (cx >= 0) &
+                    (cx < lev.shape[1]))
+            good[good] = (lev[cy[good], cx[good]] & mask) != 0
+            good &= ~hit[src]
+            src, cy, cx = src[good], cy[good], cx[good]
+
+            # extent of the pixel centers of each cell
+            xs, ys = x[src], y[src]
+            xlo, ylo = cx*size, cy*size
+            xhi, yhi = xlo + size - 1, ylo + size - 1
+            dmin = (np.maximum(np.maximum(xlo - xs, xs - xhi), 0)**2 +
+                    np.maximum(np.maximum(ylo - ys, ys - yhi), 0)**2)
+            dmax = (np.maximum(np.abs(xs - xlo), np.abs(xs - xhi))**2 +
+                    np.maximum(np.abs(ys - ylo), np.abs(ys - yhi))**2)
+            hit[src[dmax <= r2]] = True
+            edge = (dmin <= r2) & (dmax > r2)
+            if (k == 0) or not edge.any(): break
+            src, cy, cx = src[edge], 2*cy[edge], 2*cx[edge]
+            src = np.tile(src, 4)
+            cy = np.concatenate([cy, cy + 1, cy, cy + 1])
+            cx = np.concatenate([cx, cx, cx + 1, cx + 1])
+            k -= 1
+            size //= 2
+        return hit
+
+def tile_pyramid(tnum, exten, tpath, large=True, gz=False, fz=False,
+                 cache=None):
+    """
+    Return MaskPyramid of extension exten of tile tnum, from pyramid_cache.
+
+    Keyword inputs:
+        cache - tile cache of the full mask image, as for wssa_getval
+    """
+
+    suffix = ('.fz' if fz else ('.gz' if gz else ''))
+    f = os.path.join(tpath, wssa_utils.com_tiles['FNAME'][tnum-1]) + suffix
+    key = TileCache.tile_key(tnum, exten, large, suffix, tpath)
+    cache = wssa_utils.resolve_cache(cache)
+
+    def load_image():
+        wssa_utils.log.info('Reading: %s', f)
+        return wssa_utils.read_tile_image(f, exten + int(fz))
+
+    def load_pyramid():
+        if cache is None: return MaskPyramid(load_image())
+        return MaskPyramid(cache.get(key, load_image))
+
+    return pyramid_cache.get(key, load_pyramid)
+
+def mask_within(ra, dec, radius, bits=None, exten='amsk', tilepath=None,
+                release='1.0', large=True, gz=False, fz=False, cache=None):
+    """
+    Test for mask bits set anywhere within radius of each coordinate.
+
+    Inputs:
+        ra     - array of RA coordinates, assumed degrees J2000
+        dec    - array of DEC coordinates, assumed degrees J2000
+        radius - search radius, arcsec
+
+    Keyword inputs:
+        bits  - bit name or number, or a list of these, default all bits
+        exten - 'amsk' (default) or 'omsk'
+        All other keywords are as for wssa_utils.wssa_getval.
+
+    Outputs:
+        hit - boolean array shaped like ra, set where some tile pixel whose
+              center lies within radius of (ra, dec) has any of bits set
+
+    Comments:
+        Each tile's mask is read once and reduced to a MaskPyramid, kept in
+        pyramid_cache, so that repeated queries of the same tiles need no
+        I/O; a pyramid takes 4/3 of the size of the mask image. Distances
+        are measured on each tile's gnomonic pixel grid. A circle that
+        crosses the edge of its tile is also searched in the tiles
+        containing points on its edge.
+    """
+
+    par = tile_par_struc(large=large, release=release)
+    if tilepath is None: tilepath = par['tpath']
+    if tilepath is None:
+        raise ValueError('no tile path given and WISE_TILE is not set')
+    exten = wssa_utils.exten_list(exten, par)[0][0]
+    if not par['ismsk'][exten]:
+        raise ValueError('exten must be amsk or omsk')
+    mask = bit_mask(bits)
+
+    sane, ra, dec = wssa_utils.check_coords(ra, dec)
+    if not sane: return -1
+    sh = ra.shape
+    ra = ra.astype('float64').ravel()
+    dec = dec.astype('float64').ravel()
+    rpix = float(radius)/par['pscl']
+
+    tnum, x, y = wssa_utils.coord_to_tile(ra, dec, large=large)
+    src = np.arange(len(ra))
+
+    # circles crossing the tile edge, also searched in neighbouring tiles
+    pix = par['pix']
+    edge = np.flatnonzero((x - rpix < -0.5) | (x + rpix > pix - 0.5) |
+                          (y - rpix < -0.5) | (y + rpix > pix - 0.5))
+    if len(edge) > 0:
+        extra = []
+        for theta in np.arange(8)*np.pi/4:
+            pra, pdec = wssa_utils.tile_to_coord(
+                tnum[edge], x[edge] + rpix*np.cos(theta),
+                y[edge] + rpix*np.sin(theta), large=large)
+            pdec = np.clip(pdec, -90., 90.)
+            pnum = wssa_utils.coord_to_tile(pra % 360., pdec, large=large)[0]
+            extra.append((edge*512 + pnum)[pnum != tnum[edge]])
+        extra = np.unique(np.concatenate(extra))
+        if len(extra) > 0:
+            esrc, etnum = extra // 512, extra % 512
+            ex, ey = wssa_utils.tile_xy(ra[esrc], dec[esrc], etnum,
+                                        large=large)
+            src = np.concatenate([src, esrc])
+            tnum = np.concatenate([tnum, etnum])
+            x = np.concatenate([x, ex])
+            y = np.concatenate([y, ey])
+
+    hit = np.zeros(len(ra), dtype='bool')
+    sind, tiles, bdy = wssa_utils.tile_groups(tnum)
+    for i, t in enumerate(tiles):
+        ind = sind[bdy[i]:bdy[i+1]]
+        pyr = tile_pyramid(t, exten, tilepath, large=large, gz=gz, fz=fz,
+                           cache=cache)
+        hit[src[ind[pyr.any_within(x[ind], y[ind], rpix, mask)]]] = True
+    return hit.reshape(sh)
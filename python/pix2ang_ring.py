@@ -53,7 +53,7 @@ def pix2ang_ring(nside, ipix):
     n_np = len(pix_np)
     if (n_np > 0):
         ip = numpy.round(ipix[pix_np]) + one
-        iring = (numpy.sqrt(ip/2.-numpy.sqrt(ip/2))).astype('int') + 1
+        iring = (numpy.sqrt(ip/2.-numpy.sqrt(ip//2))).astype('int') + 1
         iphi = ip - 2*iring*(iring-one)
 
         theta[pix_np] = numpy.arccos(1. - numpy.power(iring.astype('float64'), 2)/fact2)
@@ -75,7 +75,7 @@ def pix2ang_ring(nside, ipix):
     n_sp = len(pix_sp)
     if (n_sp > 0):
         ip = npix - numpy.round(ipix[pix_sp])
-        iring = (numpy.sqrt(ip/2.-numpy.sqrt(ip/2))).astype('int') + 1
+        iring = (numpy.sqrt(ip/2.-numpy.sqrt(ip//2))).astype('int') + 1
         iphi = one + four*iring - (ip - 2*iring*(iring-one))
 
         theta[pix_sp] = numpy.arccos(-1. + numpy.power(iring.astype('float64'), 2)/fact2)
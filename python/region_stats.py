@@ -0,0 +1,361 @@
+"""Statistics of native WSSA tile pixels within disks and polygons."""
+
+import os
+import numpy as np
+import wssa_utils
+from wssa_utils import tile_par_struc, radeg
+
+def unit_vector(ra, dec):
+    """Cartesian unit vectors of (ra, dec) in degrees, shape (3, ...)."""
+    ra = np.asarray(ra, dtype='float64')/radeg
+    dec = np.asarray(dec, dtype='float64')/radeg
+    return np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra),
+                     np.sin(dec)])
+
+def angular_distance(ra1, dec1, ra2, dec2):
+    """Angular distance in degrees between (ra1, dec1) and (ra2, dec2)."""
+    v1 = unit_vector(ra1, dec1)
+    v2 = unit_vector(ra2, dec2)
+    chord = np.sqrt((v1[0]-v2[0])**2 + (v1[1]-v2[1])**2 + (v1[2]-v2[2])**2)
+    return 2*np.arcsin(np.minimum(chord/2, 1.))*radeg
+
+class Disk(object):
+    """
+    Spherical cap on the sky.
+
+    Inputs:
+        ra     - RA of the center, degrees J2000
+        dec    - DEC of the center, degrees J2000
+        radius - angular radius, degrees
+    """
+
+    def __init__(self, ra, dec, radius):
+        self.ra = float(ra)
+        self.dec = float(dec)
+        self.radius = float(radius)
+
+    def cap(self):
+        """Return (ra, dec, radius) of a cap containing the region."""
+        return self.ra, self.dec, self.radius
+
+    def outline(self, npt=None):
+        """
+        Return (ra, dec) of npt points along the boundary.
+
+        Comments:
+            By default, the points are close enough that the boundary
+            strays less than half a pixel of 8k tiles, 640 pixels/degree,
+            from the polygon they form.
+        """
+
+        if npt is None: npt = 16 + int(np.pi*np.sqrt(self.radius*640.))
+        az = np.arange(npt)*(2*np.pi/npt)
+        r = self.radius/radeg
+        dec0 = self.dec/radeg
+        sindec = np.sin(dec0)*np.cos(r) + np.cos(dec0)*np.sin(r)*np.cos(az)
+        dra = np.arctan2(np.sin(az)*np.sin(r)*np.cos(dec0),
+                         np.cos(r) - np.sin(dec0)*sindec)
+        return (np.mod(self.ra + dra*radeg, 360.),
+                np.arcsin(np.clip(sindec, -1, 1))*radeg)
+
+    def contains(self, ra, dec, x, y, xv, yv):
+        """Flag pixels at (ra, dec), tile coordinates (x, y), in the disk."""
+        return angular_distance(ra, dec, self.ra, self.dec) <= self.radius
+
+class Polygon(object):
+    """
+    Spherical polygon with great circle edges.
+
+    Inputs:
+        ra  - RA of the vertices, degrees J2000
+        dec - DEC of the vertices, degrees J2000
+
+    Comments:
+        The polygon must fit well within a hemisphere. Great circles
+        project to straight lines in the gnomonic projection of a tile, so
+        the polygon is tested exactly as a plane polygon in tile pixel
+        coordinates.
+    """
+
+    def __init__(self, ra, dec):
+        self.ra = np.asarray(ra, dtype='float64').ravel()
+        self.dec = np.asarray(dec, dtype='float64').ravel()
+
+    def cap(self):
+        """Return (ra, dec, radius) of a cap containing the region."""
+        v = np.sum(unit_vector(self.ra, self.dec), axis=1)
+        v /= np.sqrt(np.sum(v*v))
+        ra = np.mod(np.arctan2(v[1], v[0])*radeg, 360.)
+        dec = np.arcsin(v[2])*radeg
+        return ra, dec, np.max(angular_distance(self.ra, self.dec, ra, dec))
+
+    def outline(self):
+        """Return (ra, dec) of the vertices."""
+        return self.ra, self.dec
+
+    def contains(self, ra, dec, x, y, xv, yv):
+        """Flag pixels at tile coordinates (x, y) inside vertices (xv, yv)."""
+        inside = np.zeros(x.shape, dtype=bool)
+        for i in range(len(xv)):
+            x0, y0 = xv[i-1], yv[i-1]
+            x1, y1 = xv[i], yv[i]
+            if y0 == y1: continue
+            cross = ((y0 > y) != (y1 > y)) & \
+                    (x < x0 + (y - y0)*(x1 - x0)/(y1 - y0))
+            inside ^= cross
+        return inside
+
+def group_stats(labels, vals, nreg, stats=('mean', 'median'),
+                percentiles=None):
+    """
+    Statistics of vals grouped by integer labels.
+
+    Inputs:
+        labels - array of group labels, [0, nreg)
+        vals   - array of values
+        nreg   - number of groups
+
+    Keyword inputs:
+        stats       - list of statistics, among 'mean', 'median', 'std',
+                      'min', 'max' and 'sum'
+        percentiles - list of percentiles, [0, 100]
+
+    Outputs:
+        res - dictionary holding the array 'npix' of group sizes, an array
+              for each of stats, and for percentiles a (nreg, len(q))
+              array 'percentiles'; empty groups have NaN statistics
+
+    Comments:
+        All groups are reduced at once, with bincount and a single lexsort.
+        Percentiles interpolate linearly, as numpy.percentile does.
+    """
+
+    vals = np.asarray(vals, dtype='float64')
+    labels = np.asarray(labels, dtype='int64')
+    order = np.lexsort((vals, labels))
+    labels = labels[order]
+    vals = vals[order]
+    npix = np.bincount(labels, minlength=nreg)
+    start = np.cumsum(npix) - npix
+    good = npix > 0
+    nan = np.zeros(nreg) + np.nan
+
+    def percentile(q):
+        pos = start + (np.maximum(npix, 1) - 1)*(q/100.)
+        lo = np.minimum(np.floor(pos).astype('int64'), max(len(vals)-1, 0))
+        hi = np.minimum(np.ceil(pos).astype('int64'), max(len(vals)-1, 0))
+        if len(vals) == 0: return nan.copy()
+        return np.where(good, vals[lo] + (vals[hi] - vals[lo])*(pos - lo),
+                        np.nan)
+
+    res = {'npix' : npix}
+    sums = np.bincount(labels, weights=vals, minlength=nreg)
+    mean = np.where(good, sums/np.maximum(npix, 1), np.nan)
+    for stat in stats:
+        if stat == 'mean':
+            res[stat] = mean
+        elif stat == 'sum':
+            res[stat] = sums
+        elif stat == 'std':
+            dev = np.bincount(labels, weights=(vals - mean[labels])**2,
+                              minlength=nreg)
+            res[stat] = np.where(good, np.sqrt(dev/np.maximum(npix, 1)),
+                                 np.nan)
+        elif stat == 'median':
+            res[stat] = percentile(50.)
+        elif stat == 'min':
+            res[stat] = percentile(0.)
+        elif stat == 'max':
+            res[stat] = percentile(100.)
+        else:
+            raise ValueError('unknown statistic ' + str(stat))
+    if percentiles is not None:
+        res['percentiles'] = np.array([percentile(float(q))
+                                       for q in percentiles]).T
+    return res
+
+def region_tiles(regions, large=True, release='1.0'):
+    """
+    Find the tiles whose pixel grids overlap each of a list of regions.
+
+    Inputs:
+        regions - list of Disk and Polygon instances
+
+    Keyword inputs:
+        large   - set for 8k x 8k tiles, default is 3k x 3k
+        release - default '1.0', currently only release = '1.0' supported
+
+    Outputs:
+        groups - list of (tnum, regs), one per tile, where regs holds
+                 (index into regions, x0, y0, x1, y1, xv, yv) of each
+                 region overlapping the tile: its pixel bounding box and
+                 the tile coordinates of its outline
+
+    Comments:
+        The candidate tiles of a region are those whose centers lie
+        within the region's bounding cap, widened by the tile
+        half-diagonal.
+    """
+
+    par = tile_par_struc(large=large, release=release)
+    pix = int(par['pix'])
+    caps = np.array([r.cap() for r in regions]).reshape(-1, 3)
+    dist = angular_distance(caps[:, 0:1], caps[:, 1:2],
+                            wssa_utils.com_tiles['RA'][None, :],
+                            wssa_utils.com_tiles['DEC'][None, :])
+    near = dist <= caps[:, 2:3] + par['sidelen']/np.sqrt(2.) + 0.5
+
+    groups = []
+    for tnum in np.flatnonzero(np.any(near, axis=0)) + 1:
+        regs = []
+        for r in np.flatnonzero(near[:, tnum-1]):
+            ora, odec = regions[r].outline()
+            xv, yv = wssa_utils.tile_xy(ora, odec,
+                                        np.zeros(len(ora), dtype='int16') +
+                                        tnum, large=large)
+            x0 = max(int(np.floor(xv.min())) - 1, 0)
+            y0 = max(int(np.floor(yv.min())) - 1, 0)
+            x1 = min(int(np.ceil(xv.max())) + 2, pix)
+            y1 = min(int(np.ceil(yv.max())) + 2, pix)
+            if (x1 > x0) and (y1 > y0):
+                regs.append((r, x0, y0, x1, y1, xv, yv))
+        if len(regs) > 0: groups.append((int(tnum), regs))
+    return groups
+
+def region_pixels(regions, exten=0, tilepath=None, release='1.0',
+                  large=True, gz=False, fz=False, cache=None, mask_bits=0,
+                  mask_exten='amsk', max_read_bytes=None):
+    """
+    Gather the native tile pixels inside each of a list of regions.
+
+    Inputs:
+        regions - list of Disk and Polygon instances
+
+    Keyword inputs:
+        mask_bits  - integer bit-mask, pixels of mask_exten with any of these
+                     bits set are excluded, default is no masking
+        mask_exten - bit-mask extension, 'amsk' (default) or 'omsk'
+        All other keywords are as for wssa_utils.wssa_getval, exten must be
+        a single extension.
+
+    Outputs:
+        labels - index into regions of each gathered pixel
+        vals   - value of each gathered pixel
+
+    Comments:
+        Each pixel is counted by the tile that owns its center according to
+        the HEALPix lookup, so that pixels in the overlaps between tiles
+        are counted once. The tiles read are those found by region_tiles.
+        All regions falling on a tile are served by the same set of
+        section reads, chosen by wssa_utils.plan_reads.
+    """
+
+    import pyfits
+    par = tile_par_struc(large=large, release=release)
+    extens, names = wssa_utils.exten_list(exten, par)
+    mextens, _ = wssa_utils.exten_list(mask_exten, par)
+    if tilepath is None: tilepath = par['tpath']
+    if tilepath is None:
+        raise ValueError('no tile path given and WISE_TILE is not set')
+    cache = wssa_utils.resolve_cache(cache)
+    pix = int(par['pix'])
+    suffix = ('.fz' if fz else ('.gz' if gz else ''))
+    fname = wssa_utils.com_tiles['FNAME']
+
+    groups = region_tiles(regions, large=large, release=release)
+    wssa_utils.require_tiles([tnum for tnum, regs in groups],
+                             extens + (mextens if mask_bits else []),
+                             tilepath, large=large, suffix=suffix,
+                             cache=cache)
+
+    labels = []
+    vals = []
+    for i, (tnum, regs) in enumerate(groups):
+        f = os.path.join(tilepath, fname[tnum-1]) + suffix
+        wssa_utils.log.info('[%d/%d] Reading: %s, %d region%s', i+1,
+                            len(groups), f, len(regs), 's'*int(len(regs) > 1))
+        box = np.array([reg[1:5] for reg in regs])
+        half = np.max(np.maximum(box[:, 2]-box[:, 0], box[:, 3]-box[:, 1]))
+        order, wbdy, boxes = wssa_utils.plan_reads(
+            0.5*(box[:, 0]+box[:, 2]), 0.5*(box[:, 1]+box[:, 3]), pix,
+            max_read_bytes=max_read_bytes, pad=half//2 + 2)
+        hdus = (pyfits.open(f) if cache is None else f)
+        for j in range(len(boxes)):
+            wx0, wy0, wx1, wy1 = [int(b) for b in boxes[j]]
+            subims = [wssa_utils.read_tile_section(
+                          hdus, e + int(fz), wy0, wy1, wx0, wx1, cache=cache,
+                          key=wssa_utils.TileCache.tile_key(tnum, e, large,
+                                                            suffix, tilepath))
+                      for e in (extens + mextens if mask_bits else extens)]
+            for k in order[wbdy[j]:wbdy[j+1]]:
+                r, x0, y0, x1, y1, xv, yv = regs[k]
+                y, x = np.mgrid[y0:y1, x0:x1]
+                x = x.ravel()
+                y = y.ravel()
+                ra, dec = wssa_utils.tile_to_coord(
+                    np.zeros(len(x), dtype='int16') + tnum, x, y, large=large)
+                keep = (wssa_utils.coord_to_tnum(ra, dec) == tnum) & \
+                       regions[r].contains(ra, dec, x, y, xv, yv)
+                if mask_bits:
+                    keep &= (subims[1][y-wy0, x-wx0] & mask_bits) == 0
+                vals.append(subims[0][y[keep]-wy0, x[keep]-wx0])
+                labels.append(np.zeros(np.sum(keep), dtype='int64') + r)
+
+    if len(vals) == 0:
+        return np.zeros(0, dtype='int64'), np.zeros(0)
+    return np.concatenate(labels), np.concatenate(vals)
+
+def region_stats(regions, stats=('mean', 'median'), percentiles=None,
+                 exten=0, tilepath=None, release='1.0', large=True,
+                 mjysr=False, gz=False, fz=False, cache=None, mask_bits=0,
+                 mask_exten='amsk', max_read_bytes=None):
+    """
+    Statistics of the native tile pixels within each of a list of regions.
+
+    Inputs:
+        regions - list of Disk and Polygon instances
+
+    Keyword inputs:
+        stats       - list of statistics, see group_stats
+        percentiles - list of percentiles, [0, 100]
+        All other keywords are as for region_pixels and
+        wssa_utils.wssa_getval.
+
+    Outputs:
+        res - dictionary of per-region statistics, see group_stats
+
+    Comments:
+        Regions are processed in a batch, each tile being read once for all
+        of the regions that fall on it, see region_pixels.
+    """
+
+    par = tile_par_struc(large=large, release=release)
+    labels, vals = region_pixels(regions, exten=exten, tilepath=tilepath,
+                                 release=release, large=large, gz=gz, fz=fz,
+                                 cache=cache, mask_bits=mask_bits,
+                                 mask_exten=mask_exten,
+                                 max_read_bytes=max_read_bytes)
+    vals = vals.astype('float64')
+    if mjysr: vals = wssa_utils.calibrate(vals, exten, par)
+    return group_stats(labels, vals, len(regions), stats=stats,
+                       percentiles=percentiles)
+
+def disk_stats(ra, dec, radius, **kwargs):
+    """
+    Statistics of the tile pixels within disks, see region_stats.
+
+    Inputs:
+        ra     - array of RA coordinates of disk centers, degrees J2000
+        dec    - array of DEC coordinates of disk centers, degrees J2000
+        radius - disk radii, degrees, array or single value
+
+    Keyword inputs:
+        As for region_stats.
+    """
+
+    ra, dec, radius = np.broadcast_arrays(np.atleast_1d(ra),
+                                          np.atleast_1d(dec),
+                                          np.atleast_1d(radius))
+    return region_stats([Disk(r, d, rad) for r, d, rad in
+                         zip(ra.ravel(), dec.ravel(), radius.ravel())],
+                        **kwargs)
@@ -0,0 +1,275 @@
+"""Reprojection of WSSA tiles onto HEALPix, CAR and gnomonic grids."""
+
+import os
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from numpy.lib.format import open_memmap
+import wssa_utils
+from wssa_utils import tile_par_struc, radeg
+from pix2ang_ring import pix2ang_ring
+
+class HealpixGrid(object):
+    """
+    Ring ordered, equatorial HEALPix map.
+
+    Inputs:
+        nside - HEALPix nside parameter
+    """
+
+    def __init__(self, nside):
+        self.nside = int(nside)
+        self.shape = (12*self.nside*self.nside,)
+
+    def coords(self, ind):
+        """Return RA, DEC in degrees of pixel centers with flat indices ind."""
+        theta, phi = pix2ang_ring(self.nside, np.asarray(ind))
+        return phi*radeg, 90. - theta*radeg
+
+class CarGrid(object):
+    """
+    Plate carree grid, RA increasing to the left.
+
+    Inputs:
+        racen  - RA at the center of the grid, degrees
+        deccen - DEC at the center of the grid, degrees
+        nx     - number of columns
+        ny     - number of rows
+        cdelt  - pixel size, degrees
+    """
+
+    def __init__(self, racen, deccen, nx, ny, cdelt):
+        self.racen = float(racen)
+        self.deccen = float(deccen)
+        self.cdelt = float(cdelt)
+        self.shape = (int(ny), int(nx))
+
+    def coords(self, ind):
+        """Return RA, DEC in degrees of pixel centers with flat indices ind."""
+        ny, nx = self.shape
+        j, i = np.divmod(np.asarray(ind), nx)
+        ra = np.mod(self.racen - (i - 0.5*(nx-1))*self.cdelt, 360.)
+        dec = self.deccen + (j - 0.5*(ny-1))*self.cdelt
+        return ra, dec
+
+class GnomonicGrid(object):
+    """
+    Gnomonic grid, with the same orientation as the WSSA tiles.
+
+    Inputs:
+        racen  - RA of the center of projection, degrees
+        deccen - DEC of the center of projection, degrees
+        nx     - number of columns
+        ny     - number of rows
+        pscl   - pixel scale at the center of projection, asec/pixel
+    """
+
+    def __init__(self, racen, deccen, nx, ny, pscl):
+        self.racen = float(racen)
+        self.deccen = float(deccen)
+        self.pscl = float(pscl)
+        self.shape = (int(ny), int(nx))
+
+    def coords(self, ind):
+        """Return RA, DEC in degrees of pixel centers with flat indices ind."""
+        ny, nx = self.shape
+        j, i = np.divmod(np.asarray(ind), nx)
+        ra, dec = wssa_utils.issa_proj_gnom_inv(i - 0.5*(nx-1),
+                                                j - 0.5*(ny-1),
+                                                self.racen/radeg,
+                                                self.deccen/radeg,
+                                                3600.*radeg/self.pscl)
+        return ra*radeg, dec*radeg
+
+def sidecar_names(outfile):
+    """Names of the tile index, boundary and progress files of outfile."""
+    return {'owner' : outfile + '.owner.npy',
+            'index' : outfile + '.index.npy',
+            'bdy'   : outfile + '.bdy.npy',
+            'done'  : outfile + '.done'}
+
+def build_tile_index(grid, outfile, chunksize=2**22):
+    """
+    Sort the pixels of grid by owning WSSA tile, with bounded memory.
+
+    Inputs:
+        grid    - output grid, e.g. HealpixGrid
+        outfile - output map file name, the index is written alongside it
+
+    Keyword inputs:
+        chunksize - number of pixels processed at a time
+
+    Outputs:
+        index - memory-mapped array of flat pixel indices, grouped by tile
+        bdy   - pixels owned by tile tnum are index[bdy[tnum-1]:bdy[tnum]]
+
+    Comments:
+        Pixel centers are assigned to tiles with the same HEALPix lookup
+        used by wssa_getval. The owning tile of every pixel is spilled to a
+        memory-mapped file on a first pass, then a counting sort scatters
+        the pixel indices into place on a second pass, so memory use is set
+        by chunksize rather than by the size of the output map.
+    """
+
+    names = sidecar_names(outfile)
+    npix = int(np.prod(grid.shape))
+    ntile = tile_par_struc()['ntile']
+    owner = open_memmap(names['owner'], mode='w+', dtype='int16',
+                        shape=(npix,))
+    counts = np.zeros(ntile+1, dtype='int64')
+    for i in range(0, npix, chunksize):
+        ra, dec = grid.coords(np.arange(i, min(i+chunksize, npix)))
+        owner[i:i+chunksize] = wssa_utils.coord_to_tnum(ra, dec)
+        counts += np.bincount(owner[i:i+chunksize], minlength=ntile+1)
+
+    bdy = np.append(0, np.cumsum(counts[1:]))
+    index = open_memmap(names['index'], mode='w+',
+                        dtype=('int32' if npix < 2**31 else 'int64'),
+                        shape=(npix,))
+    pos = bdy[:-1].copy()
+    for i in range(0, npix, chunksize):
+        tnum = np.asarray(owner[i:i+chunksize])
+        sind, tiles, gbdy = wssa_utils.tile_groups(tnum)
+        for t, lo, hi in zip(tiles, gbdy[:-1], gbdy[1:]):
+            index[pos[t-1]:pos[t-1]+hi-lo] = sind[lo:hi] + i
+            pos[t-1] += hi - lo
+    index.flush()
+    np.save(names['bdy'], bdy)
+    del owner
+    os.remove(names['owner'])
+    return index, bdy
+
+def _grid_tile_xy(grid, ind, tnum, large):
+    """Pixel coordinates within tile tnum of grid pixels ind."""
+    ra, dec = grid.coords(ind)
+    tlist = np.zeros(len(ind), dtype='int16') + tnum
+    return wssa_utils.tile_xy(ra, dec, tlist, large=large)
+
+def _reproject_tile_task(task):
+    """Sample the output pixels owned by one tile, write them to outfile."""
+    (prog, grid, outfile, tnum, ind, f, extens, names, ismsk, large, gz,
+     fz, mjysr, exten, release, chunksize) = task
+    wssa_utils.log.info('[%d/%d] Reprojecting: %s, %d pixels', prog[0],
+                        prog[1], f, len(ind))
+    par = tile_par_struc(large=large, release=release)
+
+    # pass over the pixel coordinates to find the bounding box, so that
+    # every chunk is sampled with the same reference pixel
+    bbox = None
+    for i in range(0, len(ind), chunksize):
+        x, y = _grid_tile_xy(grid, ind[i:i+chunksize], tnum, large)
+        b = wssa_utils.group_bbox(x, y, [0, len(x)], par['pix'])[0]
+        bbox = (b if bbox is None else
+                np.append(np.minimum(b[0:2], bbox[0:2]),
+                          np.maximum(b[2:4], bbox[2:4])))
+
+    out = open_memmap(outfile, mode='r+').reshape(-1)
+    for i in range(0, len(ind), chunksize):
+        if len(ind) > chunksize:
+            x, y = _grid_tile_xy(grid, ind[i:i+chunksize], tnum, large)
+        samps = wssa_utils.sample_tile(f, extens, x, y, par['pix'], ismsk,
+                                       gz or fz, bbox=bbox, fz=fz)
+        vals = np.zeros(len(x), dtype=out.dtype if out.dtype.names else
+                        [(names[0], out.dtype)])
+        for name, s in zip(names, samps):
+            vals[name] = s
+        if mjysr: vals = wssa_utils.calibrate(vals, exten, par)
+        out[ind[i:i+chunksize]] = (vals if out.dtype.names else
+                                   vals[names[0]])
+    out.flush()
+    del out
+    return tnum
+
+def reproject(grid, outfile, exten=0, tilepath=None, release='1.0',
+              large=True, mjysr=False, gz=False, fz=False, workers=None,
+              backend='thread', chunksize=2**22, resume=True):
+    """
+    Reproject WSSA tiles onto a grid, one tile at a time.
+
+    Inputs:
+        grid    - output grid, a HealpixGrid, CarGrid or GnomonicGrid
+        outfile - output .npy file, written as a memory map, shaped like
+                  grid.shape
+
+    Keyword inputs:
+        exten     - extension, or list of extensions for a structured
+                    output map, as for wssa_utils.wssa_getval
+        chunksize - maximum number of pixels held in memory per tile
+        resume    - set to continue an interrupted run writing the same
+                    grid to outfile, skipping tiles already completed
+        All other keywords are as for wssa_utils.wssa_getval.
+
+    Outputs:
+        out - read-only memory map of the output map
+
+    Comments:
+        Output pixels are grouped by the tile owning their center, see
+        build_tile_index, and each tile is opened once and sampled at all
+        of its pixels, giving the same values as wssa_getval at the pixel
+        centers. The numbers of completed tiles are appended to the
+        outfile + '.done' progress file, as each is flushed to disk, so
+        that a crashed run can be resumed. The index and progress files
+        are removed once every tile is done. Tiles are sampled
+        concurrently when workers is greater than one, each worker writing
+        its own pixels of outfile.
+    """
+
+    par = tile_par_struc(large=large, release=release)
+    extens, names = wssa_utils.exten_list(exten, par)
+    ismsk = [(par['ismsk'])[e] for e in extens]
+    if tilepath is None: tilepath = par['tpath']
+    if tilepath is None:
+        raise ValueError('no tile path given and WISE_TILE is not set')
+
+    sidecars = sidecar_names(outfile)
+    if resume and all([os.path.exists(sidecars[k]) for k in
+                       ['index', 'bdy', 'done']]) and os.path.exists(outfile):
+        index = np.load(sidecars['index'], mmap_mode='r')
+        bdy = np.load(sidecars['bdy'])
+        done = set([int(l) for l in open(sidecars['done']).read().split()])
+    else:
+        if isinstance(exten, (list, tuple, np.ndarray)):
+            dtype = [(name, (par['dtype'])[msk])
+                     for name, msk in zip(names, ismsk)]
+        else:
+            dtype = (par['dtype'])[ismsk[0]]
+        out = open_memmap(outfile, mode='w+', dtype=dtype, shape=grid.shape)
+        del out
+        index, bdy = build_tile_index(grid, outfile, chunksize=chunksize)
+        open(sidecars['done'], 'w').close()
+        done = set()
+
+    suffix = ('.fz' if fz else ('.gz' if gz else ''))
+    fname = wssa_utils.com_tiles['FNAME']
+    tiles = [t for t in range(1, par['ntile']+1)
+             if (bdy[t] > bdy[t-1]) and (t not in done)]
+    tasks = []
+    for i, t in enumerate(tiles):
+        f = os.path.join(tilepath, fname[t-1]) + suffix
+        tasks.append(((i+1, len(tiles)), grid, outfile, t,
+                      index[bdy[t-1]:bdy[t]], f, extens, names, ismsk, large,
+                      gz, fz, mjysr, exten, release, chunksize))
+
+    if (workers is None) or (workers <= 1) or (len(tasks) <= 1):
+        results = (_reproject_tile_task(task) for task in tasks)
+        pool = None
+    else:
+        pool = (Pool if backend == 'process' else ThreadPool)(workers)
+        results = pool.imap_unordered(_reproject_tile_task, tasks)
+
+    try:
+        fp = open(sidecars['done'], 'a')
+        for t in results:
+            fp.write(str(t) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        fp.close()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    del index
+    for k in ['index', 'bdy', 'done']:
+        os.remove(sidecars[k])
+    return np.load(outfile, mmap_mode='r')
@@ -0,0 +1,105 @@
+"""Reusable plan for sampling a fixed list of coordinates from WSSA tiles."""
+
+import numpy as np
+import wssa_utils
+from wssa_utils import tile_par_struc
+
+class SamplingPlan(object):
+    """
+    Precomputed tile grouping of a fixed list of (ra, dec) coordinates.
+
+    Inputs:
+        ra  - array of RA coordinates, assumed degrees J2000
+        dec - array of DEC coordinates, assumed degrees J2000
+
+    Keyword inputs:
+        large - tile size for which pixel coordinates are computed up front,
+                default is 8k x 8k
+
+    Comments:
+        The HEALPix lookup and the grouping by tile are done once, when
+        the plan is built. The plan then stores the coordinates sorted into
+        tile groups, the group boundaries, and, for each tile size it has
+        been run against, the tile pixel coordinates and the integer pixel
+        bounding box of every group. The getval method can then be run
+        against any extension, tile path, tile size or compression without
+        redoing this work. Plans hold only numpy arrays, so they can be
+        pickled and shipped to worker processes.
+    """
+
+    def __init__(self, ra, dec, large=True):
+        sane, ra, dec = wssa_utils.check_coords(ra, dec)
+        if not sane:
+            raise ValueError('ra, dec must have equal shapes, |dec| <= 90')
+
+        self.shape = ra.shape
+        self.large = bool(large)
+        ra = ra.astype('float64').ravel()
+        dec = dec.astype('float64').ravel()
+
+        tnum = wssa_utils.coord_to_tnum(ra, dec)
+        self.sind, self.tiles, self.bdy = wssa_utils.tile_groups(tnum)
+        self.tnum = tnum[self.sind]
+        self.ra = ra[self.sind]
+        self.dec = dec[self.sind]
+        self._geometry = {}
+        self.geometry(large=large)
+
+    def geometry(self, large=True):
+        """
+        Return tile pixel coordinates of the grouped samples.
+
+        Keyword inputs:
+            large - set for 8k x 8k tiles, default is 3k x 3k
+
+        Outputs:
+            x    - x coordinates, sorted into tile groups
+            y    - y coordinates, sorted into tile groups
+            bbox - integer (xoffs, yoffs, xmax, ymax) of each tile group
+        """
+
+        large = bool(large)
+        if large not in self._geometry:
+            x, y = wssa_utils.tile_xy(self.ra, self.dec, self.tnum,
+                                      large=large)
+            pix = tile_par_struc(large=large)['pix']
+            bbox = wssa_utils.group_bbox(x, y, self.bdy, pix)
+            self._geometry[large] = (x, y, bbox)
+        return self._geometry[large]
+
+    def getval(self, exten=0, tilepath=None, release='1.0', large=None,
+               mjysr=False, gz=False, cache=None, mmap=False, workers=None,
+               backend='thread', fz=False, max_read_bytes=None,
+               stats=None, readahead=None):
+        """
+        Sample values from WSSA tiles at the planned coordinates.
+
+        Keyword inputs:
+            large - tile size, defaults to the size the plan was built for
+            All other keywords are as for wssa_utils.wssa_getval.
+
+        Outputs:
+            vals - values at the planned (ra, dec), shaped like the input
+        """
+
+        if large is None: large = self.large
+        x, y, bbox = self.geometry(large=large)
+        svals = wssa_utils.sample_groups(self.tiles, self.bdy, x, y,
+                                         large=large, exten=exten,
+                                         release=release, tpath=tilepath,
+                                         gz=gz, cache=cache, mmap=mmap,
+                                         workers=workers, backend=backend,
+                                         bbox=bbox, fz=fz,
+                                         max_read_bytes=max_read_bytes,
+                                         stats=stats, readahead=readahead)
+        vals = np.empty_like(svals)
+        vals[self.sind] = svals
+
+        if mjysr:
+            par = tile_par_struc(release=release, large=large)
+            vals = wssa_utils.calibrate(vals, exten, par)
+
+        return vals.reshape(self.shape)
+
+    def __len__(self):
+        return len(self.sind)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""Write synthetic WSSA tiles with analytic pixel values, for offline tests."""
+
+import os
+import gzip
+import shutil
+import numpy as np
+import wssa_utils
+from wssa_utils import tile_par_struc, radeg
+
+def synth_value(ra, dec, exten):
+    """
+    Analytic value of a synthetic tile extension at (ra, dec).
+
+    Inputs:
+        ra    - RA coordinates, degrees J2000
+        dec   - DEC coordinates, degrees J2000
+        exten - extension, integer or name as in tile_par_struc()['extens']
+
+    Outputs:
+        vals  - float64 values, int32 for the bit-mask extensions
+
+    Comments:
+        Intensities are smooth functions of position on the sphere,
+        continuous across RA = 0 and the poles, so that values interpolated
+        off of the synthetic tiles can be compared with synth_value at the
+        same coordinates, with errors set by the float32 pixel values. Bit
+        b of amsk is set on alternating stripes of DEC (b+1)^-1 degrees
+        wide, bit b of omsk on alternating stripes of RA (b+1)^-1 degrees
+        wide, for b = 0 to 7.
+    """
+
+    par = tile_par_struc()
+    if not isinstance(exten, (int, np.integer)): exten = par['extens'][exten]
+    ra = np.asarray(ra, dtype='float64')
+    dec = np.asarray(dec, dtype='float64')
+
+    if par['ismsk'][exten]:
+        coord = (dec if exten == par['extens']['amsk'] else ra)
+        vals = np.zeros(coord.shape, dtype='int32')
+        for b in range(8):
+            vals |= ((np.floor(coord*(b+1)).astype('int32') & 1) << b)
+        return vals
+
+    lam = ra/radeg
+    phi = dec/radeg
+    clean = 10. + 5.*np.cos(phi)*np.cos(2.*lam) + 3.*np.sin(phi)
+    if exten == par['extens']['clean']:
+        return clean
+    if exten == par['extens']['dirt']:
+        return clean + 2.*(np.cos(phi)**2)*np.sin(lam)
+    if exten == par['extens']['cov']:
+        return 20. + 10.*(np.sin(phi)**2)
+    if exten == par['extens']['min']:
+        return clean - 1. - 0.5*np.cos(phi)*np.cos(lam)
+    if exten == par['extens']['max']:
+        return clean + 1. + 0.5*np.cos(phi)*np.sin(lam)
+    return 0.5*np.cos(phi)*np.sin(4.*lam)
+
+def header_block(cards):
+    """
+    Format (keyword, value) pairs as a FITS header padded to 2880 bytes.
+
+    Comments:
+        Values are written in fixed format, logicals as T/F, strings quoted.
+    """
+
+    lines = []
+    for key, val in cards:
+        if isinstance(val, bool):
+            val = ('T' if val else 'F').rjust(20)
+        elif isinstance(val, str):
+            val = ("'" + val.ljust(8) + "'").ljust(20)
+        else:
+            val = str(val).rjust(20)
+        lines.append((key.ljust(8) + '= ' + val).ljust(80))
+    lines.append('END'.ljust(80))
+    hdr = ''.join(lines)
+    return (hdr + ' '*((-len(hdr)) % 2880)).encode('ascii')
+
+def synth_tile(tnum, fout, large=True, extens=None, rows=256):
+    """
+    Write one synthetic WSSA tile, with the layout of the real tiles.
+
+    Inputs:
+        tnum - tile number, [1, 430]
+        fout - output file name
+
+    Keyword inputs:
+        large  - set for 8k x 8k tiles, default is 3k x 3k
+        extens - list of extensions, integer or names, to fill with
+                 synth_value; others are written as data-less HDUs so that
+                 extension numbers stay those of the real tiles; default is
+                 all extensions
+        rows   - number of image rows computed at a time
+
+    Comments:
+        Pixel (x, y) of every extension holds synth_value at the
+        coordinates tile_to_coord(tnum, x, y) of its center. The file is
+        written directly, one block of rows at a time for all extensions,
+        so memory use is set by rows rather than the tile size.
+    """
+
+    par = tile_par_struc(large=large)
+    nexten = len(par['extens'])
+    if extens is None: extens = range(nexten)
+    extens = wssa_utils.exten_list(list(extens), par)[0]
+    pix = int(par['pix'])
+    dtypes = [('>i4' if par['ismsk'][e] else '>f4') for e in range(nexten)]
+    nbytes = pix*pix*4
+    fill = nbytes + ((-nbytes) % 2880)
+
+    fp = open(fout, 'wb')
+    offsets = {}
+    for e in range(nexten):
+        cards = ([('SIMPLE', True)] if e == 0 else [('XTENSION', 'IMAGE')])
+        cards.append(('BITPIX', (32 if par['ismsk'][e] else -32)))
+        if e in extens:
+            cards += [('NAXIS', 2), ('NAXIS1', pix), ('NAXIS2', pix)]
+        else:
+            cards.append(('NAXIS', 0))
+        cards += ([('EXTEND', True)] if e == 0 else
+                  [('PCOUNT', 0), ('GCOUNT', 1)])
+        cards += [('TILENUM', int(tnum)), ('SYNTH', True)]
+        fp.write(header_block(cards))
+        if e in extens:
+            offsets[e] = fp.tell()
+            fp.seek(offsets[e] + fill - 1)
+            fp.write(b'\0')
+
+    x = np.arange(pix, dtype='float64')
+    for y0 in range(0, pix, rows):
+        y1 = min(y0 + rows, pix)
+        xx, yy = np.meshgrid(x, np.arange(y0, y1, dtype='float64'))
+        ra, dec = wssa_utils.tile_to_coord(tnum, xx, yy, large=large)
+        for e in extens:
+            fp.seek(offsets[e] + y0*pix*4)
+            fp.write(synth_value(ra, dec, e).astype(dtypes[e]).tobytes())
+    fp.close()
+
+def gzip_file(fin, fout):
+    """Gzip fin to fout, streaming rather than reading fin into memory."""
+    fpin = open(fin, 'rb')
+    fpout = gzip.open(fout, 'wb')
+    shutil.copyfileobj(fpin, fpout, 2**22)
+    fpout.close()
+    fpin.close()
+
+def _synth_tile_task(task):
+    """Write one synthetic tile, with optional gzipped copy."""
+    tnum, f, large, extens, gz, keep = task
+    print('Writing: ' + f + ('.gz' if gz and not keep else ''))
+    synth_tile(tnum, f, large=large, extens=extens)
+    if gz:
+        gzip_file(f, f + '.gz')
+        if not keep: os.remove(f)
+    return f
+
+def synth_tiles(outpath, tiles=None, large=True, extens=None, gz=False,
+                keep=True, workers=None):
+    """
+    Write a synthetic WSSA tile set, read as the real tiles would be.
+
+    Inputs:
+        outpath - output directory, used as tilepath or WISE_TILE
+
+    Keyword inputs:
+        tiles   - list of tile numbers, [1, 430], default is all tiles
+        large   - set for 8k x 8k tiles, default is 3k x 3k
+        extens  - extensions to fill, see synth_tile, default is all
+        gz      - set to also write gzipped *.fits.gz copies
+        keep    - when gz is set, unset to remove the uncompressed tiles
+        workers - number of tiles written concurrently, in separate
+                  processes, default is one at a time
+
+    Outputs:
+        fouts - list of uncompressed output file names
+
+    Comments:
+        Files are named as com_tiles['FNAME'], so that wssa_getval reads
+        them unchanged. Values match synth_value at the sampled coordinates
+        up to float32 rounding and bilinear interpolation error. A full 8k
+        set with all extensions takes about 860 GB, pass tiles and extens
+        to write a subset. Tile-compressed copies are made by running
+        compress_tiles on outpath.
+    """
+
+    if not os.path.exists(outpath): os.makedirs(outpath)
+    fname = wssa_utils.com_tiles['FNAME']
+    if tiles is None: tiles = range(1, tile_par_struc()['ntile']+1)
+    tasks = [(t, os.path.join(outpath, fname[t-1]), large, extens, gz, keep)
+             for t in tiles]
+
+    if (workers is None) or (workers <= 1) or (len(tasks) <= 1):
+        fouts = [_synth_tile_task(task) for task in tasks]
+    else:
+        from multiprocessing import Pool
+        pool = Pool(workers)
+        fouts = pool.map(_synth_tile_task, tasks)
+        pool.close()
+        pool.join()
+    return fouts
+
+if __name__ == '__main__':
+    """write synthetic tiles from the command line"""
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('outpath', help='output directory')
+    parser.add_argument('--tiles', type=int, nargs='+', default=None,
+                        help='tile numbers, default all 430')
+    parser.add_argument('--small', action='store_true',
+                        help='write 3k x 3k tiles rather than 8k x 8k')
+    parser.add_argument('--extens', nargs='+', default=None,
+                        help='extension names to fill, default all')
+    parser.add_argument('--gz', action='store_true',
+                        help='also write gzipped copies')
+    parser.add_argument('--gz-only', action='store_true',
+                        help='write only gzipped tiles')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of tiles written in parallel')
+    opts = parser.parse_args()
+    synth_tiles(opts.outpath, tiles=opts.tiles, large=not opts.small,
+                extens=opts.extens, gz=(opts.gz or opts.gz_only),
+                keep=not opts.gz_only, workers=opts.workers)
@@ -7,7 +7,9 @@ Unit tests, will eventually repurpose for use with nose.
 import pyfits
 import numpy as np
 from pix2ang_ring import pix2ang_ring
+from ang2pix_ring import ang2pix_ring, ang2pix_ring_blocked
 import wssa_utils
+from sampling_plan import SamplingPlan
 from random_lonlat import random_lonlat
 
 def test_single_pair():
@@ -172,6 +174,625 @@ def test_tilepath(tilepath='/n/fink1/ameisner/tile-combine-8k'):
     assert isinstance(val, np.ndarray)
     assert val.shape == (nsam,)
     
+def test_tile_cache():
+    """repeated queries against the same tile are served from tile cache"""
+    print test_tile_cache.__doc__
+
+    racen = wssa_utils.com_tiles['RA'][114]
+    deccen = wssa_utils.com_tiles['DEC'][114]
+    nsam = 100
+    ra = np.random.rand(nsam) - 0.5 + racen
+    dec = np.random.rand(nsam) - 0.5 + deccen
+    cache = wssa_utils.TileCache()
+    tru = wssa_utils.wssa_getval(ra, dec)
+    vals = wssa_utils.wssa_getval(ra, dec, cache=cache)
+    assert cache.misses == 1
+    # uncompressed tiles are cached as memory maps, outside the budget
+    assert cache.nbytes == 0
+    vals = wssa_utils.wssa_getval(ra, dec, cache=cache)
+    assert cache.hits == 1
+    assert np.all(vals == tru)
+    cache.clear()
+    assert len(cache) == 0
+
+def test_mmap():
+    """memory-mapped gather path agrees with bounding box section reads"""
+    print test_mmap.__doc__
+
+    nsam = 1000
+    ra, dec = random_lonlat(nsam, deg=True)
+    tru = wssa_utils.wssa_getval(ra, dec)
+    vals = wssa_utils.wssa_getval(ra, dec, mmap=True)
+    assert vals.dtype.name == 'float32'
+    assert np.all(vals == tru)
+    vals = wssa_utils.wssa_getval(ra, dec, exten='amsk', mmap=True)
+    assert vals.dtype.name == 'int32'
+
+def test_workers():
+    """thread and process pools give the same values as serial sampling"""
+    print test_workers.__doc__
+
+    nsam = 100
+    ra, dec = random_lonlat(nsam, deg=True)
+    tru = wssa_utils.wssa_getval(ra, dec)
+    for backend in ['thread', 'process']:
+        vals = wssa_utils.wssa_getval(ra, dec, workers=4, backend=backend)
+        assert vals.dtype.name == 'float32'
+        assert np.all(vals == tru)
+
+def test_multi_exten():
+    """list of extensions sampled in one pass matches per-extension calls"""
+    print test_multi_exten.__doc__
+
+    nsam = 100
+    ra, dec = random_lonlat(nsam, deg=True)
+    extens = ['clean', 'cov', 'amsk', 'omsk']
+    vals = wssa_utils.wssa_getval(ra, dec, exten=extens)
+    assert vals.shape == (nsam,)
+    assert vals.dtype.names == tuple(extens)
+    for exten in extens:
+        tru = wssa_utils.wssa_getval(ra, dec, exten=exten)
+        assert vals[exten].dtype == tru.dtype
+        assert np.all(vals[exten] == tru)
+
+def test_getval_iter():
+    """chunked sampling yields one value array per input chunk"""
+    print test_getval_iter.__doc__
+
+    nsam = 1000
+    ra, dec = random_lonlat(nsam, deg=True)
+    tru = wssa_utils.wssa_getval(ra, dec)
+    chunks = list(wssa_utils.wssa_getval_iter(ra, dec, chunksize=300,
+                                              window=4))
+    assert len(chunks) == 4
+    assert chunks[-1].shape == (100,)
+    assert np.all(np.concatenate(chunks) == tru)
+
+def test_sampling_plan():
+    """pickled sampling plan reproduces wssa_getval for several extensions"""
+    print test_sampling_plan.__doc__
+
+    import pickle
+    nsam = 100
+    ra, dec = random_lonlat(nsam, deg=True)
+    sh = (20, 5)
+    ra = ra.reshape(sh)
+    dec = dec.reshape(sh)
+    plan = pickle.loads(pickle.dumps(SamplingPlan(ra, dec)))
+    assert len(plan) == nsam
+    for exten in ['clean', 'amsk']:
+        vals = plan.getval(exten=exten)
+        tru = wssa_utils.wssa_getval(ra, dec, exten=exten)
+        assert vals.shape == sh
+        assert vals.dtype == tru.dtype
+        assert np.all(vals == tru)
+
+def test_table_cache():
+    """binary .npy lookup tables match the FITS tables they cache"""
+    print test_table_cache.__doc__
+
+    par = wssa_utils.tile_par_struc()
+    for parkey in ['lookup', 'indexfile']:
+        tab = wssa_utils.load_table(par[parkey])
+        tru = wssa_utils.fits2dict(par[parkey])
+        assert sorted(tab.keys()) == sorted(tru.keys())
+        for name in tru.keys():
+            assert np.all(tab[name] == tru[name])
+
+def test_coord_to_tile_fused():
+    """fused coord_to_tile is bit-identical to issa_proj_gnom projection"""
+    print test_coord_to_tile_fused.__doc__
+
+    from bench import coord_to_tile_unfused
+    nsam = 100000
+    ra, dec = random_lonlat(nsam, deg=True)
+    for large in [True, False]:
+        tru = coord_to_tile_unfused(ra, dec, large=large)
+        out = (np.zeros(nsam, dtype='int16'), np.zeros(nsam), np.zeros(nsam))
+        res = wssa_utils.coord_to_tile(ra, dec, large=large, out=out,
+                                       block=1000)
+        for arr, tarr in zip(res, tru):
+            assert np.all(arr == tarr)
+
+def test_ang2pix_blocked():
+    """blocked ang2pix_ring matches ang2pix_ring over the full nside=64 sky"""
+    print test_ang2pix_blocked.__doc__
+
+    nside = 64
+    pix = np.arange(12*(nside**2))
+    theta, phi = pix2ang_ring(nside, pix)
+    nsam = 100000
+    ra, dec = random_lonlat(nsam, deg=True)
+    theta = np.concatenate((theta, (np.pi/180.)*(90. - dec)))
+    phi = np.concatenate((phi, (np.pi/180.)*ra, -(np.pi/180.)*ra))
+    theta = np.concatenate((theta, theta[len(pix):]))
+    tru = ang2pix_ring(nside, theta, phi)
+    for block in [1, 1000, 65536, len(theta)]:
+        ipring = ang2pix_ring_blocked(nside, theta, phi, block=block)
+        assert ipring.dtype.name == 'int64'
+        assert np.all(ipring == tru)
+
+def test_compressed_tiles():
+    """tile-compressed copy of a tile gives the same values as the original"""
+    print test_compressed_tiles.__doc__
+
+    import tempfile, shutil
+    from compress_tiles import compress_tiles
+    racen = wssa_utils.com_tiles['RA'][114]
+    deccen = wssa_utils.com_tiles['DEC'][114]
+    nsam = 100
+    ra = np.random.rand(nsam) - 0.5 + racen
+    dec = np.random.rand(nsam) - 0.5 + deccen
+    outpath = tempfile.mkdtemp()
+    try:
+        par = wssa_utils.tile_par_struc()
+        fouts = compress_tiles(par['tpath'], outpath=outpath, tiles=[115])
+        assert len(fouts) == 1
+        for exten in ['clean', 'amsk']:
+            tru = wssa_utils.wssa_getval(ra, dec, exten=exten)
+            vals = wssa_utils.wssa_getval(ra, dec, exten=exten, fz=True,
+                                          tilepath=outpath)
+            assert vals.dtype == tru.dtype
+            assert np.all(vals == tru)
+    finally:
+        shutil.rmtree(outpath)
+
+def test_sparse_reads():
+    """sparse samples are read as small windows without changing values"""
+    print test_sparse_reads.__doc__
+
+    pix = wssa_utils.tile_par_struc()['pix']
+    xx = np.array([10.3, pix-20.2])
+    yy = np.array([5.5, pix-10.1])
+    order, wbdy, boxes = wssa_utils.plan_reads(xx, yy, pix)
+    assert len(boxes) == 2
+    assert np.all((boxes[:, 2]-boxes[:, 0])*(boxes[:, 3]-boxes[:, 1]) <= 4)
+
+    nsam = 1000
+    ra, dec = random_lonlat(nsam, deg=True)
+    for exten in ['clean', 'amsk']:
+        tru = wssa_utils.wssa_getval(ra, dec, exten=exten)
+        vals = wssa_utils.wssa_getval(ra, dec, exten=exten,
+                                      max_read_bytes=4096)
+        assert np.all(vals == tru)
+
+def test_gnom_inverse():
+    """issa_proj_gnom_inv inverts issa_proj_gnom"""
+    print test_gnom_inverse.__doc__
+
+    nsam = 10000
+    ra0, dec0 = 1.3, -1.2
+    ra = ra0 + (np.random.rand(nsam) - 0.5)*0.2
+    dec = dec0 + (np.random.rand(nsam) - 0.5)*0.2
+    x, y = wssa_utils.issa_proj_gnom(ra, dec, ra0, dec0, 36000.)
+    ra_inv, dec_inv = wssa_utils.issa_proj_gnom_inv(x, y, ra0, dec0, 36000.)
+    assert np.max(np.abs(ra_inv - ra)) < 1e-12
+    assert np.max(np.abs(dec_inv - dec)) < 1e-12
+
+def test_reproject():
+    """tile by tile reprojection matches wssa_getval at pixel centers"""
+    print test_reproject.__doc__
+
+    import os, tempfile, shutil
+    from reproject import CarGrid, reproject
+    racen = wssa_utils.com_tiles['RA'][114]
+    deccen = wssa_utils.com_tiles['DEC'][114]
+    outpath = tempfile.mkdtemp()
+    try:
+        grid = CarGrid(racen, deccen, 200, 100, 0.01)
+        outfile = os.path.join(outpath, 'car.npy')
+        out = reproject(grid, outfile, chunksize=5000)
+        ra, dec = grid.coords(np.arange(200*100))
+        tru = wssa_utils.wssa_getval(ra, dec)
+        assert out.shape == (100, 200)
+        assert np.all(out == tru.reshape(100, 200))
+        assert os.listdir(outpath) == ['car.npy']
+    finally:
+        shutil.rmtree(outpath)
+
+def test_tile_to_coord():
+    """tile_to_coord inverts coord_to_tile, polar tiles included"""
+    print test_tile_to_coord.__doc__
+
+    nsam = 100000
+    ra, dec = random_lonlat(nsam, deg=True)
+    tnum, x, y = wssa_utils.coord_to_tile(ra, dec)
+    ra_inv, dec_inv = wssa_utils.tile_to_coord(tnum, x, y)
+    dra = np.mod(ra_inv - ra + 180., 360.) - 180.
+    assert np.max(np.abs(dra*np.cos(dec/wssa_utils.radeg))) < 1e-9
+    assert np.max(np.abs(dec_inv - dec)) < 1e-9
+
+def test_cutouts():
+    """cutouts match the native tile pixels around each source"""
+    print test_cutouts.__doc__
+
+    racen = wssa_utils.com_tiles['RA'][114]
+    deccen = wssa_utils.com_tiles['DEC'][114]
+    nsam = 20
+    size = 33
+    ra = np.random.rand(nsam) - 0.5 + racen
+    dec = np.random.rand(nsam) - 0.5 + deccen
+    cut = wssa_utils.wssa_cutouts(ra, dec, size)
+    assert cut.shape == (nsam, size, size)
+    assert cut.dtype.name == 'float32'
+
+    par = wssa_utils.tile_par_struc()
+    image = pyfits.getdata(par['tpath'] + '/' +
+                           wssa_utils.com_tiles['FNAME'][114])
+    tnum, x, y = wssa_utils.coord_to_tile(ra, dec)
+    assert np.all(tnum == 115)
+    for i in range(nsam):
+        x0 = int(np.round(x[i])) - size//2
+        y0 = int(np.round(y[i])) - size//2
+        assert np.all(cut[i] == image[y0:y0+size, x0:x0+size])
+
+    cut = wssa_utils.wssa_cutouts(ra, dec, size, exten=['clean', 'amsk'])
+    assert cut.dtype.names == ('clean', 'amsk')
+    assert cut['amsk'].dtype.name == 'int32'
+
+def test_group_stats():
+    """grouped statistics agree with numpy reductions of each group"""
+    print test_group_stats.__doc__
+
+    from region_stats import group_stats
+    nreg = 10
+    labels = np.random.randint(0, nreg-1, 10000)
+    vals = np.random.randn(10000)
+    res = group_stats(labels, vals, nreg, stats=['mean', 'median', 'std',
+                                                 'min', 'max'],
+                      percentiles=[5, 50, 95])
+    assert res['npix'][nreg-1] == 0
+    assert np.isnan(res['mean'][nreg-1])
+    for i in range(nreg-1):
+        v = vals[labels == i]
+        assert res['npix'][i] == len(v)
+        assert np.allclose(res['mean'][i], np.mean(v))
+        assert np.allclose(res['std'][i], np.std(v))
+        assert res['median'][i] == np.median(v)
+        assert res['min'][i] == np.min(v)
+        assert res['max'][i] == np.max(v)
+        assert np.allclose(res['percentiles'][i],
+                           np.percentile(v, [5, 50, 95]))
+
+def test_region_stats():
+    """disk statistics match the tile pixels within the disk"""
+    print test_region_stats.__doc__
+
+    from region_stats import disk_stats, angular_distance
+    racen = wssa_utils.com_tiles['RA'][114]
+    deccen = wssa_utils.com_tiles['DEC'][114]
+    radius = 0.1
+    res = disk_stats(racen, deccen, radius, stats=['mean', 'median'])
+
+    par = wssa_utils.tile_par_struc()
+    image = pyfits.getdata(par['tpath'] + '/' +
+                           wssa_utils.com_tiles['FNAME'][114])
+    y, x = np.mgrid[3800:4200, 3800:4200]
+    ra, dec = wssa_utils.tile_to_coord(np.zeros(x.shape, dtype='int16') + 115,
+                                       x, y)
+    v = image[3800:4200, 3800:4200][angular_distance(ra, dec, racen, deccen)
+                                    <= radius].astype('float64')
+    assert res['npix'][0] == len(v)
+    assert np.allclose(res['mean'][0], np.mean(v))
+    assert res['median'][0] == np.median(v)
+
+def test_synth_tiles():
+    """values sampled from a synthetic tile match the analytic values"""
+    print test_synth_tiles.__doc__
+
+    import tempfile, shutil
+    from synth_tiles import synth_tiles, synth_value
+    racen = wssa_utils.com_tiles['RA'][114]
+    deccen = wssa_utils.com_tiles['DEC'][114]
+    nsam = 1000
+    ra = np.random.rand(nsam) - 0.5 + racen
+    dec = np.random.rand(nsam) - 0.5 + deccen
+    outpath = tempfile.mkdtemp()
+    try:
+        synth_tiles(outpath, tiles=[115], large=False,
+                    extens=['clean', 'amsk'])
+        vals = wssa_utils.wssa_getval(ra, dec, exten=['clean', 'amsk'],
+                                      large=False, tilepath=outpath)
+        assert np.allclose(vals['clean'], synth_value(ra, dec, 'clean'),
+                           rtol=0., atol=1e-4)
+        # bit-masks are quoted at the nearest pixel center
+        tnum, x, y = wssa_utils.coord_to_tile(ra, dec, large=False)
+        rapix, decpix = wssa_utils.tile_to_coord(tnum, np.round(x),
+                                                 np.round(y), large=False)
+        assert np.all(vals['amsk'] == synth_value(rapix, decpix, 'amsk'))
+    finally:
+        shutil.rmtree(outpath)
+
+def test_tile_stats():
+    """per-tile read records account for every sample and tile"""
+    print test_tile_stats.__doc__
+
+    from tile_stats import TileStats
+    nsam = 100
+    ra, dec = random_lonlat(nsam, deg=True)
+    stats = TileStats()
+    vals = wssa_utils.wssa_getval(ra, dec, stats=stats)
+    tnum = wssa_utils.coord_to_tnum(ra, dec)
+    assert stats.totals['nsamp'] == nsam
+    assert stats.ntile == len(np.unique(tnum))
+    assert sorted(stats.by_tile().keys()) == sorted(np.unique(tnum))
+    assert stats.totals['bytes_read'] > 0
+    assert np.all(vals == wssa_utils.wssa_getval(ra, dec))
+
+def test_tile_store():
+    """shared tile store gives the same values, also in worker processes"""
+    print test_tile_store.__doc__
+
+    import tempfile, shutil
+    from tile_store import SharedTileStore
+    racen = wssa_utils.com_tiles['RA'][114]
+    deccen = wssa_utils.com_tiles['DEC'][114]
+    nsam = 100
+    ra = np.random.rand(nsam) - 0.5 + racen
+    dec = np.random.rand(nsam) - 0.5 + deccen
+    root = tempfile.mkdtemp()
+    try:
+        store = SharedTileStore(root)
+        store.fill([115], exten=['clean', 'amsk'])
+        assert len(store) == 2
+        for exten in ['clean', 'amsk']:
+            tru = wssa_utils.wssa_getval(ra, dec, exten=exten, cache=False)
+            vals = wssa_utils.wssa_getval(ra, dec, exten=exten, cache=store)
+            assert np.all(vals == tru)
+            vals = wssa_utils.wssa_getval(ra, dec, exten=exten,
+                                          cache=SharedTileStore(root,
+                                                                readonly=True),
+                                          workers=2, backend='process')
+            assert np.all(vals == tru)
+        assert store.stats()['misses'] == 0
+        store.clear()
+        assert len(store) == 0
+    finally:
+        shutil.rmtree(root)
+
+def test_approx():
+    """approximate lookups from a HEALPix map match values at pixel centers"""
+    print test_approx.__doc__
+
+    import os, tempfile, shutil
+    from healpix_map import build_map
+    nside = 16
+    theta, phi = pix2ang_ring(nside, np.arange(12*nside*nside))
+    ra = (180./np.pi)*phi
+    dec = 90. - (180./np.pi)*theta
+    outpath = tempfile.mkdtemp()
+    try:
+        fnames = build_map(nside=nside, exten=['clean', 'amsk'],
+                           outpath=outpath)
+        vals = wssa_utils.wssa_getval(ra, dec, exten=['clean', 'amsk'],
+                                      approx=outpath)
+        tru = wssa_utils.wssa_getval(ra, dec, exten=['clean', 'amsk'])
+        assert np.allclose(vals['clean'], tru['clean'], rtol=1e-3)
+        assert np.all(vals['amsk'] == tru['amsk'])
+        # any coordinate within a pixel gets the value of its center
+        vals = wssa_utils.wssa_getval(ra + 0.1, dec - 0.1, approx=outpath)
+        pix = ang2pix_ring(nside, (90. - (dec - 0.1))*(np.pi/180.),
+                           (ra + 0.1)*(np.pi/180.))
+        assert np.all(vals == np.load(fnames[0])[pix])
+        # an unfinished finer map, and its sidecar files, are skipped
+        from healpix_map import find_map, map_name
+        unfinished = os.path.join(outpath, map_name('clean', 2*nside))
+        for f in [unfinished, unfinished + '.owner.npy', unfinished + '.done']:
+            open(f, 'w').close()
+        assert find_map('clean', outpath) == fnames[0]
+    finally:
+        shutil.rmtree(outpath)
+
+def test_batch_sampler():
+    """command line sampler appends the values of wssa_getval to a catalog"""
+    print test_batch_sampler.__doc__
+
+    import os, tempfile, shutil
+    from wssa_sample import main
+    nsam = 1000
+    ra, dec = random_lonlat(nsam, deg=True)
+    cat = np.zeros(nsam, dtype=[('ra', 'f8'), ('dec', 'f8'), ('id', 'i8')])
+    cat['ra'] = ra
+    cat['dec'] = dec
+    cat['id'] = np.arange(nsam)
+    outpath = tempfile.mkdtemp()
+    try:
+        infile = os.path.join(outpath, 'cat.npy')
+        outfile = os.path.join(outpath, 'out.npy')
+        np.save(infile, cat)
+        main([infile, outfile, '--exten', 'clean', 'amsk', '--sort',
+              '--quiet'])
+        out = np.load(outfile)
+        tru = wssa_utils.wssa_getval(ra, dec, exten=['clean', 'amsk'])
+        assert np.all(out['id'] == cat['id'])
+        assert np.all(out['wssa_clean'] == tru['clean'])
+        assert np.all(out['wssa_amsk'] == tru['amsk'])
+    finally:
+        shutil.rmtree(outpath)
+
+def test_csv_coords():
+    """coordinates of a CSV catalog are read without a spill file"""
+    print test_csv_coords.__doc__
+
+    import os, tempfile, shutil
+    from wssa_sample import read_coords
+    nsam = 100
+    ra, dec = random_lonlat(nsam, deg=True)
+    outpath = tempfile.mkdtemp()
+    try:
+        infile = os.path.join(outpath, 'cat.csv')
+        fp = open(infile, 'w')
+        fp.write('id,RA,DEC\n')
+        for i in range(nsam):
+            fp.write('%d,%.17g,%s\n' % (i, ra[i],
+                                         ('%.17g' % dec[i] if i else '')))
+        fp.close()
+        r, d = read_coords(infile, racol='RA', deccol='DEC', chunksize=30)
+        assert np.all(r == ra)
+        assert np.isnan(d[0]) and np.all(d[1:] == dec[1:])
+    finally:
+        shutil.rmtree(outpath)
+
+def test_query_server():
+    """server coalesces concurrent client requests into one batch"""
+    print test_query_server.__doc__
+
+    import os, tempfile, threading, shutil
+    import wssa_server, wssa_client
+    nsam = 400
+    ra, dec = random_lonlat(nsam, deg=True)
+    outpath = tempfile.mkdtemp()
+    address = os.path.join(outpath, 'wssa.sock')
+    server = wssa_server.make_server(address, window=0.5)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        vals = {}
+        def query(k):
+            vals[k] = wssa_client.wssa_getval(ra[k::4], dec[k::4],
+                                              address=address)
+        clients = [threading.Thread(target=query, args=(k,))
+                   for k in range(4)]
+        for client in clients: client.start()
+        for client in clients: client.join()
+        assert server.coalescer.nbatch == 1
+        for k in range(4):
+            tru = wssa_utils.wssa_getval(ra[k::4], dec[k::4])
+            assert np.all(vals[k] == tru)
+    finally:
+        wssa_server.close_server(server)
+        shutil.rmtree(outpath)
+
+def test_mask_query():
+    """mask bits by name, and OR pyramid neighbourhood search"""
+    print test_mask_query.__doc__
+
+    import mask_query
+    nsam = 1000
+    ra, dec = random_lonlat(nsam, deg=True)
+    bits = ['moon', 'ecliptic', 'big_object']
+    amsk = wssa_utils.wssa_getval(ra, dec, exten='amsk')
+    mask = (1 << 15) | (1 << 22) | (1 << 17)
+    assert mask_query.bit_mask(bits) == mask
+    flags = mask_query.mask_getval(ra, dec, bits=bits)
+    assert np.all(flags == ((amsk & mask) != 0))
+    split = mask_query.unpack_bits(amsk, bits)
+    assert np.all(split['moon'] == ((amsk & (1 << 15)) != 0))
+
+    # pyramid search against a brute force search of a random mask
+    image = np.zeros((200, 300), dtype='int32')
+    ind = np.random.randint(0, image.size, 100)
+    image.flat[ind] = 1 << np.random.randint(0, 23, 100)
+    pyr = mask_query.MaskPyramid(image)
+    jj, ii = np.mgrid[0:200, 0:300]
+    x = np.random.uniform(-10, 310, 200)
+    y = np.random.uniform(-10, 210, 200)
+    for radius in [0.8, 3.5, 12.]:
+        hit = pyr.any_within(x, y, radius, mask)
+        for k in range(len(x)):
+            near = ((ii - x[k])**2 + (jj - y[k])**2) <= radius**2
+            assert hit[k] == np.any(image[near] & mask)
+
+    # pyramids are cached at their final size, whatever levels are used
+    from tile_cache import TileCache
+    cache = TileCache(maxbytes=pyr.nbytes)
+    pyr = cache.get('a', lambda: mask_query.MaskPyramid(image))
+    nbytes = cache.nbytes
+    pyr.any_within(x, y, 1000., mask)
+    assert cache.nbytes == nbytes == pyr.nbytes
+    cache.get('b', lambda: mask_query.MaskPyramid(image))
+    assert (len(cache) == 1) and (cache.nbytes == nbytes)
+
+    # a neighbourhood of any radius contains the pixel of its center
+    mask_query.pyramid_cache.clear()
+    near = mask_query.mask_within(ra, dec, 10., bits=bits)
+    assert np.all(near[flags])
+    assert mask_query.pyramid_cache.nbytes > 0
+    mask_query.pyramid_cache.resize(0)
+    assert mask_query.pyramid_cache.nbytes == 0
+    mask_query.pyramid_cache.resize(2**30)
+
+def test_footprint():
+    """footprint planner stages the tiles a catalog needs"""
+    print test_footprint.__doc__
+
+    import os, tempfile, shutil
+    import footprint
+    nsam = 200
+    ra, dec = random_lonlat(nsam, deg=True)
+    ra = 20. + np.mod(ra, 1.)
+    dec = np.mod(dec, 1.)
+    fp = footprint.catalog_footprint(ra, dec, exten=['clean', 'amsk'])
+    tnum = wssa_utils.coord_to_tile(ra, dec)[0]
+    assert np.all(fp.tiles == np.unique(tnum))
+    assert np.sum(fp.nsamp) == nsam
+    outpath = tempfile.mkdtemp()
+    try:
+        assert len(fp.missing(outpath)) == len(fp.tiles)
+        fp.stage(outpath)
+        assert len(fp.missing(outpath)) == 0
+        vals = wssa_utils.wssa_getval(ra, dec, exten=['clean', 'amsk'],
+                                      tilepath=outpath)
+        tru = wssa_utils.wssa_getval(ra, dec, exten=['clean', 'amsk'])
+        assert np.all(vals == tru)
+
+        # extensions not staged are reported before any tile is read
+        sub = os.path.join(outpath, 'clean')
+        footprint.catalog_footprint(ra, dec, exten='clean').stage(sub)
+        try:
+            wssa_utils.wssa_getval(ra, dec, exten='amsk', tilepath=sub)
+            assert False
+        except IOError as e:
+            assert 'amsk not staged' in str(e)
+
+        os.remove(fp.files(outpath)[0])
+        try:
+            wssa_utils.wssa_getval(ra, dec, tilepath=outpath)
+            assert False
+        except IOError as e:
+            assert os.path.basename(fp.files(outpath)[0]) in str(e)
+    finally:
+        shutil.rmtree(outpath)
+
+def test_readahead():
+    """read-ahead pipeline gives the same values as serial sampling"""
+    print test_readahead.__doc__
+
+    nsam = 100
+    ra, dec = random_lonlat(nsam, deg=True)
+    tru = wssa_utils.wssa_getval(ra, dec, exten=['clean', 'amsk'])
+    for depth in [1, 3]:
+        vals = wssa_utils.wssa_getval(ra, dec, exten=['clean', 'amsk'],
+                                      readahead=depth)
+        assert np.all(vals == tru)
+    vals = wssa_utils.wssa_getval(ra, dec, exten=['clean', 'amsk'],
+                                  readahead=2, max_read_bytes=10**6)
+    assert np.all(vals == wssa_utils.wssa_getval(ra, dec,
+                                                 exten=['clean', 'amsk'],
+                                                 max_read_bytes=10**6))
+
+def test_shards():
+    """tile shards run separately merge to the values of wssa_getval"""
+    print test_shards.__doc__
+
+    import tempfile, shutil
+    import wssa_shard
+    nsam = 300
+    ra, dec = random_lonlat(nsam, deg=True)
+    outpath = tempfile.mkdtemp()
+    try:
+        vals = wssa_shard.run_local(ra, dec, outpath, 3, workers=2,
+                                    exten=['clean', 'amsk'])
+        tru = wssa_utils.wssa_getval(ra, dec, exten=['clean', 'amsk'])
+        assert np.all(vals == tru)
+        manifest = wssa_shard.load_manifest(outpath)
+        tiles = sum([shard['tiles'] for shard in manifest['shards']], [])
+        assert len(tiles) == len(set(tiles))
+        assert sum([shard['nrow'] for shard in manifest['shards']]) == nsam
+    finally:
+        shutil.rmtree(outpath)
+
 if __name__ == '__main__':
     """run the above tests"""
     test_single_pair()
@@ -185,4 +806,32 @@ if __name__ == '__main__':
     test_2d_many()
     test_tilepath()
     test_bad_lat()
+    test_tile_cache()
+    test_mmap()
+    test_workers()
+    test_multi_exten()
+    test_getval_iter()
+    test_sampling_plan()
+    test_table_cache()
+    test_coord_to_tile_fused()
+    test_ang2pix_blocked()
+    test_compressed_tiles()
+    test_sparse_reads()
+    test_gnom_inverse()
+    test_reproject()
+    test_tile_to_coord()
+    test_cutouts()
+    test_group_stats()
+    test_region_stats()
+    test_synth_tiles()
+    test_tile_stats()
+    test_tile_store()
+    test_approx()
+    test_batch_sampler()
+    test_csv_coords()
+    test_query_server()
+    test_mask_query()
+    test_footprint()
+    test_readahead()
+    test_shards()
     print 'successfully completed testing'
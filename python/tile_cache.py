@@ -0,0 +1,117 @@
+"""In-memory LRU cache of decoded WSSA tile extensions."""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+class TileCache(object):
+    """
+    Least recently used cache of decoded WSSA tile extension images.
+
+    Keyword inputs:
+        maxbytes - memory budget in bytes, default 4 GB, sixteen decoded
+                   8k x 8k extensions; entries are evicted in least
+                   recently used order once the cached images exceed this
+                   budget
+
+    Comments:
+        Entries are keyed on (tnum, exten, large, suffix, tpath), see the
+        tile_key method. For an uncompressed tile, the entry is a memory
+        map of the extension, see wssa_utils.read_tile_section, so that a
+        miss costs no read and later sections only touch the pages they
+        need; memory maps are not counted against the budget, their pages
+        belong to the operating system's page cache. For a gzipped or
+        tile-compressed tile, the entry is the full decoded extension, so
+        a miss decodes the whole 256 MB image of an 8k tile: the cache
+        then only pays off for tile-local workloads, that return to a tile
+        before it is evicted. Images larger than the budget are never
+        cached. Access is serialized with a lock, so that a single cache
+        can be shared between threads.
+    """
+
+    def __init__(self, maxbytes=2**32):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._images = OrderedDict()
+        # bytes of each entry when it was cached, subtracted on eviction
+        self._nbytes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tile_key(tnum, exten, large, suffix, tpath):
+        """Return cache key of one tile extension, suffix as in '.gz'."""
+        return (int(tnum), int(exten), bool(large), suffix, tpath)
+
+    @staticmethod
+    def image_bytes(image):
+        """Bytes of image counted against the budget, 0 for memory maps."""
+        if isinstance(image, np.memmap): return 0
+        return image.nbytes
+
+    def get(self, key, loader):
+        """
+        Return image stored under key, calling loader() on a cache miss.
+
+        Inputs:
+            key    - cache key, see tile_key
+            loader - function of no arguments returning the decoded image
+        """
+        with self._lock:
+            if key in self._images:
+                image = self._images.pop(key)
+                self._images[key] = image
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        image = loader()
+        with self._lock:
+            nbytes = self.image_bytes(image)
+            if (nbytes <= self.maxbytes) and (key not in self._images):
+                self._images[key] = image
+                self._nbytes[key] = nbytes
+                self.nbytes += nbytes
+                self._evict()
+        return image
+
+    def _evict(self):
+        """Drop least recently used images until within memory budget."""
+        while (self.nbytes > self.maxbytes) and self._images:
+            key, image = self._images.popitem(last=False)
+            self.nbytes -= self._nbytes.pop(key)
+            self.evictions += 1
+
+    def resize(self, maxbytes):
+        """Change the memory budget, evicting images as needed."""
+        with self._lock:
+            self.maxbytes = maxbytes
+            self._evict()
+
+    def clear(self):
+        """Drop all cached images and reset the counters."""
+        with self._lock:
+            self._images.clear()
+            self._nbytes.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        """Return dictionary of cache counters."""
+        with self._lock:
+            return {'hits'      : self.hits,
+                    'misses'    : self.misses,
+                    'evictions' : self.evictions,
+                    'nbytes'    : self.nbytes,
+                    'ntile'     : len(self._images),
+                    'maxbytes'  : self.maxbytes }
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, key):
+        return key in self._images
@@ -0,0 +1,82 @@
+"""Per-tile read statistics of WSSA tile sampling."""
+
+import threading
+
+# timing and size fields of the records passed to stats callbacks
+FIELDS = ['nsamp', 'nread', 'open_time', 'read_time', 'interp_time',
+          'bytes_read']
+
+class TileStats(object):
+    """
+    Accumulator of the per-tile records reported while sampling tiles.
+
+    Keyword inputs:
+        callback - function called with each record as it arrives, e.g. to
+                   forward the numbers to a metrics system
+        keep     - set (default) to keep every record in self.records,
+                   unset to keep only the running totals
+
+    Comments:
+        Pass an instance as the stats keyword of wssa_getval or
+        tile_val_interp; it is called once per tile read, with a dictionary
+        holding:
+            tnum        - tile number, [1, 430]
+            file        - tile file name
+            nsamp       - number of samples taken from the tile
+            nread       - number of section reads, summed over extensions
+            open_time   - seconds spent opening the file
+            read_time   - seconds spent reading sections, or gathering
+                          pixels from a memory map
+            interp_time - seconds spent interpolating
+            bytes_read  - bytes of decoded pixel data read
+        Any other callable taking one record can be used in its place.
+        Calls are serialized with a lock, so that an instance can be shared
+        between threads.
+    """
+
+    def __init__(self, callback=None, keep=True):
+        self.callback = callback
+        self.keep = keep
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, rec):
+        with self._lock:
+            self.ntile += 1
+            for k in FIELDS:
+                self.totals[k] += rec[k]
+            if self.keep: self.records.append(rec)
+        if self.callback is not None:
+            self.callback(rec)
+
+    def reset(self):
+        """Drop the records and zero the totals."""
+        with self._lock:
+            self.records = []
+            self.ntile = 0
+            self.totals = dict([(k, 0) for k in FIELDS])
+
+    def by_tile(self):
+        """Return dictionary of totals over the records of each tile."""
+        tiles = {}
+        for rec in self.records:
+            tot = tiles.setdefault(rec['tnum'],
+                                   dict([(k, 0) for k in FIELDS + ['ncall']]))
+            for k in FIELDS:
+                tot[k] += rec[k]
+            tot['ncall'] += 1
+        return tiles
+
+    def slowest(self, n=10, key='read_time'):
+        """Return the n records with the largest values of key."""
+        return sorted(self.records, key=lambda rec: rec[key],
+                      reverse=True)[0:n]
+
+    def summary(self):
+        """One line summary of the totals."""
+        tot = self.totals
+        return ('%d tiles, %d samples, %d reads, %.1f MB read; open %.3f s, '
+                'read %.3f s, interpolate %.3f s' %
+                (self.ntile, tot['nsamp'], tot['nread'],
+                 tot['bytes_read']/1.e6, tot['open_time'], tot['read_time'],
+                 tot['interp_time']))
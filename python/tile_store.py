@@ -0,0 +1,277 @@
+"""Tile store shared between processes, backed by memory-mapped files."""
+
+import os
+import errno
+import fcntl
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+from numpy.lib.format import open_memmap
+
+def default_root():
+    """Default store directory, in /dev/shm when it exists."""
+    base = ('/dev/shm' if os.path.isdir('/dev/shm') else
+            tempfile.gettempdir())
+    return os.path.join(base, 'wssa_tiles')
+
+class SharedTileStore(object):
+    """
+    Decoded WSSA tile extension images shared by all processes on a host.
+
+    Keyword inputs:
+        root      - directory holding the images, default /dev/shm/wssa_tiles;
+                    all processes attaching to the same root share images
+        maxbytes  - budget for the images in root, default 4 GB; unused
+                    images are evicted, least recently used first, once
+                    this is exceeded
+        readonly  - set in workers that should only attach to images
+                    published by a coordinator, see fill; images missing
+                    from the store are then read privately, as without a
+                    store
+        maxattach - number of images each process keeps attached
+
+    Comments:
+        Each tile extension is stored as one .npy file, and get returns a
+        read-only memory map of it, so that every process sampling the tile
+        maps the same physical pages: memory use does not grow with the
+        number of processes. Keys are as for TileCache, and a store can be
+        passed wherever a TileCache is accepted, including to worker
+        processes, or configured for all calls as wssa_utils.tile_store,
+        e.g. by setting the WISE_TILE_STORE environment variable to root.
+
+        Each process holds a shared flock on the images it has attached,
+        released on detach or exit, so these locks count the references to
+        every image. Eviction only removes images that no process holds.
+        Images are published by writing to a temporary file that is then
+        renamed into place, so that readers never see partial images.
+    """
+
+    # may be passed to worker processes, unlike TileCache
+    shared = True
+
+    def __init__(self, root=None, maxbytes=4*2**30, readonly=False,
+                 maxattach=16):
+        self.root = (default_root() if root is None else root)
+        self.maxbytes = maxbytes
+        self.readonly = readonly
+        self.maxattach = maxattach
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._attached = OrderedDict()
+        self._lock = threading.Lock()
+        if not readonly:
+            try:
+                os.makedirs(self.root)
+            except OSError as e:
+                if e.errno != errno.EEXIST: raise
+
+    def __getstate__(self):
+        return {'root' : self.root, 'maxbytes' : self.maxbytes,
+                'readonly' : self.readonly, 'maxattach' : self.maxattach}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __del__(self):
+        # release the references held by a store going out of scope
+        for image, fd in getattr(self, '_attached', {}).values():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def filename(self, key):
+        """Name of the file storing the image with key, see tile_key."""
+        tnum, exten, large, suffix, tpath = key
+        tag = hashlib.md5(str(tpath).encode('utf-8')).hexdigest()[0:8]
+        return os.path.join(self.root, 'wssa_%03d_%d_%s%s_%s.npy' %
+                            (tnum, exten, ('8k' if large else '3k'),
+                             suffix.replace('.', '_'), tag))
+
+    def _attach(self, key):
+        """Map the stored image of key and pin it, None if not stored."""
+        fname = self.filename(key)
+        try:
+            fd = os.open(fname, os.O_RDONLY)
+        except OSError as e:
+            if e.errno == errno.ENOENT: return None
+            raise
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        try:
+            image = np.load(fname, mmap_mode='r')
+        except (IOError, OSError):
+            # evicted between the open and the lock
+            os.close(fd)
+            return None
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+        self._attached[key] = (image, fd)
+        while len(self._attached) > self.maxattach:
+            self._detach(next(iter(self._attached)))
+        return image
+
+    def _detach(self, key):
+        """Drop the local map of key, releasing its reference."""
+        image, fd = self._attached.pop(key)
+        os.close(fd)
+
+    def get(self, key, loader):
+        """
+        Return image stored under key, calling loader() if it is missing.
+
+        Inputs:
+            key    - cache key, see TileCache.tile_key
+            loader - function of no arguments returning the decoded image
+
+        Comments:
+            A missing image is published to the store for other processes,
+            unless the store is read-only or the image exceeds maxbytes.
+        """
+
+        with self._lock:
+            if key in self._attached:
+                image = self._attached.pop(key)
+                self._attached[key] = image
+                self.hits += 1
+                return image[0]
+            image = self._attach(key)
+            if image is not None:
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        image = loader()
+        if self.readonly or (image.nbytes > self.maxbytes):
+            return image
+        self.put(key, image)
+        with self._lock:
+            shared = self._attach(key)
+        return (image if shared is None else shared)
+
+    def put(self, key, image):
+        """Publish image under key, evicting unused images as needed."""
+        fname = self.filename(key)
+        tmp = fname + '.tmp.' + str(os.getpid())
+        self.evict(self.maxbytes - image.nbytes)
+        out = open_memmap(tmp, mode='w+', dtype=image.dtype,
+                          shape=image.shape)
+        out[...] = image
+        out.flush()
+        del out
+        os.rename(tmp, fname)
+
+    def entries(self):
+        """Return list of (file name, bytes, last use time) of images."""
+        entries = []
+        for f in os.listdir(self.root):
+            if not f.endswith('.npy'): continue
+            fname = os.path.join(self.root, f)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((fname, st.st_size, st.st_mtime))
+        return entries
+
+    def evict(self, maxbytes=None):
+        """
+        Remove unused images, least recently used first, until the store
+        holds at most maxbytes, default the store's budget.
+
+        Outputs:
+            nbytes - bytes held by the store afterwards
+        """
+
+        if maxbytes is None: maxbytes = self.maxbytes
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        nbytes = sum([e[1] for e in entries])
+        for fname, size, mtime in entries:
+            if nbytes <= maxbytes: break
+            try:
+                fd = os.open(fname, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # attached by some process
+                os.close(fd)
+                continue
+            os.remove(fname)
+            os.close(fd)
+            nbytes -= size
+            self.evictions += 1
+        return nbytes
+
+    def fill(self, tiles, exten=0, tilepath=None, release='1.0', large=True,
+             gz=False, fz=False):
+        """
+        Publish full extension images of tiles, as a coordinator would.
+
+        Inputs:
+            tiles - list of tile numbers, [1, 430]
+
+        Keyword inputs:
+            exten - extension, or list of extensions, as for wssa_getval
+            All other keywords are as for wssa_getval.
+
+        Outputs:
+            nbytes - bytes held by the store afterwards
+        """
+
+        import wssa_utils
+        from tile_cache import TileCache
+        par = wssa_utils.tile_par_struc(large=large, release=release)
+        extens = wssa_utils.exten_list(exten, par)[0]
+        if tilepath is None: tilepath = par['tpath']
+        suffix = ('.fz' if fz else ('.gz' if gz else ''))
+        fname = wssa_utils.com_tiles['FNAME']
+        for tnum in tiles:
+            f = os.path.join(tilepath, fname[tnum-1]) + suffix
+            for e in extens:
+                key = TileCache.tile_key(tnum, e, large, suffix, tilepath)
+                if os.path.exists(self.filename(key)): continue
+                wssa_utils.log.info('Storing: %s extension %d', f, e)
+                self.put(key, wssa_utils.read_tile_image(f, e + int(fz)))
+        return sum([e[1] for e in self.entries()])
+
+    def resize(self, maxbytes):
+        """Change the memory budget, evicting images as needed."""
+        self.maxbytes = maxbytes
+        self.evict()
+
+    def detach(self):
+        """Drop this process's maps of the stored images."""
+        with self._lock:
+            for key in list(self._attached.keys()):
+                self._detach(key)
+
+    def clear(self):
+        """Detach, remove all unused images and reset the counters."""
+        self.detach()
+        self.evict(0)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        """Return dictionary of store counters."""
+        entries = self.entries()
+        return {'hits'      : self.hits,
+                'misses'    : self.misses,
+                'evictions' : self.evictions,
+                'nbytes'    : sum([e[1] for e in entries]),
+                'ntile'     : len(entries),
+                'attached'  : len(self._attached),
+                'maxbytes'  : self.maxbytes }
+
+    def __len__(self):
+        return len(self.entries())
+
+    def __contains__(self, key):
+        return os.path.exists(self.filename(key))
@@ -0,0 +1,135 @@
+"""Client of the local WSSA query server started by wssa_server.py."""
+
+import os
+import json
+import socket
+import struct
+import tempfile
+import numpy as np
+
+def default_address():
+    """Server address, WISE_SERVER if set, else a Unix socket in /tmp."""
+    return os.environ.get('WISE_SERVER',
+                          os.path.join(tempfile.gettempdir(),
+                                       'wssa_utils.sock'))
+
+def connect(address=None):
+    """
+    Open a connection to the server at address, a Unix socket path or
+    'host:port'.
+    """
+
+    if address is None: address = default_address()
+    if (':' in address) and not address.startswith(os.sep):
+        host, port = address.rsplit(':', 1)
+        return socket.create_connection((host, int(port)))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+def recv_exact(sock, nbytes):
+    """Read exactly nbytes from sock, None if it is closed first."""
+    chunks = []
+    while nbytes > 0:
+        chunk = sock.recv(min(nbytes, 2**20))
+        if not chunk: return None
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return b''.join(chunks)
+
+def send_message(sock, header, payload=b''):
+    """Send a JSON header, prefixed by its length, then the payload."""
+    header = dict(header, nbytes=len(payload))
+    hdr = json.dumps(header).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(hdr)) + hdr)
+    if len(payload): sock.sendall(payload)
+
+def recv_message(sock):
+    """Receive (header, payload) sent by send_message, None on close."""
+    size = recv_exact(sock, 4)
+    if size is None: return None
+    header = json.loads(recv_exact(sock, struct.unpack('>I', size)[0])
+                        .decode('utf-8'))
+    payload = (recv_exact(sock, header['nbytes']) if header['nbytes'] else
+               b'')
+    return header, payload
+
+def encode_array(arr):
+    """Header fields and payload bytes of a plain or structured array."""
+    arr = np.ascontiguousarray(arr)
+    if arr.dtype.names is None:
+        dtype = arr.dtype.str
+    else:
+        dtype = [[name, arr.dtype[name].str] for name in arr.dtype.names]
+    return {'dtype' : dtype, 'shape' : list(arr.shape)}, arr.tobytes()
+
+def decode_array(header, payload):
+    """Array from the header fields and payload of encode_array."""
+    dtype = header['dtype']
+    if isinstance(dtype, list):
+        dtype = [(str(name), str(fmt)) for name, fmt in dtype]
+    return np.frombuffer(payload, dtype=dtype).reshape(header['shape'])
+
+def wssa_getval(ra, dec, exten=0, tilepath=None, release='1.0', large=True,
+                mjysr=False, gz=False, cache=None, mmap=False, workers=None,
+                backend='thread', fz=False, max_read_bytes=None, stats=None,
+                approx=False, readahead=None, address=None):
+    """
+    Sample values from WSSA tiles through the local query server.
+
+    Inputs:
+        ra  - array of RA coordinates, assumed degrees J2000
+        dec - array of DEC coordinates, assumed degrees J2000
+
+    Keyword inputs:
+        address - server address, default WISE_SERVER or the default
+                  Unix socket of wssa_server.py
+        All other keywords are as for wssa_utils.wssa_getval; cache, mmap,
+        workers, backend and stats are set on the server, and are ignored.
+
+    Outputs:
+        vals - values at (ra, dec), as returned by wssa_utils.wssa_getval
+
+    Comments:
+        Takes the place of wssa_utils.wssa_getval, e.g.
+            from wssa_client import wssa_getval
+        The server keeps the lookup tables in memory, and samples
+        concurrent requests from all clients together; values are exactly
+        those of a separate wssa_getval call.
+    """
+
+    try:
+        ra, dec = np.atleast_1d(ra, dec)
+    except:
+        return -1
+    if (ra.shape != dec.shape) or (np.max(np.abs(dec)) > 90): return -1
+
+    sh = ra.shape
+    coords = np.empty((2, ra.size), dtype='<f8')
+    coords[0] = ra.ravel()
+    coords[1] = dec.ravel()
+    if isinstance(exten, (tuple, np.ndarray)): exten = list(exten)
+    if isinstance(exten, list):
+        exten = [(int(e) if isinstance(e, (int, np.integer)) else e)
+                 for e in exten]
+    elif isinstance(exten, np.integer):
+        exten = int(exten)
+    opts = {'exten' : exten, 'tilepath' : tilepath, 'release' : release,
+            'large' : bool(large), 'mjysr' : bool(mjysr), 'gz' : bool(gz),
+            'fz' : bool(fz), 'max_read_bytes' : max_read_bytes,
+            'approx' : approx, 'readahead' : readahead}
+
+    sock = connect(address)
+    try:
+        send_message(sock, {'opts' : opts, 'n' : ra.size}, coords.tobytes())
+        msg = recv_message(sock)
+    finally:
+        sock.close()
+    if msg is None:
+        raise IOError('connection to the WSSA server closed')
+    header, payload = msg
+    if 'error' in header:
+        exc = {'ValueError' : ValueError, 'IOError' : IOError,
+               'OSError' : IOError}.get(header['type'], RuntimeError)
+        raise exc('WSSA server: ' + header['error'])
+    return decode_array(header, payload).reshape(sh)
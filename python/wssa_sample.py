@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""
+Sample WSSA tiles at the coordinates of a catalog file, appending the
+sampled values to the catalog as new columns.
+
+    python wssa_sample.py cat.fits out.fits --exten clean amsk --sort
+    python wssa_sample.py cat.csv out.csv --ra RA --dec DEC --workers 4
+
+"""
+
+import os
+import sys
+import csv
+import time
+import numpy as np
+from numpy.lib.format import open_memmap
+import wssa_utils
+from wssa_utils import tile_par_struc
+
+def catalog_format(fname):
+    """Catalog format, 'fits', 'csv' or 'npy', from file name extension."""
+    lower = fname.lower()
+    if lower.endswith('.npy'): return 'npy'
+    if lower.endswith(('.csv', '.txt')): return 'csv'
+    if lower.endswith(('.fits', '.fit', '.fts')): return 'fits'
+    raise ValueError('unrecognized catalog format: ' + fname)
+
+def csv_column(header, col):
+    """Index of column col, a name or integer, in CSV header row."""
+    if col in header: return header.index(col)
+    try:
+        return int(col)
+    except ValueError:
+        raise ValueError('no column ' + str(col) + ' in ' + ', '.join(header))
+
+def read_coords(fname, racol='ra', deccol='dec', fmt=None, ext=1,
+                spill=None, chunksize=1000000):
+    """
+    Return the RA and DEC columns of a catalog, without reading the rest.
+
+    Inputs:
+        fname - catalog file name, FITS table, CSV with header row, or .npy
+                structured array
+
+    Keyword inputs:
+        racol  - name of the RA column, degrees J2000
+        deccol - name of the DEC column, degrees J2000
+        fmt    - catalog format, default from the file name, see
+                 catalog_format
+        ext    - HDU of a FITS catalog, default 1
+        spill  - .npy file receiving the coordinates of a CSV catalog,
+                 which is parsed chunksize rows at a time, default to
+                 hold them in memory
+
+    Outputs:
+        ra, dec - coordinate arrays, memory-mapped from the catalog itself
+                  for FITS and .npy catalogs, from spill, if given, for
+                  CSV catalogs
+    """
+
+    if fmt is None: fmt = catalog_format(fname)
+    if fmt == 'npy':
+        cat = np.load(fname, mmap_mode='r')
+        return cat[racol], cat[deccol]
+    if fmt == 'fits':
+        import pyfits
+        data = pyfits.open(fname, memmap=True)[ext].data
+        return data[racol], data[deccol]
+
+    fp = open(fname)
+    reader = csv.reader(fp)
+    header = next(reader)
+    ira, idec = csv_column(header, racol), csv_column(header, deccol)
+    nrow = sum(1 for row in reader)
+    dtype = [('ra', 'f8'), ('dec', 'f8')]
+    if spill is None:
+        coords = np.zeros(nrow, dtype=dtype)
+    else:
+        coords = open_memmap(spill, mode='w+', dtype=dtype, shape=(nrow,))
+    fp.seek(0)
+    reader = csv.reader(fp)
+    next(reader)
+    buf = []
+    i = 0
+    for row in reader:
+        buf.append((float(row[ira] or 'nan'), float(row[idec] or 'nan')))
+        if len(buf) == chunksize:
+            coords[i:i+len(buf)] = buf
+            i += len(buf)
+            buf = []
+    coords[i:i+len(buf)] = buf
+    fp.close()
+    if spill is not None: coords.flush()
+    return coords['ra'], coords['dec']
+
+class CatalogCoords(object):
+    """Catalog coordinates, indexed as an output grid of reproject."""
+
+    def __init__(self, ra, dec):
+        self.ra = ra
+        self.dec = dec
+        self.shape = (len(ra),)
+
+    def coords(self, ind):
+        """
+        Return RA, DEC in degrees of the catalog rows ind, with invalid
+        coordinates replaced by (0, 0), see sample_catalog.
+        """
+        ra = np.array(self.ra[ind], dtype='float64')
+        dec = np.array(self.dec[ind], dtype='float64')
+        bad = ~(np.isfinite(ra) & np.isfinite(dec) & (np.abs(dec) <= 90))
+        ra[bad] = 0.
+        dec[bad] = 0.
+        return ra, dec
+
+class Progress(object):
+    """Rows done and throughput, reported on one stderr line."""
+
+    def __init__(self, nrow, quiet=False):
+        self.nrow = nrow
+        self.done = 0
+        self.quiet = quiet
+        self.t0 = time.time()
+
+    def update(self, n):
+        self.done += n
+        if self.quiet: return
+        dt = time.time() - self.t0
+        sys.stderr.write('\r%d/%d rows, %.1f%%, %.0f rows/s' %
+                         (self.done, self.nrow,
+                          100.*self.done/max(self.nrow, 1),
+                          self.done/max(dt, 1e-9)))
+        if self.done >= self.nrow: sys.stderr.write('\n')
+        sys.stderr.flush()
+
+def sample_catalog(ra, dec, outfile, exten=0, sort=False, chunksize=1000000,
+                   quiet=False, **kwargs):
+    """
+    Sample WSSA tiles at catalog coordinates, with bounded memory.
+
+    Inputs:
+        ra      - array of RA coordinates, degrees J2000, may be a memory map
+        dec     - array of DEC coordinates, degrees J2000
+        outfile - .npy file receiving the structured array of sampled values
+
+    Keyword inputs:
+        exten     - extension, or list of extensions, as for wssa_getval
+        sort      - set to sort the catalog rows by tile, over the whole
+                    catalog, so that each tile is read once
+        chunksize - number of rows sampled at a time
+        quiet     - set to suppress progress reports
+        All other keywords are passed to wssa_utils.wssa_getval.
+
+    Outputs:
+        vals - memory map of outfile, one field per extension
+
+    Comments:
+        Rows with non-finite coordinates, or |DEC| > 90, are given NaN for
+        intensity extensions and -1 for bit-masks. Without sort, each
+        chunk is sampled in catalog order, so that a tile is read once per
+        chunk touching it. With sort, the rows are first grouped by tile,
+        see reproject.build_tile_index, and chunks are then cut at tile
+        boundaries wherever possible.
+    """
+
+    large = kwargs.get('large', True)
+    par = tile_par_struc(large=large, release=kwargs.get('release', '1.0'))
+    extens, names = wssa_utils.exten_list(exten, par)
+    ismsk = [(par['ismsk'])[e] for e in extens]
+    nrow = len(ra)
+    vals = open_memmap(outfile, mode='w+', shape=(nrow,),
+                       dtype=[(name, (par['dtype'])[msk])
+                              for name, msk in zip(names, ismsk)])
+    for name, msk in zip(names, ismsk):
+        vals[name] = (-1 if msk else np.nan)
+
+    if sort:
+        from reproject import build_tile_index
+        index, bdy = build_tile_index(CatalogCoords(ra, dec), outfile,
+                                      chunksize=chunksize)
+        cuts = [0]
+        while cuts[-1] < nrow:
+            # largest tile boundary within chunksize rows, else chunksize
+            k = np.searchsorted(bdy, cuts[-1] + chunksize, side='right') - 1
+            cuts.append(int(bdy[k]) if bdy[k] > cuts[-1] else
+                        min(cuts[-1] + chunksize, nrow))
+        chunks = ((np.asarray(index[lo:hi]), lo, hi)
+                  for lo, hi in zip(cuts[:-1], cuts[1:]))
+    else:
+        chunks = ((slice(lo, min(lo+chunksize, nrow)), lo,
+                   min(lo+chunksize, nrow)) for lo in range(0, nrow, chunksize))
+
+    progress = Progress(nrow, quiet=quiet)
+    for ind, lo, hi in chunks:
+        r = np.asarray(ra[ind], dtype='float64')
+        d = np.asarray(dec[ind], dtype='float64')
+        good = np.isfinite(r) & np.isfinite(d) & (np.abs(d) <= 90)
+        if np.any(good):
+            if not isinstance(ind, slice): ind = ind[good]
+            else: ind = np.arange(lo, hi)[good]
+            vals[ind] = wssa_utils.wssa_getval(r[good], d[good],
+                                               exten=list(extens), **kwargs)
+        progress.update(hi - lo)
+
+    vals.flush()
+    if sort:
+        from reproject import sidecar_names
+        index = None
+        for k in ['index', 'bdy']:
+            os.remove(sidecar_names(outfile)[k])
+    return vals
+
+def append_columns(fname, outfile, vals, prefix='wssa_', fmt=None, ext=1,
+                   chunksize=1000000):
+    """
+    Write catalog fname to outfile, with the fields of vals appended as new
+    columns named prefix + field name.
+
+    Keyword inputs:
+        fmt - catalog format, see catalog_format
+        ext - HDU of a FITS catalog, the output holds only this table
+
+    Comments:
+        Rows are copied chunksize at a time. A FITS table is written row
+        by row from its raw bytes, so it must be uncompressed and must not
+        use variable length array columns.
+    """
+
+    if fmt is None: fmt = catalog_format(fname)
+    names = [prefix + name for name in vals.dtype.names]
+    nrow = len(vals)
+
+    if fmt == 'npy':
+        cat = np.load(fname, mmap_mode='r')
+        for name in names:
+            if name in cat.dtype.names:
+                raise ValueError('column ' + name + ' already in ' + fname)
+        dtype = cat.dtype.descr + [(prefix + name, vals.dtype[name].str)
+                                   for name in vals.dtype.names]
+        out = open_memmap(outfile, mode='w+', dtype=dtype, shape=(nrow,))
+        for lo in range(0, nrow, chunksize):
+            block = out[lo:lo+chunksize]
+            for name in cat.dtype.names:
+                block[name] = cat[name][lo:lo+chunksize]
+            for name in vals.dtype.names:
+                block[prefix + name] = vals[name][lo:lo+chunksize]
+        out.flush()
+        return
+
+    if fmt == 'csv':
+        fpin = open(fname)
+        fpout = open(outfile, 'w')
+        reader = csv.reader(fpin)
+        writer = csv.writer(fpout, lineterminator='\n')
+        writer.writerow(next(reader) + names)
+        fmts = [('%d' if vals.dtype[name].kind == 'i' else '%.9g')
+                for name in vals.dtype.names]
+        for lo in range(0, nrow, chunksize):
+            block = vals[lo:lo+chunksize]
+            for i in range(len(block)):
+                row = next(reader)
+                writer.writerow(row + [f % v for f, v in zip(fmts, block[i])])
+        fpin.close()
+        fpout.close()
+        return
+
+    import pyfits
+    hdus = pyfits.open(fname, memmap=True)
+    header = hdus[ext].header.copy()
+    if header.get('PCOUNT', 0) != 0:
+        raise ValueError('variable length array columns are not supported')
+    ncol = header['TFIELDS']
+    for name in names:
+        if name.lower() in [n.lower() for n in hdus[ext].columns.names]:
+            raise ValueError('column ' + name + ' already in ' + fname)
+    tforms = {'f' : 'E', 'i' : 'J'}
+    for i, name in enumerate(vals.dtype.names):
+        header['TTYPE' + str(ncol+i+1)] = prefix + name
+        header['TFORM' + str(ncol+i+1)] = tforms[vals.dtype[name].kind]
+    header['TFIELDS'] = ncol + len(names)
+    rowbytes = header['NAXIS1']
+    header['NAXIS1'] = rowbytes + 4*len(names)
+    hdus.close()
+
+    offset, shape = wssa_utils.fits_image_layout(fname)[ext][0:2]
+    raw = np.memmap(fname, dtype='u1', mode='r', offset=offset, shape=shape)
+    outtype = np.dtype([('raw', 'u1', rowbytes)] +
+                       [(name, '>' + vals.dtype[name].str[1:])
+                        for name in vals.dtype.names])
+    fp = open(outfile, 'wb')
+    fp.write(pyfits.PrimaryHDU().header.tostring().encode('ascii'))
+    fp.write(header.tostring().encode('ascii'))
+    for lo in range(0, nrow, chunksize):
+        block = np.zeros(min(chunksize, nrow-lo), dtype=outtype)
+        block['raw'] = raw[lo:lo+chunksize]
+        for name in vals.dtype.names:
+            block[name] = vals[name][lo:lo+chunksize]
+        fp.write(block.tobytes())
+    nbytes = nrow*outtype.itemsize
+    fp.write(b'\0'*((-nbytes) % 2880))
+    fp.close()
+
+def main(argv=None):
+    """Command line interface, see python wssa_sample.py --help."""
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().split('\n\n')[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='\n\n'.join(__doc__.strip().split('\n\n')[1:]))
+    parser.add_argument('infile', help='input catalog, .fits, .csv or .npy')
+    parser.add_argument('outfile', help='output catalog, in the same format')
+    parser.add_argument('--ra', default='ra', help='RA column, degrees')
+    parser.add_argument('--dec', default='dec', help='DEC column, degrees')
+    parser.add_argument('--hdu', type=int, default=1,
+                        help='HDU of a FITS catalog, default 1')
+    parser.add_argument('--exten', nargs='+', default=['clean'],
+                        help='tile extensions to sample, default clean')
+    parser.add_argument('--prefix', default='wssa_',
+                        help='prefix of the new column names')
+    parser.add_argument('--tilepath', default=None,
+                        help='tile directory, default WISE_TILE')
+    parser.add_argument('--small', action='store_true',
+                        help='sample 3k x 3k tiles rather than 8k x 8k')
+    parser.add_argument('--mjysr', action='store_true',
+                        help='convert intensities to MJy/sr')
+    parser.add_argument('--gz', action='store_true',
+                        help='read gzipped tiles')
+    parser.add_argument('--fz', action='store_true',
+                        help='read tile-compressed tiles')
+    parser.add_argument('--approx', action='store_true',
+                        help='look up precomputed HEALPix maps, see '
+                        'healpix_map.py')
+    parser.add_argument('--sort', action='store_true',
+                        help='sort rows by tile over the whole catalog')
+    parser.add_argument('--chunksize', type=int, default=1000000,
+                        help='rows sampled at a time, default 1000000')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of tiles sampled concurrently')
+    parser.add_argument('--backend', default='thread',
+                        choices=['thread', 'process'],
+                        help='worker pool, default thread')
+    parser.add_argument('--max-read-bytes', type=int, default=None,
+                        help='cap on the size of a single tile read')
+    parser.add_argument('--readahead', type=int, default=None,
+                        help='number of tiles read ahead of interpolation')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not report progress')
+    opts = parser.parse_args(argv)
+
+    fmt = catalog_format(opts.infile)
+    if catalog_format(opts.outfile) != fmt:
+        parser.error('output format must match input format')
+    exten = [(int(e) if e.isdigit() else e) for e in opts.exten]
+    tmp = opts.outfile + '.wssa.npy'
+    spill = opts.outfile + '.coords.npy'
+    try:
+        ra, dec = read_coords(opts.infile, racol=opts.ra, deccol=opts.dec,
+                              fmt=fmt, ext=opts.hdu, spill=spill,
+                              chunksize=opts.chunksize)
+        vals = sample_catalog(ra, dec, tmp, exten=exten, sort=opts.sort,
+                              chunksize=opts.chunksize, quiet=opts.quiet,
+                              tilepath=opts.tilepath, large=not opts.small,
+                              mjysr=opts.mjysr, gz=opts.gz, fz=opts.fz,
+                              approx=opts.approx, workers=opts.workers,
+                              backend=opts.backend,
+                              max_read_bytes=opts.max_read_bytes,
+                              readahead=opts.readahead)
+        append_columns(opts.infile, opts.outfile, vals, prefix=opts.prefix,
+                       fmt=fmt, ext=opts.hdu, chunksize=opts.chunksize)
+    finally:
+        for f in [tmp, spill]:
+            if os.path.exists(f): os.remove(f)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""Long-lived local WSSA query server, sampling the concurrent requests of
+all its clients together; see wssa_client.py for the client."""
+
+import os
+import json
+import time
+import socket
+import threading
+import numpy as np
+import wssa_utils
+from tile_cache import TileCache
+from wssa_client import (default_address, recv_message, send_message,
+                         encode_array)
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class Request(object):
+    """One client request, answered by the batch it was coalesced into."""
+
+    def __init__(self, opts, ra, dec):
+        self.opts = opts
+        self.key = json.dumps(opts, sort_keys=True)
+        self.ra = ra
+        self.dec = dec
+        self.vals = None
+        self.error = None
+        self.done = threading.Event()
+
+class Coalescer(object):
+    """
+    Queue of requests, sampled in batches by a background thread.
+
+    Keyword inputs:
+        window  - seconds to wait for further requests once one arrives
+        cache   - tile cache of the batches, as for wssa_getval, e.g. a
+                  TileCache kept for the life of the server; default is
+                  wssa_getval's, a fresh read of each tile section unless
+                  wssa_utils.tile_store is configured
+        workers - number of tiles of a batch sampled concurrently
+        backend - 'thread' (default) or 'process' worker pool
+
+    Comments:
+        Requests arriving within window of the first pending one are
+        grouped by their wssa_getval options, and the coordinates of each
+        group are passed to a single wssa_getval call, so that a tile
+        needed by several clients is read once. The samples of each
+        request are labelled, see wssa_utils.label_refs, so that every
+        client gets exactly the values of its own wssa_getval call.
+    """
+
+    def __init__(self, window=0.005, cache=None, workers=None,
+                 backend='thread'):
+        self.window = window
+        self.cache = cache
+        self.workers = workers
+        self.backend = backend
+        self.nrequest = 0
+        self.nbatch = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, opts, ra, dec):
+        """Sample ra, dec with wssa_getval options opts, waiting for it."""
+        req = Request(opts, ra, dec)
+        self._queue.put(req)
+        req.done.wait()
+        if req.error is not None: raise req.error
+        return req.vals
+
+    def stop(self):
+        """Stop the background thread once the pending requests are done."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            req = self._queue.get()
+            if req is None: return
+            pending = [req]
+            t_end = time.time() + self.window
+            while True:
+                wait = t_end - time.time()
+                try:
+                    req = (self._queue.get(timeout=wait) if wait > 0 else
+                           self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                if req is None:
+                    self._queue.put(None)
+                    break
+                pending.append(req)
+
+            batches = {}
+            for req in pending:
+                batches.setdefault(req.key, []).append(req)
+            for reqs in batches.values():
+                self.sample(reqs)
+
+    def sample(self, reqs):
+        """Answer requests reqs, which share their options, with one call."""
+        self.nrequest += len(reqs)
+        self.nbatch += 1
+        wssa_utils.log.debug('Coalesced %d requests, %d points', len(reqs),
+                             sum([len(req.ra) for req in reqs]))
+        ra = np.concatenate([req.ra for req in reqs])
+        dec = np.concatenate([req.dec for req in reqs])
+        labels = np.repeat(np.arange(len(reqs)),
+                           [len(req.ra) for req in reqs])
+        try:
+            vals = wssa_utils.wssa_getval(ra, dec, cache=self.cache,
+                                          workers=self.workers,
+                                          backend=self.backend,
+                                          labels=labels, **reqs[0].opts)
+            if not isinstance(vals, np.ndarray):
+                raise ValueError('invalid coordinates')
+            i = 0
+            for req in reqs:
+                req.vals = vals[i:i+len(req.ra)]
+                i += len(req.ra)
+        except Exception as e:
+            for req in reqs:
+                req.error = e
+        for req in reqs:
+            req.done.set()
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    """Answer the requests sent over one client connection."""
+
+    def handle(self):
+        while True:
+            msg = recv_message(self.request)
+            if msg is None: return
+            header, payload = msg
+            try:
+                opts = dict([(str(k), v) for k, v in header['opts'].items()])
+                coords = np.frombuffer(payload, dtype='<f8').reshape(2, -1)
+                vals = self.server.coalescer.submit(opts, coords[0],
+                                                    coords[1])
+            except Exception as e:
+                send_message(self.request, {'error' : str(e),
+                                            'type' : type(e).__name__})
+                continue
+            header, payload = encode_array(vals)
+            send_message(self.request, header, payload)
+
+class UnixServer(socketserver.ThreadingMixIn,
+                 socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def make_server(address=None, **kwargs):
+    """
+    Create a query server, started with serve_forever().
+
+    Keyword inputs:
+        address - Unix socket path, or 'host:port' to listen on TCP, default
+                  WISE_SERVER or a Unix socket in /tmp
+        All other keywords are passed to Coalescer.
+
+    Outputs:
+        server - socketserver instance, with the Coalescer as its
+                 coalescer attribute
+
+    Comments:
+        The global tables are loaded here, and stay loaded, along with the
+        tiles held by the cache, for the life of the server. A Unix socket
+        is only accessible to its owner; a TCP server should only listen on
+        localhost, as there is no authentication.
+    """
+
+    if address is None: address = default_address()
+    wssa_utils.init_global()
+    if ':' in address and not address.startswith(os.sep):
+        host, port = address.rsplit(':', 1)
+        server = TCPServer((host, int(port)), RequestHandler)
+    else:
+        if os.path.exists(address):
+            # remove the socket of a server that has gone away
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(address)
+            except socket.error:
+                os.remove(address)
+            else:
+                raise IOError('a server is already listening on ' + address)
+            finally:
+                probe.close()
+        umask = os.umask(0o177)
+        try:
+            server = UnixServer(address, RequestHandler)
+        finally:
+            os.umask(umask)
+    server.coalescer = Coalescer(**kwargs)
+    return server
+
+def close_server(server):
+    """Stop a server returned by make_server, removing its socket file."""
+    server.shutdown()
+    server.server_close()
+    server.coalescer.stop()
+    if isinstance(server.server_address, str):
+        try:
+            os.remove(server.server_address)
+        except OSError:
+            pass
+
+if __name__ == '__main__':
+    """run the server from the command line"""
+    import argparse
+    import logging
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--address', default=None,
+                        help='Unix socket path or host:port, default ' +
+                        'WISE_SERVER or ' + default_address())
+    parser.add_argument('--window', type=float, default=0.005,
+                        help='seconds to coalesce requests, default 0.005')
+    parser.add_argument('--cache-bytes', type=int, default=None,
+                        help='keep a tile cache of this budget in bytes, ' +
+                        'default is no cache')
+    parser.add_argument('--store', action='store_true',
+                        help='cache tiles in wssa_utils.tile_store, set by ' +
+                        'WISE_TILE_STORE, rather than in the server')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of tiles sampled concurrently')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log each batch')
+    opts = parser.parse_args()
+    logging.basicConfig(level=(logging.DEBUG if opts.verbose else
+                               logging.INFO))
+    if opts.store:
+        cache = None
+    elif opts.cache_bytes is not None:
+        cache = TileCache(maxbytes=opts.cache_bytes)
+    else:
+        cache = False
+    server = make_server(opts.address, window=opts.window,
+                         workers=opts.workers, cache=cache)
+    wssa_utils.log.info('Serving on %s', server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(server.server_address, str):
+            os.remove(server.server_address)
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+"""
+Split the sampling of a large catalog into shards of whole WSSA tiles, run
+them as independent jobs, on any number of machines, then merge the
+results in catalog order.
+
+    python wssa_shard.py plan cat.fits shards --nshard 16 --exten clean amsk
+    python wssa_shard.py run shards 0          # one job per shard, 0 to 15
+    python wssa_shard.py merge shards out.fits
+    python wssa_shard.py local cat.fits out.fits shards --nshard 4
+
+"""
+
+import os
+import json
+import heapq
+import numpy as np
+from numpy.lib.format import open_memmap
+import wssa_utils
+from wssa_utils import tile_par_struc
+
+MANIFEST = 'manifest.json'
+
+def shard_names(outdir, k):
+    """Return (input, output) file names of shard k."""
+    base = os.path.join(outdir, 'shard_%04d' % k)
+    return base + '.in.npy', base + '.out.npy'
+
+def load_manifest(outdir):
+    """Return the manifest written by plan_shards to outdir."""
+    fp = open(os.path.join(outdir, MANIFEST))
+    manifest = json.load(fp)
+    fp.close()
+    return manifest
+
+def tile_costs(counts, nexten=1, large=True, sample_rate=1.e6,
+               read_rate=1.e8):
+    """
+    Estimated seconds to sample each tile.
+
+    Inputs:
+        counts - number of samples on each tile, indexed by tile number
+
+    Keyword inputs:
+        nexten      - number of extensions sampled
+        sample_rate - samples interpolated per second
+        read_rate   - bytes of tile images read per second
+
+    Comments:
+        A tile with any samples is charged for reading the full images of
+        the sampled extensions, an upper bound on its section reads.
+    """
+
+    par = tile_par_struc(large=large)
+    tile_bytes = nexten*int(par['pix'])**2*4
+    return (counts*nexten/sample_rate + (counts > 0)*tile_bytes/read_rate)
+
+def balance_tiles(cost, nshard):
+    """
+    Assign tiles to nshard shards, balancing the summed cost.
+
+    Inputs:
+        cost   - estimated cost of each tile, indexed by tile number
+        nshard - number of shards
+
+    Outputs:
+        shard - shard of each tile, indexed by tile number, -1 for tiles
+                without samples
+
+    Comments:
+        Tiles are taken in decreasing order of cost, each one given to the
+        shard with the least cost so far.
+    """
+
+    shard = np.zeros(len(cost), dtype='int64') - 1
+    loads = [(0., k) for k in range(nshard)]
+    for tnum in np.argsort(-cost, kind='mergesort'):
+        if cost[tnum] <= 0: break
+        load, k = heapq.heappop(loads)
+        shard[tnum] = k
+        heapq.heappush(loads, (load + cost[tnum], k))
+    return shard
+
+def plan_shards(ra, dec, outdir, nshard, exten=0, release='1.0', large=True,
+                mjysr=False, gz=False, fz=False, chunksize=1000000,
+                sample_rate=1.e6, read_rate=1.e8, catalog=None):
+    """
+    Partition catalog rows into shards of whole tiles, writing the inputs
+    of every shard and a manifest to outdir.
+
+    Inputs:
+        ra     - array of RA coordinates, degrees J2000, may be a memory map
+        dec    - array of DEC coordinates, degrees J2000
+        outdir - directory receiving the shard files
+        nshard - number of shards
+
+    Keyword inputs:
+        exten    - extension, or list of extensions, as for wssa_getval
+        chunksize - number of rows read at a time
+        sample_rate, read_rate - cost model, see tile_costs
+        catalog  - dictionary describing the catalog file, kept in the
+                   manifest for the merge step
+        All other keywords are as for wssa_getval, and are used by every
+        shard.
+
+    Outputs:
+        manifest - dictionary written to outdir/manifest.json
+
+    Comments:
+        Rows are assigned to tiles by the HEALPix lookup of coord_to_tile,
+        and tiles to shards by balance_tiles, so each tile is read by one
+        shard only. Each shard input is a .npy file of (row, ra, dec),
+        grouped by tile, catalog order kept within each tile. Rows with
+        non-finite coordinates, or |DEC| > 90, are left out of all shards.
+        The catalog is read twice, chunk by chunk, so memory use does not
+        grow with its size.
+    """
+
+    par = tile_par_struc(large=large, release=release)
+    extens, names = wssa_utils.exten_list(exten, par)
+    ismsk = [(par['ismsk'])[e] for e in extens]
+    nrow = len(ra)
+    ntile = par['ntile']
+
+    def chunk_tiles(lo):
+        r = np.array(ra[lo:lo+chunksize], dtype='float64')
+        d = np.array(dec[lo:lo+chunksize], dtype='float64')
+        good = np.isfinite(r) & np.isfinite(d) & (np.abs(d) <= 90)
+        tnum = np.zeros(len(r), dtype='int64')
+        tnum[good] = wssa_utils.coord_to_tnum(np.mod(r[good], 360.),
+                                              d[good])
+        return r, d, tnum
+
+    counts = np.zeros(ntile + 1, dtype='int64')
+    for lo in range(0, nrow, chunksize):
+        counts += np.bincount(chunk_tiles(lo)[2], minlength=ntile + 1)
+    counts[0] = 0
+    cost = tile_costs(counts, nexten=len(extens), large=large,
+                      sample_rate=sample_rate, read_rate=read_rate)
+    shard = balance_tiles(cost, nshard)
+
+    # row offset of each tile within its shard input
+    offset = np.zeros(ntile + 1, dtype='int64')
+    shards = []
+    for k in range(nshard):
+        tiles = np.flatnonzero(shard == k)
+        offset[tiles] = np.append(0, np.cumsum(counts[tiles]))[0:-1]
+        shards.append({'tiles' : [int(t) for t in tiles],
+                       'counts' : [int(n) for n in counts[tiles]],
+                       'nrow' : int(np.sum(counts[tiles])),
+                       'cost' : float(np.sum(cost[tiles]))})
+
+    if not os.path.isdir(outdir): os.makedirs(outdir)
+    for f in os.listdir(outdir):
+        # outputs of an earlier plan
+        if f.startswith('shard_') and f.endswith('.out.npy'):
+            os.remove(os.path.join(outdir, f))
+    inputs = [open_memmap(shard_names(outdir, k)[0], mode='w+',
+                          dtype=[('row', 'i8'), ('ra', 'f8'), ('dec', 'f8')],
+                          shape=(shards[k]['nrow'],))
+              for k in range(nshard)]
+    for lo in range(0, nrow, chunksize):
+        r, d, tnum = chunk_tiles(lo)
+        sind, tiles, bdy = wssa_utils.tile_groups(tnum)
+        for i, t in enumerate(tiles):
+            if t == 0: continue
+            ind = sind[bdy[i]:bdy[i+1]]
+            out = inputs[shard[t]][offset[t]:offset[t]+len(ind)]
+            out['row'] = lo + ind
+            out['ra'] = r[ind]
+            out['dec'] = d[ind]
+            offset[t] += len(ind)
+    for out in inputs:
+        out.flush()
+    del inputs
+
+    manifest = {'nrow' : int(nrow), 'nshard' : int(nshard),
+                'exten' : names, 'ismsk' : ismsk, 'release' : release,
+                'large' : bool(large), 'mjysr' : bool(mjysr),
+                'gz' : bool(gz), 'fz' : bool(fz),
+                'nskip' : int(nrow - np.sum(counts)), 'catalog' : catalog,
+                'shards' : shards}
+    fp = open(os.path.join(outdir, MANIFEST), 'w')
+    json.dump(manifest, fp, indent=1)
+    fp.close()
+    return manifest
+
+def run_shard(outdir, k, chunksize=1000000, **kwargs):
+    """
+    Sample the rows of shard k, writing its output file.
+
+    Inputs:
+        outdir - directory written by plan_shards
+        k      - shard number, [0, nshard)
+
+    Keyword inputs:
+        chunksize - number of rows sampled at a time
+        All other keywords, e.g. tilepath, cache, workers or readahead, are
+        passed to wssa_getval.
+
+    Outputs:
+        outfile - name of the shard output file
+
+    Comments:
+        Chunks are cut at tile boundaries wherever possible, so that the
+        values are those of a single wssa_getval call on the whole
+        catalog. A shard whose output file exists is skipped, so that
+        failed jobs can simply be rerun. The output is written under a
+        temporary name and renamed when complete.
+    """
+
+    manifest = load_manifest(outdir)
+    infile, outfile = shard_names(outdir, k)
+    if os.path.exists(outfile): return outfile
+    shard = np.load(infile, mmap_mode='r')
+    wssa_utils.log.info('Shard %d: %d rows on %d tiles', k, len(shard),
+                        len(manifest['shards'][k]['tiles']))
+    for key in ['release', 'large', 'mjysr', 'gz', 'fz']:
+        kwargs.setdefault(key, manifest[key])
+    par = tile_par_struc(large=kwargs['large'], release=kwargs['release'])
+    names = [str(name) for name in manifest['exten']]
+    tmp = outfile + '.tmp.npy'
+    vals = open_memmap(tmp, mode='w+', shape=(len(shard),),
+                       dtype=[(name, (par['dtype'])[msk]) for name, msk in
+                              zip(names, manifest['ismsk'])])
+
+    bdy = np.append(0, np.cumsum(manifest['shards'][k]['counts']))
+    lo = 0
+    while lo < len(shard):
+        # largest tile boundary within chunksize rows, else chunksize
+        j = np.searchsorted(bdy, lo + chunksize, side='right') - 1
+        hi = (int(bdy[j]) if bdy[j] > lo else
+              min(lo + chunksize, len(shard)))
+        vals[lo:hi] = wssa_utils.wssa_getval(np.asarray(shard['ra'][lo:hi]),
+                                             np.asarray(shard['dec'][lo:hi]),
+                                             exten=names, **kwargs)
+        lo = hi
+    vals.flush()
+    del vals, shard
+    os.rename(tmp, outfile)
+    return outfile
+
+def _run_shard_task(task):
+    """Run run_shard on argument tuple (outdir, k, kwargs)."""
+    outdir, k, kwargs = task
+    return run_shard(outdir, k, **kwargs)
+
+def merge_shards(outdir, outfile=None, chunksize=1000000):
+    """
+    Reassemble the shard outputs in catalog row order.
+
+    Inputs:
+        outdir - directory written by plan_shards and run_shard
+
+    Keyword inputs:
+        outfile - .npy file receiving the merged values, default is to
+                  hold them in memory
+
+    Outputs:
+        vals - structured array with one field per extension, one row per
+               catalog row; rows left out of all shards hold NaN for
+               intensity extensions and -1 for bit-masks
+
+    Comments:
+        Raises IOError naming the shards without output.
+    """
+
+    manifest = load_manifest(outdir)
+    missing = [k for k in range(manifest['nshard'])
+               if not os.path.exists(shard_names(outdir, k)[1])]
+    if len(missing) > 0:
+        raise IOError('%d of %d shards have no output in %s: %s' %
+                      (len(missing), manifest['nshard'], outdir,
+                       ', '.join([str(k) for k in missing])))
+
+    par = tile_par_struc(large=manifest['large'],
+                         release=manifest['release'])
+    dtype = [(str(name), (par['dtype'])[msk]) for name, msk in
+             zip(manifest['exten'], manifest['ismsk'])]
+    if outfile is None:
+        vals = np.zeros(manifest['nrow'], dtype=dtype)
+    else:
+        vals = open_memmap(outfile, mode='w+', dtype=dtype,
+                           shape=(manifest['nrow'],))
+    for name, msk in zip(manifest['exten'], manifest['ismsk']):
+        vals[str(name)] = (-1 if msk else np.nan)
+
+    for k in range(manifest['nshard']):
+        infile, shardfile = shard_names(outdir, k)
+        rows = np.load(infile, mmap_mode='r')
+        svals = np.load(shardfile, mmap_mode='r')
+        for lo in range(0, len(rows), chunksize):
+            vals[np.asarray(rows['row'][lo:lo+chunksize])] = \
+                svals[lo:lo+chunksize]
+    if outfile is not None: vals.flush()
+    return vals
+
+def run_shards(outdir, workers=None, **kwargs):
+    """
+    Run all shards of outdir on this machine, each in its own process.
+
+    Keyword inputs:
+        workers - number of shards run at once, default is all of them
+        All other keywords are passed to run_shard.
+    """
+
+    from multiprocessing import Pool
+    nshard = load_manifest(outdir)['nshard']
+    tasks = [(outdir, k, kwargs) for k in range(nshard)]
+    pool = Pool(min(workers or nshard, nshard))
+    try:
+        pool.map(_run_shard_task, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def run_local(ra, dec, outdir, nshard, workers=None, **kwargs):
+    """
+    Plan, run and merge all shards on this machine.
+
+    Inputs:
+        ra     - array of RA coordinates, degrees J2000
+        dec    - array of DEC coordinates, degrees J2000
+        outdir - directory receiving the shard files
+        nshard - number of shards
+
+    Keyword inputs:
+        workers - number of shards run at once, default is nshard
+        All other keywords are as for wssa_getval.
+
+    Outputs:
+        vals - merged values, see merge_shards
+    """
+
+    plan_keys = ['exten', 'release', 'large', 'mjysr', 'gz', 'fz']
+    plan_kwargs = dict([(key, kwargs.pop(key)) for key in plan_keys
+                        if key in kwargs])
+    plan_shards(ra, dec, outdir, nshard, **plan_kwargs)
+    run_shards(outdir, workers=workers, **kwargs)
+    return merge_shards(outdir)
+
+def main(argv=None):
+    """Command line interface, see python wssa_shard.py --help."""
+    import argparse
+    import logging
+    from wssa_sample import read_coords, catalog_format, append_columns
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    sub = parser.add_subparsers(dest='command')
+
+    def catalog_args(p):
+        p.add_argument('--ra', default='ra', help='RA column, default ra')
+        p.add_argument('--dec', default='dec',
+                       help='DEC column, default dec')
+        p.add_argument('--hdu', type=int, default=1,
+                       help='FITS table extension, default 1')
+        p.add_argument('--nshard', type=int, required=True,
+                       help='number of shards')
+        p.add_argument('--exten', nargs='+', default=['clean'],
+                       help='extension names, default clean')
+        p.add_argument('--small', action='store_true',
+                       help='sample 3k x 3k tiles rather than 8k x 8k')
+        p.add_argument('--mjysr', action='store_true',
+                       help='intensities in MJy/sr rather than DN')
+        p.add_argument('--gz', action='store_true', help='gzipped tiles')
+        p.add_argument('--fz', action='store_true',
+                       help='tile-compressed tiles')
+
+    def run_args(p):
+        p.add_argument('--tilepath', default=None,
+                       help='tile directory, default WISE_TILE')
+        p.add_argument('--readahead', type=int, default=None,
+                       help='number of tiles read ahead of interpolation')
+
+    p = sub.add_parser('plan', help='partition a catalog into shards')
+    p.add_argument('infile', help='FITS, CSV or .npy catalog')
+    p.add_argument('outdir', help='shard directory')
+    catalog_args(p)
+    p = sub.add_parser('run', help='sample one shard')
+    p.add_argument('outdir', help='shard directory')
+    p.add_argument('shard', type=int, help='shard number')
+    run_args(p)
+    p = sub.add_parser('merge', help='merge the shard outputs')
+    p.add_argument('outdir', help='shard directory')
+    p.add_argument('outfile', help='catalog with appended columns, or .npy')
+    p.add_argument('--prefix', default='wssa_',
+                   help='prefix of the new column names, default wssa_')
+    p = sub.add_parser('local', help='plan, run and merge on this machine')
+    p.add_argument('infile', help='FITS, CSV or .npy catalog')
+    p.add_argument('outfile', help='output catalog')
+    p.add_argument('outdir', help='shard directory')
+    p.add_argument('--workers', type=int, default=None,
+                   help='number of shards run at once, default nshard')
+    p.add_argument('--prefix', default='wssa_',
+                   help='prefix of the new column names, default wssa_')
+    catalog_args(p)
+    run_args(p)
+    opts = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if opts.command in ['plan', 'local']:
+        fmt = catalog_format(opts.infile)
+        spill = os.path.join(opts.outdir, 'coords.npy')
+        if not os.path.isdir(opts.outdir): os.makedirs(opts.outdir)
+        ra, dec = read_coords(opts.infile, racol=opts.ra, deccol=opts.dec,
+                              fmt=fmt, ext=opts.hdu, spill=spill)
+        plan_shards(ra, dec, opts.outdir, opts.nshard,
+                    exten=[(int(e) if e.isdigit() else e)
+                           for e in opts.exten],
+                    large=not opts.small, mjysr=opts.mjysr, gz=opts.gz,
+                    fz=opts.fz,
+                    catalog={'file' : os.path.abspath(opts.infile),
+                             'format' : fmt, 'hdu' : opts.hdu})
+        del ra, dec
+        if os.path.exists(spill): os.remove(spill)
+
+    if opts.command == 'run':
+        run_shard(opts.outdir, opts.shard, tilepath=opts.tilepath,
+                  readahead=opts.readahead)
+    elif opts.command == 'local':
+        run_shards(opts.outdir, workers=opts.workers, tilepath=opts.tilepath,
+                   readahead=opts.readahead)
+
+    if opts.command in ['merge', 'local']:
+        catalog = load_manifest(opts.outdir)['catalog']
+        merged = os.path.join(opts.outdir, 'merged.npy')
+        vals = merge_shards(opts.outdir, outfile=merged)
+        if opts.outfile.lower().endswith('.npy') and (catalog is None or
+                catalog['format'] != 'npy'):
+            del vals
+            os.rename(merged, opts.outfile)
+        else:
+            append_columns(catalog['file'], opts.outfile, vals,
+                           prefix=opts.prefix, fmt=catalog['format'],
+                           ext=catalog['hdu'])
+            del vals
+            os.remove(merged)
+
+if __name__ == '__main__':
+    main()
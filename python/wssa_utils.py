@@ -1,15 +1,100 @@
 """Utilities for reading WSSA tiles."""
 
 import os
+import sys
+import time
+import logging
+import threading
 import numpy as np
-import pyfits
-from ang2pix_ring import ang2pix_ring
-from scipy.ndimage import map_coordinates
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from ang2pix_ring import ang2pix_ring_blocked
+from tile_cache import TileCache
+from tile_store import SharedTileStore
 
-# global variables
-com_pix_tile = {'NSIDE': 64}
-com_tiles    = {}
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# pyfits and scipy.ndimage are imported by the functions that use them, so
+# that importing this module stays cheap for short-lived processes
+
+class LazyTable(dict):
+    """
+    Dictionary of table columns, read from disk on first access.
+
+    Inputs:
+        parkey - key of the table's file name in tile_par_struc()
+
+    Keyword inputs:
+        init   - dictionary of entries known without reading the table
+    """
+
+    def __init__(self, parkey, init=None):
+        dict.__init__(self, init or {})
+        self.parkey = parkey
+        self.loaded = False
+
+    def load(self):
+        """Read the table, unless this has already been done."""
+        if not self.loaded:
+            self.update(load_table(tile_par_struc()[self.parkey]))
+            self.loaded = True
+
+    def __getitem__(self, key):
+        self.load()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.load()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self.load()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.load()
+        return dict.__len__(self)
+
+    def get(self, key, default=None):
+        self.load()
+        return dict.get(self, key, default)
+
+    def keys(self):
+        self.load()
+        return dict.keys(self)
+
+    def values(self):
+        self.load()
+        return dict.values(self)
+
+    def items(self):
+        self.load()
+        return dict.items(self)
+
+# progress messages, one per tile read, are logged at INFO level and the
+# read statistics of each tile at DEBUG level; enable with e.g.
+# logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('wssa_utils')
+
+# global variables, tables are read on first access
+com_pix_tile = LazyTable('lookup', {'NSIDE': 64})
+com_tiles    = LazyTable('indexfile')
 radeg = 180./np.pi
+# tile images shared across calls when tile_val_interp is run with cache=True
+tile_cache = TileCache()
+# tile images shared across processes, used when tile_val_interp is run
+# without a cache, see tile_store.SharedTileStore; created on first use from
+# the WISE_TILE_STORE environment variable, see default_tile_store
+tile_store = None
+# memory maps of uncompressed tiles, keyed on file name
+tile_maps    = {}
+# extensions holding an image in uncompressed tiles, see image_extens
+tile_extens  = {}
+# per-tile projection constants, keyed on tile size, see tile_constants
+tile_consts  = {}
 
 def tile_par_struc(large=True, release='1.0'):
     """
@@ -28,11 +113,15 @@ def tile_par_struc(large=True, release='1.0'):
     pscl      = (5.625 if large else 15.)
     # central coordinate, lower left = (0,0)
     crpix     = (3999.5 if large else 1499.5)
+    # directory with auxiliary files, defaults to wssa_utils/etc
+    datadir   = os.environ.get('WISE_DATA',
+                               os.path.join(os.path.dirname(
+                                   os.path.abspath(__file__)), os.pardir,
+                                            'etc'))
     # name of index file with tile centers, etc.
-    indexfile = os.path.join(os.environ['WISE_DATA'],
-                             'wisetile-index-allsky.fits')
+    indexfile = os.path.join(datadir, 'wisetile-index-allsky.fits')
     # file containing HEALPix -> tile lookup table
-    lookup = os.path.join(os.environ['WISE_DATA'], 'pixel_lookup.fits')
+    lookup = os.path.join(datadir, 'pixel_lookup.fits')
 
     # tile extension names
     extens = {'clean' : 0,
@@ -48,8 +137,8 @@ def tile_par_struc(large=True, release='1.0'):
     ismsk  = [0,0,0,0,0,1,1,0]
     # number of tiles, don't want random 430's all over my code
     ntile  = 430
-    # default tile path
-    tpath  = os.environ['WISE_TILE']
+    # default tile path, None if WISE_TILE is not set
+    tpath  = os.environ.get('WISE_TILE')
     # conversion from factor from W3 DN to MJy/sr
     calfac = 0.0135172
     # data type for intensity and bit-mask outputs, respectively
@@ -98,7 +187,58 @@ def issa_proj_gnom(ra, dec, ra0, dec0, scale):
 
     return x, y
 
-def coord_to_tile(ra, dec, large=True):
+def issa_proj_gnom_inv(x, y, ra0, dec0, scale):
+    """
+    Invert issa_proj_gnom, from gnomic projection to longitude and latitude.
+
+    Inputs:
+        x     - array of x coordinates, relative to center of projection
+        y     - array of y coordinates, relative to center of projection
+        ra0   - central RA of projection, radians
+        dec0  - central DEC of projection, radians
+        scale - scale factor of projection in pixels/radian
+
+    Outputs:
+        ra    - array of RA coordinates, radians, in [0, 2*pi)
+        dec   - array of DEC coordinates, radians
+    """
+
+    xi = -np.asarray(x, dtype='float64')/scale
+    eta = np.asarray(y, dtype='float64')/scale
+    denom = np.cos(dec0) - eta*np.sin(dec0)
+    dra = np.arctan2(xi, denom)
+    ra = np.mod(ra0 + dra, 2*np.pi)
+    dec = np.arctan2(np.sin(dec0) + eta*np.cos(dec0), np.hypot(xi, denom))
+
+    return ra, dec
+
+def tile_constants(large=True):
+    """
+    Per-tile gnomonic projection constants, computed once per tile size.
+
+    Keyword inputs:
+        large - set for 8k x 8k tiles, default is 3k x 3k
+
+    Outputs:
+        const - dictionary with arrays 'ra0' (tile center RA, radians),
+                'sindec0' and 'cosdec0' (sine and cosine of tile center
+                DEC), indexed directly by tile number with element 0
+                unused, plus the tile 'scale' (pixels/radian) and 'crpix'
+    """
+
+    large = bool(large)
+    if large not in tile_consts:
+        par = tile_par_struc(large=large)
+        dec0 = np.append(0., com_tiles['DEC']/radeg)
+        tile_consts[large] = {
+            'ra0'     : np.append(0., com_tiles['RA']/radeg),
+            'sindec0' : np.sin(dec0),
+            'cosdec0' : np.cos(dec0),
+            'scale'   : (par['pix']/par['sidelen'])*radeg,
+            'crpix'   : par['crpix'] }
+    return tile_consts[large]
+
+def coord_to_tile(ra, dec, large=True, out=None, block=65536):
     """
     Translate (ra,dec) coordinates to WSSA tiles using HEALPix lookup table.
 
@@ -108,26 +248,172 @@ def coord_to_tile(ra, dec, large=True):
 
     Keyword inputs:
         large    - set for 8k x 8k tiles, default is 3k x 3k
+        out      - optional (tlist, x, y) tuple of contiguous arrays, shaped
+                   like ra, to write the outputs into; x and y float64
+        block    - number of coordinates processed at a time
 
     Outputs:
         tlist - array of tiles corresponding to each (ra, dec) pair
         x     - array of x coordinates within each tile
         y     - array of y coordinates within each tile
+
+    Comments:
+        Coordinates are processed in blocks, with temporaries held in a few
+        reused block-sized buffers and the projection taken from the
+        precomputed tile_constants, so that the only full-length arrays
+        allocated are the outputs. Results are bit-identical to those of
+        coord_to_tnum followed by issa_proj_gnom.
     """
 
-    pix = ang2pix_ring(com_pix_tile['NSIDE'], (90.-dec)/radeg, ra/radeg)
-    tlist = (com_pix_tile['TILE'])[pix]
-    del pix
-    par = tile_par_struc(large=large)
-    scale = (par['pix']/par['sidelen'])*radeg
-    x, y = issa_proj_gnom(ra/radeg, dec/radeg,
-                          (com_tiles['RA'])[tlist-1]/radeg,
-                          (com_tiles['DEC'])[tlist-1]/radeg, scale)
-    x += par['crpix']
-    y += par['crpix']
+    ra = np.asarray(ra, dtype='float64')
+    dec = np.asarray(dec, dtype='float64')
+    if out is None:
+        out = (np.zeros(ra.shape,
+                        dtype=com_pix_tile['TILE'].dtype.newbyteorder('=')),
+               np.zeros(ra.shape), np.zeros(ra.shape))
+    tlist, x, y = out
+    const = tile_constants(large)
+    nside = com_pix_tile['NSIDE']
+    table = com_pix_tile['TILE']
+
+    ra = ra.reshape(-1)
+    dec = dec.reshape(-1)
+    tflat = tlist.reshape(-1)
+    xflat = x.reshape(-1)
+    yflat = y.reshape(-1)
+    n = len(ra)
+    buf = np.zeros((7, min(block, n)))
+    pbuf = np.zeros(min(block, n), dtype='int64')
+    for i in range(0, n, block):
+        j = min(i+block, n)
+        b = buf[:, 0:j-i]
+        phi = np.divide(ra[i:j], radeg, out=b[0])
+        theta = np.subtract(90., dec[i:j], out=b[1])
+        theta /= radeg
+        pix = ang2pix_ring_blocked(nside, theta, phi, block=block,
+                                   out=pbuf[0:j-i])
+        np.take(table, pix, out=tflat[i:j])
+        _gnom_block(phi, dec[i:j], tflat[i:j], const, xflat[i:j],
+                    yflat[i:j], b[1:])
 
     return tlist, x, y
 
+def _gnom_block(ra, dec, tlist, const, x, y, b):
+    """
+    Fused issa_proj_gnom onto tiles tlist, writing into x and y.
+
+    Inputs:
+        ra    - RA coordinates, radians
+        dec   - DEC coordinates, degrees
+        tlist - tile numbers
+        const - dictionary returned by tile_constants
+        x, y  - output arrays
+        b     - scratch buffer of 6 rows, each as long as ra
+
+    Comments:
+        Performs exactly the floating point operations of issa_proj_gnom,
+        in the same order, so that its results are reproduced bit for bit.
+    """
+
+    dra = np.take(const['ra0'], tlist, out=b[0])
+    np.subtract(ra, dra, out=dra)
+    sindec = np.divide(dec, radeg, out=b[1])
+    cosdec = np.cos(sindec, out=b[2])
+    np.sin(sindec, out=sindec)
+    sind0 = np.take(const['sindec0'], tlist, out=b[3])
+    cosd0 = np.take(const['cosdec0'], tlist, out=b[4])
+
+    A = np.cos(dra, out=b[5])
+    A *= cosdec
+    np.sin(dra, out=dra)
+    # F = scale/(sin(dec0)*sin(dec) + A*cos(dec0))
+    np.multiply(cosd0, sindec, out=y)
+    np.multiply(A, cosd0, out=x)
+    F = np.multiply(sind0, sindec, out=b[4])
+    F += x
+    np.divide(const['scale'], F, out=F)
+    # y = F*(cos(dec0)*sin(dec) - A*sin(dec0))
+    A *= sind0
+    y -= A
+    y *= F
+    # x = -F*cos(dec)*sin(ra-ra0)
+    np.negative(F, out=x)
+    x *= cosdec
+    x *= dra
+
+    x += const['crpix']
+    y += const['crpix']
+
+def coord_to_tnum(ra, dec):
+    """
+    Look up the WSSA tile of each (ra,dec) pair from its HEALPix pixel.
+
+    Inputs:
+        ra  - array of RA coordinates, assumed degrees J2000
+        dec - array of DEC coordinates, assumed degrees J2000
+
+    Outputs:
+        tlist - array of tiles corresponding to each (ra, dec) pair
+    """
+
+    pix = ang2pix_ring_blocked(com_pix_tile['NSIDE'], (90.-dec)/radeg,
+                               ra/radeg)
+    return (com_pix_tile['TILE'])[pix]
+
+def tile_xy(ra, dec, tlist, large=True):
+    """
+    Project (ra,dec) coordinates onto the pixel grid of tiles tlist.
+
+    Inputs:
+        ra    - array of RA coordinates, assumed degrees J2000
+        dec   - array of DEC coordinates, assumed degrees J2000
+        tlist - array of tile numbers, [1, 430]
+
+    Keyword inputs:
+        large - set for 8k x 8k tiles, default is 3k x 3k
+
+    Outputs:
+        x     - array of x coordinates within each tile
+        y     - array of y coordinates within each tile
+    """
+
+    ra = np.asarray(ra, dtype='float64')
+    x = np.zeros(ra.shape)
+    y = np.zeros(ra.shape)
+    _gnom_block(ra/radeg, np.asarray(dec, dtype='float64'), tlist,
+                tile_constants(large), x, y, np.zeros((6,) + ra.shape))
+    return x, y
+
+def tile_to_coord(tlist, x, y, large=True):
+    """
+    Convert pixel coordinates within tiles tlist to (ra,dec), see tile_xy.
+
+    Inputs:
+        tlist - array of tile numbers, [1, 430]
+        x     - array of x coordinates within each tile
+        y     - array of y coordinates within each tile
+
+    Keyword inputs:
+        large - set for 8k x 8k tiles, default is 3k x 3k
+
+    Outputs:
+        ra    - array of RA coordinates, degrees J2000
+        dec   - array of DEC coordinates, degrees J2000
+
+    Comments:
+        Coordinates outside of the tile boundaries are extrapolated along
+        the tile's gnomonic projection.
+    """
+
+    const = tile_constants(large)
+    tlist = np.asarray(tlist)
+    ra, dec = issa_proj_gnom_inv(np.asarray(x) - const['crpix'],
+                                 np.asarray(y) - const['crpix'],
+                                 const['ra0'][tlist],
+                                 np.arcsin(const['sindec0'][tlist]),
+                                 const['scale'])
+    return ra*radeg, dec*radeg
+
 def uniq(arr):
     """
     Return sorted unique values and indices of their first appearance.
@@ -145,8 +431,684 @@ def uniq(arr):
     u = arr[bdy]
     return u, bdy
 
+def tile_groups(tnum):
+    """
+    Group samples by tile number with an O(n) counting sort.
+
+    Inputs:
+        tnum - array of tile numbers, [1, 430]
+
+    Outputs:
+        sind  - indices sorting tnum, original order kept within each tile
+        tiles - sorted array of the distinct tile numbers
+        bdy   - group boundaries, samples of tiles[i] are sind[bdy[i]:bdy[i+1]]
+
+    Comments:
+        NumPy sorts 16 bit integers with a radix sort when a stable sort is
+        requested, so no comparison sort of the samples is performed.
+    """
+
+    tnum = np.asarray(tnum).ravel()
+    counts = np.bincount(tnum)
+    tiles = np.flatnonzero(counts)
+    bdy = np.append(0, np.cumsum(counts[tiles]))
+    sind = np.argsort(tnum.astype('int16'), kind='mergesort')
+    return sind, tiles, bdy
+
+def group_bbox(x, y, bdy, pix):
+    """
+    Pixel bounding box of every tile group of samples.
+
+    Inputs:
+        x   - x coordinates, sorted into tile groups
+        y   - y coordinates, sorted into tile groups
+        bdy - group boundaries, as returned by tile_groups
+        pix - tile sidelength, pixels
+
+    Outputs:
+        bbox - integer array of (xoffs, yoffs, xmax, ymax) rows, one per
+               group, with python slice convention for xmax, ymax
+    """
+
+    bbox = np.zeros((len(bdy)-1, 4), dtype='int64')
+    if len(bdy) == 1: return bbox
+    start = bdy[:-1]
+    bbox[:, 0] = np.maximum(np.floor(np.minimum.reduceat(x, start)), 0)
+    bbox[:, 1] = np.maximum(np.floor(np.minimum.reduceat(y, start)), 0)
+    bbox[:, 2] = np.minimum(np.ceil(np.maximum.reduceat(x, start)), pix-1) + 1
+    bbox[:, 3] = np.minimum(np.ceil(np.maximum.reduceat(y, start)), pix-1) + 1
+    return bbox
+
+def label_refs(x, y, bdy, labels, pix):
+    """
+    Reference pixel of every sample, for samples of several requests
+    sorted into tile groups together.
+
+    Inputs:
+        x      - x coordinates, sorted into tile groups
+        y      - y coordinates, sorted into tile groups
+        bdy    - group boundaries, as returned by tile_groups
+        labels - request of every sample, non-decreasing within each group
+        pix    - tile sidelength, pixels
+
+    Outputs:
+        ref - (xref, yref) arrays, the lower left corner of the bounding box
+              of the samples sharing each sample's tile and request
+
+    Comments:
+        This is the reference a separate call for each request would use,
+        see sample_section, so that the float32 rounding of a request's
+        coordinates does not depend on the other requests.
+    """
+
+    cut = np.zeros(len(x)+1, dtype=bool)
+    cut[bdy] = True
+    cut[1:-1] |= (labels[1:] != labels[:-1])
+    sub = np.flatnonzero(cut)
+    bbox = group_bbox(x, y, sub, pix)
+    n = np.diff(sub)
+    return np.repeat(bbox[:, 0], n), np.repeat(bbox[:, 1], n)
+
+def _pad_boxes(boxes, pad, pix):
+    """Widen (xoffs, yoffs, xmax, ymax) boxes by pad pixels, within tile."""
+    boxes = np.array(boxes, dtype='int64').reshape(-1, 4)
+    boxes[:, 0:2] = np.maximum(boxes[:, 0:2] - pad, 0)
+    boxes[:, 2:4] = np.minimum(boxes[:, 2:4] + pad, pix)
+    return boxes
+
+def _grid_windows(xx, yy, pix, cell, pad=0):
+    """Group samples into cell x cell pixel grid cells, see plan_reads."""
+    ncell = (pix + cell - 1)//cell
+    cx = np.clip(np.floor(xx), 0, pix-1).astype('int64')//cell
+    cy = np.clip(np.floor(yy), 0, pix-1).astype('int64')//cell
+    cid = cy*ncell + cx
+    order = np.argsort(cid, kind='mergesort')
+    cid = cid[order]
+    wbdy = np.concatenate(([0], np.flatnonzero(cid[1:] != cid[:-1]) + 1,
+                           [len(cid)]))
+    return order, wbdy, _pad_boxes(group_bbox(xx[order], yy[order], wbdy,
+                                              pix), pad, pix)
+
+def plan_reads(xx, yy, pix, bbox=None, cell=256, overhead=2**20,
+               max_read_bytes=None, itemsize=4, pad=0):
+    """
+    Choose the set of tile sections to read for samples at (xx, yy).
+
+    Inputs:
+        xx  - x coordinates within the tile
+        yy  - y coordinates within the tile
+        pix - tile sidelength, pixels
+
+    Keyword inputs:
+        bbox           - precomputed bounding box of all samples, see
+                         group_bbox
+        cell           - sidelength in pixels of the grid cells into which
+                         samples are clustered, default 256
+        overhead       - fixed cost of one section read, in bytes,
+                         default 1 MB
+        max_read_bytes - upper limit on the size of any single section
+                         read, default is no limit
+        itemsize       - bytes per pixel, 4 for all WSSA extensions
+        pad            - number of pixels by which every window is widened
+                         on each side, e.g. to hold cutouts centered on
+                         the samples; bbox is widened likewise
+
+    Outputs:
+        order - indices sorting the samples into read windows
+        wbdy  - window boundaries, window j holds samples
+                order[wbdy[j]:wbdy[j+1]]
+        boxes - integer (xoffs, yoffs, xmax, ymax) of each window
+
+    Comments:
+        The cost of a set of reads is the number of pixel bytes read plus
+        overhead per read. The bounding box of all samples is compared
+        against one window per occupied grid cell, each the bounding box
+        of the samples in that cell, and the cheaper plan is returned.
+        When the chosen windows exceed max_read_bytes, the grid cells are
+        halved in size until every window fits.
+    """
+
+    nsam = len(xx)
+    if bbox is None: bbox = group_bbox(xx, yy, [0, nsam], pix)[0]
+    plan = (np.arange(nsam), np.array([0, nsam]), _pad_boxes(bbox, pad, pix))
+
+    def window_bytes(boxes):
+        return (boxes[:, 2]-boxes[:, 0])*(boxes[:, 3]-boxes[:, 1])*itemsize
+
+    def fits(boxes):
+        return ((max_read_bytes is None) or
+                (window_bytes(boxes).max() <= max_read_bytes))
+
+    def cost(boxes):
+        return window_bytes(boxes).sum() + overhead*len(boxes)
+
+    while cell >= 1:
+        grid = _grid_windows(xx, yy, pix, cell, pad=pad)
+        if fits(plan[2]):
+            if fits(grid[2]) and (cost(grid[2]) < cost(plan[2])):
+                return grid
+            return plan
+        plan = grid
+        cell //= 2
+
+    if not fits(plan[2]):
+        raise ValueError('max_read_bytes too small to read a single window')
+    return plan
+
+def read_tile_image(f, exten):
+    """Read full image of extension exten from WSSA tile file f."""
+    import pyfits
+    hdus = pyfits.open(f)
+    image = np.array(hdus[exten].data)
+    hdus.close()
+    return image
+
+def read_tile_section(f, exten, yoffs, ymax, xoffs, xmax, cache=None,
+                      key=None):
+    """
+    Read the [yoffs:ymax, xoffs:xmax] section of a WSSA tile extension.
+
+    Inputs:
+        f     - WSSA tile file name, or tile already opened with pyfits
+        exten - integer fits extension
+        yoffs, ymax, xoffs, xmax - section bounds, python slice convention
+
+    Keyword inputs:
+        cache - TileCache or SharedTileStore instance; when given, f must be
+                a file name and sections are sliced from the image cached
+                under key: a memory map of an uncompressed tile held by a
+                TileCache, see map_tile_image, else the full decoded
+                extension image, read once
+        key   - cache key of this tile extension, see TileCache.tile_key
+    """
+
+    import pyfits
+    if cache is not None:
+        if (key is not None) and (key[3] == '') and \
+           not getattr(cache, 'shared', False):
+            image = cache.get(key, lambda: map_tile_image(f, exten))
+        else:
+            image = cache.get(key, lambda: read_tile_image(f, exten))
+        return image[yoffs:ymax, xoffs:xmax]
+
+    hdus = (f if isinstance(f, pyfits.HDUList) else pyfits.open(f))
+    return hdus[exten].section[yoffs:ymax, xoffs:xmax]
+
+def fits_image_layout(f):
+    """
+    Locate the data segment of every HDU in an uncompressed FITS file.
+
+    Inputs:
+        f - name of uncompressed FITS file
+
+    Outputs:
+        layout - list with one (offset, shape, dtype, bscale, bzero) tuple
+                 per HDU, offset in bytes from the start of the file
+
+    Comments:
+        The headers are parsed directly, without reading any data.
+    """
+
+    bitpix_dtype = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8',
+                    -32: '>f4', -64: '>f8'}
+    layout = []
+    offset = 0
+    fp = open(f, 'rb')
+    while True:
+        cards = {}
+        end = False
+        while not end:
+            block = fp.read(2880)
+            if len(block) < 2880:
+                fp.close()
+                return layout
+            offset += 2880
+            for i in range(0, 2880, 80):
+                card = block[i:i+80].decode('ascii')
+                if card[0:8].strip() == 'END':
+                    end = True
+                    break
+                if card[8:10] == '= ':
+                    cards[card[0:8].strip()] = card[10:].split('/')[0].strip()
+
+        bitpix = int(cards['BITPIX'])
+        naxis = int(cards['NAXIS'])
+        shape = tuple([int(cards['NAXIS' + str(n)])
+                       for n in range(naxis, 0, -1)])
+        npix = (int(np.prod(shape)) if naxis > 0 else 0)
+        nbytes = (abs(bitpix)//8)*int(cards.get('GCOUNT', 1))* \
+                 (int(cards.get('PCOUNT', 0)) + npix)
+        layout.append((offset, shape, np.dtype(bitpix_dtype[bitpix]),
+                       float(cards.get('BSCALE', 1)),
+                       float(cards.get('BZERO', 0))))
+        offset += 2880*((nbytes + 2879)//2880)
+        fp.seek(offset)
+
+def image_extens(f):
+    """
+    List of the extensions of uncompressed tile f holding an image.
+
+    Comments:
+        Tiles staged by footprint.py may hold only some extensions, the
+        others being empty HDUs. Results are kept in the tile_extens
+        global, and are read again when f is replaced.
+    """
+
+    st = os.stat(f)
+    stamp = (st.st_ino, st.st_size, st.st_mtime)
+    if (f not in tile_extens) or (tile_extens[f][0] != stamp):
+        tile_extens[f] = (stamp, [e for e, hdu in
+                                  enumerate(fits_image_layout(f))
+                                  if len(hdu[1]) > 0])
+    return tile_extens[f][1]
+
+def tile_memmap(f, exten):
+    """
+    Return read-only memory map of one extension of an uncompressed tile.
+
+    Inputs:
+        f     - WSSA tile file name, must not be gzipped
+        exten - integer fits extension
+
+    Outputs:
+        image  - 2d memory-mapped image, native FITS byte order
+        bscale - BSCALE of the extension, 1 if absent
+        bzero  - BZERO of the extension, 0 if absent
+
+    Comments:
+        Each file is mapped once and kept in the tile_maps global, call
+        tile_maps.clear() to release the mappings.
+    """
+
+    if f not in tile_maps:
+        tile_maps[f] = (np.memmap(f, dtype='u1', mode='r'),
+                        fits_image_layout(f))
+    mm, layout = tile_maps[f]
+    offset, shape, dtype, bscale, bzero = layout[exten]
+    nbytes = int(np.prod(shape))*dtype.itemsize
+    image = mm[offset:offset+nbytes].view(dtype).reshape(shape)
+    return image, bscale, bzero
+
+def map_tile_image(f, exten):
+    """
+    Return memory map of extension exten of uncompressed tile f, see
+    tile_memmap, or the decoded image read by read_tile_image if the
+    extension is scaled by BSCALE or BZERO.
+    """
+
+    image, bscale, bzero = tile_memmap(f, exten)
+    if (bscale != 1) or (bzero != 0): return read_tile_image(f, exten)
+    return image
+
+def sample_section(subim, xx, yy, xoffs, yoffs, ismsk, ref=None):
+    """
+    Sample tile section at (xx, yy), bilinear unless ismsk is set.
+
+    Inputs:
+        subim - tile section whose lower left pixel is (xoffs, yoffs)
+        xx    - x coordinates within the full tile
+        yy    - y coordinates within the full tile
+        xoffs - x offset of subim within the tile
+        yoffs - y offset of subim within the tile
+        ismsk - set to quote nearest pixel value, as is done for bit-masks
+
+    Keyword inputs:
+        ref - reference (x, y) pixel, coordinates are rounded to float32
+              relative to ref, default is (xoffs, yoffs); windows read on
+              behalf of one tile group share the group's ref, so that the
+              values do not depend on how the group was split into reads;
+              may also be a pair of arrays, one reference per sample
+    """
+
+    from scipy.ndimage import map_coordinates
+    if ismsk:
+        return subim[(np.round(yy)).astype('int')-yoffs,
+                     (np.round(xx)).astype('int')-xoffs]
+    if ref is None: ref = (xoffs, yoffs)
+    # the float32 coordinates relative to ref are shifted to the section
+    # origin in float64, exactly, wherever the section lies relative to ref
+    return map_coordinates(subim, [(yy-ref[1]).astype('float32')
+                                   .astype('float64') - (yoffs-ref[1]),
+                                   (xx-ref[0]).astype('float32')
+                                   .astype('float64') - (xoffs-ref[0])],
+                           order=1, mode='nearest')
+
+def gather_values(image, xx, yy, xoffs, yoffs, ismsk):
+    """
+    Sample image at (xx, yy) reading only the pixels that are needed.
+
+    Inputs:
+        image - full tile image, typically a memory map from tile_memmap
+        xx    - x coordinates within the tile
+        yy    - y coordinates within the tile
+        xoffs - reference x pixel, coordinates are rounded to float32
+                relative to (xoffs, yoffs) as in sample_section; xoffs and
+                yoffs may also be arrays, one reference per sample
+        yoffs - reference y pixel
+        ismsk - set to quote nearest pixel value, as is done for bit-masks
+
+    Outputs:
+        vals - sampled values, float64 unless ismsk is set
+
+    Comments:
+        Only the 2x2 neighbourhood of each sample (the nearest pixel for
+        bit-masks) is gathered, so a memory-mapped image is touched only on
+        the pages holding those pixels. Samples off of the image edge take
+        the edge values, as map_coordinates does with mode='nearest'.
+    """
+
+    ny, nx = image.shape
+    if ismsk:
+        ix = np.clip(np.round(xx).astype('int'), 0, nx-1)
+        iy = np.clip(np.round(yy).astype('int'), 0, ny-1)
+        return image[iy, ix]
+
+    xx = np.clip((xx-xoffs).astype('float32').astype('float64') + xoffs,
+                 0, nx-1)
+    yy = np.clip((yy-yoffs).astype('float32').astype('float64') + yoffs,
+                 0, ny-1)
+    x0 = np.floor(xx).astype('int')
+    y0 = np.floor(yy).astype('int')
+    wx1 = xx - x0
+    wy1 = yy - y0
+    wx0 = 1. - wx1
+    wy0 = 1. - wy1
+    x1 = np.minimum(x0+1, nx-1)
+    y1 = np.minimum(y0+1, ny-1)
+
+    vals = image[y0, x0]*wy0*wx0
+    vals += image[y0, x1]*wy0*wx1
+    vals += image[y1, x0]*wy1*wx0
+    vals += image[y1, x1]*wy1*wx1
+    return vals
+
+def exten_list(exten, par):
+    """
+    Parse scalar or list exten into lists of integer extensions and names.
+
+    Inputs:
+        exten - extension as integer or string, or a list of these
+        par   - dictionary returned by tile_par_struc
+
+    Outputs:
+        extens - list of integer extensions
+        names  - list of corresponding extension names
+    """
+
+    if isinstance(exten, (list, tuple, np.ndarray)):
+        extens = [(e if isinstance(e, (int, np.integer)) else
+                   par['extens'][e]) for e in exten]
+    else:
+        extens = [exten if isinstance(exten, (int, np.integer)) else
+                  par['extens'][exten]]
+    extens = [int(e) for e in extens]
+    names = dict([(v, k) for k, v in par['extens'].items()])
+    return extens, [names[e] for e in extens]
+
+def sample_tile(f, extens, xx, yy, pix, ismsk, gz=False, cache=None,
+                keys=None, mmap=False, bbox=None, fz=False,
+                max_read_bytes=None, ref=None, stats=None):
+    """
+    Sample values at (xx, yy) from one or more extensions of a WSSA tile.
+
+    Inputs:
+        f      - WSSA tile file name
+        extens - list of integer fits extensions
+        xx     - array of x coordinates within the tile
+        yy     - array of y coordinates within the tile
+        pix    - tile sidelength, pixels
+        ismsk  - list of flags, set for extensions that are bit-masks
+
+    Keyword inputs:
+        gz    - set if f is compressed, either gzipped or tile-compressed
+        cache - TileCache instance, see read_tile_section
+        keys  - list of cache keys of the tile extensions
+        mmap  - set to gather samples from a memory map of f, see
+                tile_val_interp
+        bbox  - precomputed (xoffs, yoffs, xmax, ymax) of the samples, see
+                group_bbox
+        fz    - set if f is tile-compressed, as written by compress_tiles,
+                in which case extension exten is stored in HDU exten+1
+        max_read_bytes - upper limit on the size of a single section read,
+                         see plan_reads
+        ref   - (x, y) reference pixel of the float32 rounding of the
+                sample coordinates, or a pair of arrays with one reference
+                per sample, see sample_section; default is the lower left
+                corner of bbox
+        stats - function called with the read record of the tile, see
+                tile_stats.TileStats; the tnum field is left to the caller
+
+    Outputs:
+        samps - list with array of values sampled at (xx, yy) for each
+                extension
+
+    Comments:
+        The tile is opened at most once, and every extension is sampled
+        from the same set of sections, chosen by plan_reads. Sparse samples
+        are read as several small windows rather than one bounding box.
+        For a tile-compressed file, a section read decompresses only the
+        row blocks that overlap the section.
+    """
+
+    if bbox is None:
+        bbox = group_bbox(xx, yy, [0, len(xx)], pix)[0]
+    if ref is None: ref = (int(bbox[0]), int(bbox[1]))
+    rec = {'file' : f, 'nsamp' : len(xx), 'nread' : 0, 'open_time' : 0.,
+           'read_time' : 0., 'interp_time' : 0., 'bytes_read' : 0}
+
+    samps = []
+    if mmap and not gz:
+        for exten, msk in zip(extens, ismsk):
+            t0 = time.time()
+            image, bscale, bzero = tile_memmap(f, exten)
+            t1 = time.time()
+            samp = gather_values(image, xx, yy, ref[0], ref[1], msk)
+            if (bscale != 1) or (bzero != 0):
+                samp = samp*bscale + bzero
+            rec['open_time'] += t1 - t0
+            rec['read_time'] += time.time() - t1
+            rec['bytes_read'] += (1 if msk else 4)*len(xx)*image.itemsize
+            samps.append(samp)
+        if stats is not None: stats(rec)
+        return samps
+
+    windows = read_tile_windows(f, extens, xx, yy, pix, cache=cache,
+                                keys=keys, bbox=bbox, fz=fz,
+                                max_read_bytes=max_read_bytes, rec=rec)
+    samps = interp_tile_windows(windows, xx, yy, ismsk, ref, rec=rec)
+    if stats is not None: stats(rec)
+    return samps
+
+def read_tile_windows(f, extens, xx, yy, pix, cache=None, keys=None,
+                      bbox=None, fz=False, max_read_bytes=None, rec=None,
+                      load=False):
+    """
+    Read the sections of a WSSA tile covering (xx, yy), see sample_tile.
+
+    Keyword inputs:
+        rec  - read record updated with the open and read times, see
+               sample_tile
+        load - set to copy sections into memory, unless sliced from a
+               cached image already in memory, so that sections backed by
+               a memory map of f are read here rather than when they are
+               first interpolated
+        All other keywords are as for sample_tile.
+
+    Outputs:
+        windows - (order, wbdy, boxes, subims), the sample order and window
+                  boundaries returned by plan_reads, the (x0, y0, x1, y1)
+                  window bounds, and the list of sections read from each
+                  window of each extension
+    """
+
+    import pyfits
+    if bbox is None:
+        bbox = group_bbox(xx, yy, [0, len(xx)], pix)[0]
+    if keys is None: keys = [None]*len(extens)
+    if rec is None: rec = dict(open_time=0., read_time=0., bytes_read=0,
+                               nread=0)
+    t0 = time.time()
+    hdus = (pyfits.open(f) if cache is None else f)
+    rec['open_time'] += time.time() - t0
+    order, wbdy, boxes = plan_reads(xx, yy, pix, bbox=bbox,
+                                    max_read_bytes=max_read_bytes)
+
+    subims = []
+    for exten, key in zip(extens, keys):
+        subims.append([])
+        for j in range(len(boxes)):
+            wx0, wy0, wx1, wy1 = [int(b) for b in boxes[j]]
+            t0 = time.time()
+            subim = read_tile_section(hdus, exten + int(fz), wy0, wy1, wx0,
+                                      wx1, cache=cache, key=key)
+            if load and ((cache is None) or isinstance(subim, np.memmap)):
+                subim = np.array(subim)
+            rec['read_time'] += time.time() - t0
+            rec['bytes_read'] += subim.nbytes
+            rec['nread'] += 1
+            subims[-1].append(subim)
+    return order, wbdy, boxes, subims
+
+def interp_tile_windows(windows, xx, yy, ismsk, ref, rec=None):
+    """
+    Sample the sections returned by read_tile_windows at (xx, yy).
+
+    Inputs:
+        windows - sections read by read_tile_windows
+        xx      - array of x coordinates within the tile
+        yy      - array of y coordinates within the tile
+        ismsk   - list of flags, set for extensions that are bit-masks
+        ref     - reference (x, y) pixel, or pair of arrays with one
+                  reference per sample, see sample_section
+
+    Keyword inputs:
+        rec - read record updated with the interpolation time
+
+    Outputs:
+        samps - list with array of values sampled at (xx, yy) for each
+                extension
+    """
+
+    order, wbdy, boxes, subims = windows
+    samps = []
+    for msk, sections in zip(ismsk, subims):
+        samp = None
+        for j in range(len(boxes)):
+            wx0, wy0 = int(boxes[j][0]), int(boxes[j][1])
+            ind = (slice(None) if len(boxes) == 1 else
+                   order[wbdy[j]:wbdy[j+1]])
+            r = (ref if np.ndim(ref[0]) == 0 else
+                 (ref[0][ind], ref[1][ind]))
+            t0 = time.time()
+            s = sample_section(sections[j], xx[ind], yy[ind], wx0, wy0, msk,
+                               ref=r)
+            if rec is not None: rec['interp_time'] += time.time() - t0
+            if len(boxes) == 1: samp = s
+            else:
+                if samp is None: samp = np.empty(len(xx), dtype=s.dtype)
+                samp[ind] = s
+        samps.append(samp)
+    return samps
+
+def _sample_tile_task(task):
+    """
+    Log progress message and run sample_tile on argument tuple.
+
+    Outputs:
+        samps - list of sampled values, as returned by sample_tile
+        rec   - read record of the tile, see tile_stats.TileStats
+    """
+
+    i, nu, nsam = task[0]
+    log.info('[%d/%d] Reading: %s, %d sample%s', i, nu, task[1], nsam,
+             's'*int(nsam > 1))
+    recs = []
+    samps = sample_tile(*task[1:], stats=recs.append)
+    log.debug('Read %(file)s: %(nsamp)d samples, %(nread)d reads, '
+              '%(bytes_read)d bytes, open %(open_time).4f s, read '
+              '%(read_time).4f s, interpolate %(interp_time).4f s', recs[0])
+    return samps, recs[0]
+
+def _read_ahead(tasks, depth):
+    """
+    Sample the tiles of _sample_tile_task argument tuples tasks, reading
+    up to depth tiles ahead of the one being interpolated.
+
+    Outputs:
+        iterator of (samps, rec), as returned by _sample_tile_task
+
+    Comments:
+        A background thread opens each tile and reads, and decompresses,
+        its sections into a queue holding at most depth tiles, while the
+        calling thread interpolates, so that tile I/O overlaps
+        interpolation even on a single core, as reads release the GIL.
+        Tiles sampled through mmap are gathered in the calling thread.
+    """
+
+    results = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        for task in tasks:
+            i, nu, nsam = task[0]
+            f, extens, xx, yy, pix, ismsk, gz, cache, keys, mmap, bbox, \
+                fz, max_read_bytes, ref = task[1:]
+            rec = {'file' : f, 'nsamp' : len(xx), 'nread' : 0,
+                   'open_time' : 0., 'read_time' : 0., 'interp_time' : 0.,
+                   'bytes_read' : 0}
+            try:
+                if mmap and not gz:
+                    windows = None
+                else:
+                    log.info('[%d/%d] Reading: %s, %d sample%s', i, nu, f,
+                             nsam, 's'*int(nsam > 1))
+                    windows = read_tile_windows(
+                        f, extens, xx, yy, pix, cache=cache, keys=keys,
+                        bbox=bbox, fz=fz, max_read_bytes=max_read_bytes,
+                        rec=rec, load=True)
+            except Exception:
+                put((None, None, sys.exc_info()))
+                return
+            if not put((windows, rec, None)): return
+
+    thread = threading.Thread(target=reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        for task in tasks:
+            windows, rec, exc = results.get()
+            if exc is not None:
+                raise exc[1]
+            if windows is None:
+                yield _sample_tile_task(task)
+                continue
+            xx, yy, ismsk, bbox, ref = task[3], task[4], task[6], task[11], \
+                                       task[14]
+            if ref is None: ref = (int(bbox[0]), int(bbox[1]))
+            samps = interp_tile_windows(windows, xx, yy, ismsk, ref, rec=rec)
+            log.debug('Read %(file)s: %(nsamp)d samples, %(nread)d reads, '
+                      '%(bytes_read)d bytes, open %(open_time).4f s, read '
+                      '%(read_time).4f s, interpolate %(interp_time).4f s',
+                      rec)
+            yield samps, rec
+    finally:
+        stop.set()
+        thread.join()
+
 def tile_val_interp(tnum, x, y, large=True, exten=0, release='1.0',
-                    tpath=tile_par_struc()['tpath'], gz=False):
+                    tpath=None, gz=False, cache=None, mmap=False,
+                    workers=None, backend='thread', fz=False,
+                    max_read_bytes=None, stats=None, readahead=None,
+                    labels=None):
     """
     Use (x,y) pairs and tile numbers to sample values from WSSA tiles.
 
@@ -157,52 +1119,208 @@ def tile_val_interp(tnum, x, y, large=True, exten=0, release='1.0',
 
     Keyword inputs:
         large    - set for 8k x 8k tiles, default is 3k x 3k
-        exten    - fits extension, default to 0, currently implemented
-                   only for scalar exten values
+        exten    - fits extension, default to 0, or a list of extensions
+                   which are all sampled while each tile is open
         release  - default '1.0', currently only release = '1.0' supported
         large    - set for 8k x 8k tiles, default is 3k x 3k
+        cache    - TileCache instance holding tile images across calls,
+                   memory maps of uncompressed tiles and decoded images of
+                   compressed ones, see tile_cache.TileCache, or True for
+                   the module-level tile_cache, or a SharedTileStore
+                   holding decoded images across processes; default
+                   is the module-level tile_store when one is configured,
+                   otherwise, or when False, to read a fresh section of
+                   each tile from disk
+        mmap     - set to memory map uncompressed tiles and gather only the
+                   pixels neighbouring each sample, rather than reading the
+                   bounding box of all samples in a tile; has no effect when
+                   gz or fz is set
+        workers  - number of tiles sampled concurrently, default is to
+                   sample one tile at a time
+        backend  - 'thread' (default) or 'process', pool used when workers
+                   is greater than one; worker processes do not share cache
+                   unless it is a SharedTileStore
+        fz       - set to read the tile-compressed *.fits.fz copies of the
+                   tiles written by compress_tiles, which decompress only
+                   the row blocks covering the samples of each tile
+        max_read_bytes - upper limit on the bytes of a single section read,
+                   default is no limit; samples of a tile are split among
+                   several small reads when that is cheaper, see plan_reads
+        stats    - function called once per tile read with a record of its
+                   open, read and interpolation times, bytes read and number
+                   of samples, e.g. a tile_stats.TileStats instance
+        readahead - number of tiles read ahead by a background thread, while
+                   the current tile is interpolated, default is none; the
+                   sections of at most readahead + 1 tiles are held at once;
+                   applies when tiles are sampled one at a time
+        labels   - non-decreasing array labelling the request each sample
+                   belongs to, when the samples of several requests are
+                   sampled together; every request then gets the values of
+                   a separate call, see label_refs
 
     Outputs:
-        vals - values at (x,y) sampled from tiles tnum
+        vals - values at (x,y) sampled from tiles tnum; for a list exten, a
+               structured array with one field per extension, named as in
+               tile_par_struc()['extens']
+    """
+
+    sind, tiles, bdy = tile_groups(tnum)
+    x = x[sind]
+    y = y[sind]
+    ref = (None if labels is None else
+           label_refs(x, y, bdy, np.asarray(labels).ravel()[sind],
+                      tile_par_struc(large=large, release=release)['pix']))
+    svals = sample_groups(tiles, bdy, x, y, large=large,
+                          exten=exten, release=release, tpath=tpath, gz=gz,
+                          cache=cache, mmap=mmap, workers=workers,
+                          backend=backend, fz=fz,
+                          max_read_bytes=max_read_bytes, stats=stats,
+                          readahead=readahead, ref=ref)
+    vals = np.empty_like(svals)
+    vals[sind] = svals
+    return vals
+
+def resolve_cache(cache):
+    """Return the tile cache selected by keyword cache, see tile_val_interp."""
+    if cache is True: return tile_cache
+    if cache is None: return default_tile_store()
+    if cache is False: return None
+    return cache
+
+def default_tile_store():
+    """
+    Return the module-level tile_store, first creating it in directory
+    WISE_TILE_STORE if that is set, None if there is no store.
+    """
+
+    global tile_store
+    if (tile_store is None) and os.environ.get('WISE_TILE_STORE'):
+        tile_store = SharedTileStore(os.environ['WISE_TILE_STORE'])
+    return tile_store
+
+def require_tiles(tiles, extens, tpath, large=True, suffix='', cache=None):
+    """
+    Raise IOError naming every tile file needed but missing from tpath,
+    or lacking one of the extensions.
+
+    Inputs:
+        tiles  - array of tile numbers, [1, 430]
+        extens - list of integer extensions to be read
+        tpath  - tile directory
+
+    Keyword inputs:
+        suffix - compression suffix of the tile files, as in '.gz'
+        cache  - tile cache already resolved by resolve_cache; tiles whose
+                 extensions are all cached need no file
+
+    Comments:
+        Called before any tile is read, so that a partial tile set fails
+        at once, rather than part way through a run; see footprint.py to
+        plan and stage the tiles a job needs.
+    """
+
+    fname = com_tiles['FNAME']
+    names = dict([(v, k) for k, v in tile_par_struc(large=large)['extens']
+                  .items()])
+    missing = []
+    for tnum in np.unique(tiles):
+        f = os.path.join(tpath, fname[tnum-1]) + suffix
+        if (cache is not None) and all([TileCache.tile_key(
+                tnum, e, large, suffix, tpath) in cache for e in extens]):
+            continue
+        if not os.path.exists(f):
+            missing.append(os.path.basename(f))
+        elif suffix == '':
+            # a subset staged by footprint.py
+            absent = [names.get(e, str(e)) for e in extens
+                      if e not in image_extens(f)]
+            if len(absent) > 0:
+                missing.append('%s (%s not staged)' %
+                               (os.path.basename(f), ', '.join(absent)))
+    if len(missing) > 0:
+        raise IOError('%d of %d tiles needed are missing from %s: %s' %
+                      (len(missing), len(np.unique(tiles)), tpath,
+                       ', '.join(missing)))
+
+def sample_groups(tiles, bdy, x, y, large=True, exten=0, release='1.0',
+                  tpath=None, gz=False, cache=None, mmap=False, workers=None,
+                  backend='thread', bbox=None, fz=False,
+                  max_read_bytes=None, stats=None, readahead=None, ref=None):
+    """
+    Sample WSSA tiles at (x,y) coordinates already sorted into tile groups.
+
+    Inputs:
+        tiles - array of distinct tile numbers
+        bdy   - group boundaries, samples on tiles[i] are x[bdy[i]:bdy[i+1]]
+        x     - x coordinates, sorted into tile groups
+        y     - y coordinates, sorted into tile groups
+
+    Keyword inputs:
+        bbox - precomputed bounding boxes of the groups, see group_bbox
+        ref  - (x, y) arrays of the reference pixel of every sample, sorted
+               like x and y, see label_refs; default is the lower left
+               corner of the bounding box of each group
+        All other keywords are as for tile_val_interp.
+
+    Outputs:
+        vals - values at (x,y), in the same order as x and y
     """
 
     par = tile_par_struc(large=large, release=release)
-    exten = (exten if isinstance(exten, int) else par['extens'][exten])
-    nval = len(tnum.flat)
-    sind = np.argsort(tnum)
-    tu, bdy = uniq(tnum[sind])
-    nu = len(tu.flat)
-
-    fname = (com_tiles['FNAME'])[tnum[sind[bdy]]-1]
-    vals = np.zeros(nval, dtype=(par['dtype'])[(par['ismsk'])[exten]])
+    extens, names = exten_list(exten, par)
+    ismsk = [(par['ismsk'])[e] for e in extens]
+    if tpath is None: tpath = par['tpath']
+    if tpath is None:
+        raise ValueError('no tile path given and WISE_TILE is not set')
+    cache = resolve_cache(cache)
+    if bbox is None: bbox = group_bbox(x, y, bdy, par['pix'])
+    nval = len(x)
+    nu = len(tiles)
+    suffix = ('.fz' if fz else ('.gz' if gz else ''))
+    require_tiles(tiles, extens, tpath, large=large, suffix=suffix,
+                  cache=cache)
+
+    fname = (com_tiles['FNAME'])[np.asarray(tiles)-1]
+    vals = np.zeros(nval, dtype=[(name, (par['dtype'])[msk])
+                                 for name, msk in zip(names, ismsk)])
+    tasks = []
     for i in range(0, nu):
-        indl = bdy[i]
-        indu = (nval if (i == (nu-1)) else bdy[i+1])
-        xx = x[sind[indl:indu]]
-        yy = y[sind[indl:indu]]
-        f = os.path.join(tpath, fname[i]) + ('.gz' if gz else '')
-
-        print('[' + str(i+1) + '/' + str(nu) + '] Reading: ' + f + ', ' +
-              str(len(xx)) + ' sample'+ 's'*int(len(xx) > 1))
-
-        xoffs = int(max(np.floor(np.min(xx)), 0))
-        yoffs = int(max(np.floor(np.min(yy)), 0))
-
-        xmax = int(min(np.ceil(np.max(xx)), par['pix']-1)) + 1
-        ymax = int(min(np.ceil(np.max(yy)), par['pix']-1)) + 1
-
-        hdus = pyfits.open(f)
-        subim = hdus[exten].section[yoffs:ymax, xoffs:xmax]
-        if (par['ismsk'])[exten] == 1:
-            vals[sind[indl:indu]] = \
-            subim[(np.round(yy)).astype('int')-yoffs,
-                  (np.round(xx)).astype('int')-xoffs]
+        f = os.path.join(tpath, fname[i]) + suffix
+        keys = [TileCache.tile_key(tiles[i], e, large, suffix, tpath)
+                for e in extens]
+        tasks.append(((i+1, nu, bdy[i+1] - bdy[i]), f, extens, x[bdy[i]:bdy[i+1]], y[bdy[i]:bdy[i+1]],
+                      par['pix'], ismsk, gz or fz,
+                      (cache if (backend != 'process') or
+                       getattr(cache, 'shared', False) else None), keys, mmap,
+                      bbox[i], fz, max_read_bytes,
+                      (None if ref is None else
+                       (ref[0][bdy[i]:bdy[i+1]], ref[1][bdy[i]:bdy[i+1]]))))
+
+    if (workers is None) or (workers <= 1) or (nu == 1):
+        if readahead and (nu > 1):
+            samps = _read_ahead(tasks, readahead)
         else:
-            vals[sind[indl:indu]] = map_coordinates(subim,
-                                                [(yy-yoffs).astype('float32'),
-                                                 (xx-xoffs).astype('float32')],
-                                                  order=1, mode='nearest')
-    return vals
+            samps = (_sample_tile_task(task) for task in tasks)
+        pool = None
+    else:
+        pool = (Pool if backend == 'process' else ThreadPool)(min(workers, nu))
+        samps = pool.imap(_sample_tile_task, tasks)
+
+    try:
+        for i, (samp, rec) in enumerate(samps):
+            for name, s in zip(names, samp):
+                vals[name][bdy[i]:bdy[i+1]] = s
+            if stats is not None:
+                rec['tnum'] = int(tiles[i])
+                stats(rec)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if isinstance(exten, (list, tuple, np.ndarray)):
+        return vals
+    return vals[names[0]]
 
 def check_coords(ra, dec):
     """Attempt to ensure ra, dec are numpy arrays, sanity check coordinates"""
@@ -213,8 +1331,10 @@ def check_coords(ra, dec):
     good = (ra.shape == dec.shape) & (np.max(np.abs(dec)) <= 90)
     return good, ra, dec
 
-def wssa_getval(ra, dec, exten=0, tilepath=tile_par_struc()['tpath'],
-                release='1.0', large=True, mjysr=False, gz=False):
+def wssa_getval(ra, dec, exten=0, tilepath=None, release='1.0', large=True,
+                mjysr=False, gz=False, cache=None, mmap=False, workers=None,
+                backend='thread', fz=False, max_read_bytes=None, stats=None,
+                approx=False, readahead=None, labels=None):
     """
     Sample values from WSSA tiles at specified celestial coordinates.
 
@@ -233,13 +1353,40 @@ def wssa_getval(ra, dec, exten=0, tilepath=tile_par_struc()['tpath'],
                     5: 'amsk'
                     6: 'omsk'
                     7: 'art'
+                or a list of these, e.g. ['clean', 'cov', 'amsk', 'omsk'],
+                to sample several extensions in a single pass
         tilepath - directory containing WSSA tiles
         release  - default '1.0', currently only release = '1.0' supported
         large    - set for 8k x 8k tiles, default is 3k x 3k
         mjysr    - set for result in MJy/sr, default is W3 DN
+        cache    - TileCache instance, or True for the module-level
+                   tile_cache, so that repeated queries of the same tiles
+                   skip opening and decoding them, or a SharedTileStore, see
+                   tile_val_interp
+        mmap     - set to gather samples from memory-mapped uncompressed
+                   tiles, see tile_val_interp
+        workers  - number of tiles sampled concurrently, default is one
+        backend  - 'thread' (default) or 'process' worker pool
+        fz       - set to read tile-compressed *.fits.fz tiles written by
+                   compress_tiles, see tile_val_interp
+        max_read_bytes - cap on the bytes of a single tile section read,
+                   see tile_val_interp
+        stats    - function called with the read record of each tile, see
+                   tile_val_interp
+        approx   - set to look up values in the precomputed HEALPix maps
+                   written by healpix_map.build_map, found in tilepath,
+                   rather than sampling the tiles; values are then those at
+                   the center of the HEALPix pixel containing (ra, dec);
+                   may also be the name of a map directory or file
+        readahead - number of tiles read ahead of interpolation, see
+                   tile_val_interp
+        labels   - request of every sample, for servers merging the
+                   coordinates of several requests into one call, see
+                   tile_val_interp
 
     Outputs:
-        vals - values at (ra, dec) sampled from  WSSA tiles
+        vals - values at (ra, dec) sampled from  WSSA tiles; for a list
+               exten, a structured array with one field per extension
     """
 
     sane, ra, dec = check_coords(ra, dec)
@@ -252,35 +1399,286 @@ def wssa_getval(ra, dec, exten=0, tilepath=tile_par_struc()['tpath'],
     ra = ra.ravel()
     dec = dec.ravel()
 
+    if approx:
+        from healpix_map import map_getval
+        vals = map_getval(ra, dec, exten=exten,
+                          path=(tilepath if approx is True else approx),
+                          release=release, large=large)
+        par = tile_par_struc(release=release, large=large)
+        if mjysr:
+            vals = calibrate(vals, exten, par)
+        return vals.reshape(sh)
+
     tnum, x, y = coord_to_tile(ra, dec, large=large)
     vals = tile_val_interp(tnum, x, y, exten=exten, tpath=tilepath,
-                           release=release, large=large, gz=gz)
+                           release=release, large=large, gz=gz,
+                           cache=cache, mmap=mmap, workers=workers,
+                           backend=backend, fz=fz,
+                           max_read_bytes=max_read_bytes, stats=stats,
+                           readahead=readahead, labels=labels)
 
     par = tile_par_struc(release=release, large=large)
-    mask = (par['ismsk'])[exten if isinstance(exten, int) else
-                          par['extens'][exten]]
-
-    if mjysr and not mask:
-        vals *= par['calfac']
+    if mjysr:
+        vals = calibrate(vals, exten, par)
 
     vals = vals.reshape(sh)
 
     return vals
 
+def wssa_getval_iter(ra, dec=None, chunksize=1000000, window=1, exten=0,
+                     tilepath=None, release='1.0', large=True, mjysr=False,
+                     gz=False, cache=None, mmap=False, workers=None,
+                     backend='thread', fz=False, max_read_bytes=None,
+                     stats=None, approx=False, readahead=None):
+    """
+    Sample WSSA tiles chunk by chunk, for catalogs larger than memory.
+
+    Inputs:
+        ra  - iterable of (ra, dec) chunks when dec is None, otherwise
+              array of RA coordinates, e.g. a memory-mapped column
+        dec - array of DEC coordinates, split into chunks along with ra
+
+    Keyword inputs:
+        chunksize - number of coordinates per chunk when ra, dec are arrays
+        window    - number of consecutive chunks sampled together; samples
+                    are grouped by tile across the whole window, so each
+                    tile is read at most once per window
+        All other keywords are as for wssa_getval.
+
+    Outputs:
+        Generator yielding the values of one input chunk at a time, each
+        shaped like the chunk's coordinates, or -1 for a chunk failing
+        check_coords.
+
+    Comments:
+        Peak memory scales with window*chunksize rather than with the
+        length of the catalog.
+    """
+
+    if dec is not None:
+        chunks = ((ra[i:i+chunksize], dec[i:i+chunksize])
+                  for i in range(0, len(ra), chunksize))
+    else:
+        chunks = iter(ra)
+
+    done = False
+    while not done:
+        block = []
+        for r, d in chunks:
+            block.append(check_coords(r, d))
+            if len(block) == window: break
+        else:
+            done = True
+        if len(block) == 0: break
+
+        good = [b for b in block if b[0]]
+        if len(good) > 0:
+            vals = wssa_getval(np.concatenate([b[1].ravel() for b in good]),
+                               np.concatenate([b[2].ravel() for b in good]),
+                               exten=exten, tilepath=tilepath,
+                               release=release, large=large, mjysr=mjysr,
+                               gz=gz, cache=cache, mmap=mmap,
+                               workers=workers, backend=backend, fz=fz,
+                               max_read_bytes=max_read_bytes, stats=stats,
+                               approx=approx, readahead=readahead)
+        i = 0
+        for sane, r, d in block:
+            if not sane:
+                yield -1
+                continue
+            yield vals[i:i+r.size].reshape(r.shape)
+            i += r.size
+
+def wssa_cutouts(ra, dec, size, exten=0, tilepath=None, release='1.0',
+                 large=True, mjysr=False, gz=False, fz=False, cache=None,
+                 max_read_bytes=None, stats=None):
+    """
+    Extract square postage stamp cutouts of WSSA tiles.
+
+    Inputs:
+        ra   - array of RA coordinates of cutout centers, degrees J2000
+        dec  - array of DEC coordinates of cutout centers, degrees J2000
+        size - cutout sidelength, pixels
+
+    Keyword inputs:
+        All keywords are as for wssa_getval.
+
+    Outputs:
+        cutouts - array of cutouts, shaped like ra with two trailing axes of
+                  length size, so (N, size, size) for N coordinates; for a
+                  list exten, a structured array with one field per
+                  extension
+
+    Comments:
+        Each cutout is taken from the native pixel grid of the tile that
+        owns its center, as found by coord_to_tile, with pixel [j, k] of
+        the cutout at tile pixel (x0 + k, y0 + j), where (x0 + size//2,
+        y0 + size//2) is the tile pixel nearest (ra, dec). Pixels are
+        copied without interpolation. Cutouts are grouped by tile, and the
+        cutouts of each tile are read in as few sections as plan_reads
+        finds worthwhile. Cutout pixels beyond the edge of the owning tile
+        are placed on the sky along the tile's gnomonic projection, then
+        sampled from the tile owning them, as by wssa_getval.
+    """
+
+    import pyfits
+    sane, ra, dec = check_coords(ra, dec)
+    if not sane: return -1
+
+    sh = ra.shape
+    ra = ra.astype('float64').ravel()
+    dec = dec.astype('float64').ravel()
+    size = int(size)
+
+    par = tile_par_struc(large=large, release=release)
+    extens, names = exten_list(exten, par)
+    ismsk = [(par['ismsk'])[e] for e in extens]
+    if tilepath is None: tilepath = par['tpath']
+    if tilepath is None:
+        raise ValueError('no tile path given and WISE_TILE is not set')
+    cache = resolve_cache(cache)
+    pix = int(par['pix'])
+
+    tnum, x, y = coord_to_tile(ra, dec, large=large)
+    xcen = np.round(x).astype('int64')
+    ycen = np.round(y).astype('int64')
+    x0 = xcen - size//2
+    y0 = ycen - size//2
+    off = np.arange(size)
+    cutouts = np.zeros((len(ra), size, size),
+                       dtype=[(name, (par['dtype'])[msk])
+                              for name, msk in zip(names, ismsk)])
+
+    suffix = ('.fz' if fz else ('.gz' if gz else ''))
+    sind, tiles, bdy = tile_groups(tnum)
+    require_tiles(tiles, extens, tilepath, large=large, suffix=suffix,
+                  cache=cache)
+    fname = (com_tiles['FNAME'])[tiles-1]
+    for i in range(0, len(tiles)):
+        ind = sind[bdy[i]:bdy[i+1]]
+        f = os.path.join(tilepath, fname[i]) + suffix
+        log.info('[%d/%d] Reading: %s, %d cutout%s', i+1, len(tiles), f,
+                 len(ind), 's'*int(len(ind) > 1))
+        rec = {'tnum' : int(tiles[i]), 'file' : f, 'nsamp' : len(ind),
+               'nread' : 0, 'open_time' : 0., 'read_time' : 0.,
+               'interp_time' : 0., 'bytes_read' : 0}
+        order, wbdy, boxes = plan_reads(xcen[ind], ycen[ind], pix,
+                                        max_read_bytes=max_read_bytes,
+                                        pad=size//2)
+        t0 = time.time()
+        hdus = (pyfits.open(f) if cache is None else f)
+        rec['open_time'] = time.time() - t0
+        for e, name in zip(extens, names):
+            key = TileCache.tile_key(tiles[i], e, large, suffix, tilepath)
+            for j in range(len(boxes)):
+                wx0, wy0, wx1, wy1 = [int(b) for b in boxes[j]]
+                t0 = time.time()
+                subim = read_tile_section(hdus, e + int(fz), wy0, wy1, wx0,
+                                          wx1, cache=cache, key=key)
+                t1 = time.time()
+                k = ind[order[wbdy[j]:wbdy[j+1]]]
+                iy = np.clip(y0[k][:, None] + off, wy0, wy1-1) - wy0
+                ix = np.clip(x0[k][:, None] + off, wx0, wx1-1) - wx0
+                cutouts[name][k] = subim[iy[:, :, None], ix[:, None, :]]
+                rec['read_time'] += t1 - t0
+                rec['interp_time'] += time.time() - t1
+                rec['bytes_read'] += subim.nbytes
+                rec['nread'] += 1
+        if stats is not None: stats(rec)
+
+    edge = np.flatnonzero((x0 < 0) | (x0 + size > pix) |
+                          (y0 < 0) | (y0 + size > pix))
+    if len(edge) > 0:
+        xx = x0[edge][:, None] + off
+        yy = y0[edge][:, None] + off
+        outside = (((yy < 0) | (yy >= pix))[:, :, None] |
+                   ((xx < 0) | (xx >= pix))[:, None, :])
+        e, j, k = np.nonzero(outside)
+        ra_out, dec_out = tile_to_coord(tnum[edge[e]], xx[e, k], yy[e, j],
+                                        large=large)
+        tnum_out, x_out, y_out = coord_to_tile(ra_out, dec_out, large=large)
+        vals = tile_val_interp(tnum_out, x_out, y_out, large=large,
+                               exten=list(extens), release=release,
+                               tpath=tilepath, gz=gz, cache=cache, fz=fz,
+                               max_read_bytes=max_read_bytes, stats=stats)
+        for name in names:
+            cutouts[name][edge[e], j, k] = vals[name]
+
+    if mjysr:
+        cutouts = calibrate(cutouts, extens, par)
+
+    cutouts = cutouts.reshape(sh + (size, size))
+    if isinstance(exten, (list, tuple, np.ndarray)):
+        return cutouts
+    return cutouts[names[0]]
+
+def calibrate(vals, exten, par):
+    """Convert intensity extensions among sampled vals from DN to MJy/sr."""
+    extens, names = exten_list(exten, par)
+    for e, name in zip(extens, names):
+        if (par['ismsk'])[e]: continue
+        if vals.dtype.names is None:
+            vals *= par['calfac']
+        else:
+            vals[name] *= par['calfac']
+    return vals
+
 def fits2dict(fname):
     """Ingest FITS table and return dictionary containing the data."""
+    import pyfits
     hdus = pyfits.open(fname)
     cols = hdus[1].columns
     tab  = hdus[1].data
 
     return dict([(col.name, tab[col.name]) for col in cols])
 
-def init_global():
-    """Initialize global variables."""
-    global com_pix_tile, com_tiles
-    par = tile_par_struc()
+def table_cache_name(fname):
+    """Name of the .npy binary cache of FITS table fname."""
+    return os.path.splitext(fname)[0] + '.npy'
+
+def load_table(fname):
+    """
+    Return dictionary of columns of FITS table fname.
 
-    com_pix_tile.update(fits2dict(par['lookup']))
-    com_tiles.update(fits2dict(par['indexfile']))
+    Comments:
+        When the .npy binary cache written by write_table_cache exists, it
+        is memory mapped instead of parsing the FITS table.
+    """
 
-init_global()
+    npyname = table_cache_name(fname)
+    if not os.path.exists(npyname):
+        return fits2dict(fname)
+
+    tab = np.load(npyname, mmap_mode='r')
+    return dict([(name, tab[name]) for name in tab.dtype.names])
+
+def write_table_cache(fname):
+    """
+    Write .npy binary cache of FITS table fname, read by load_table.
+
+    Comments:
+        Columns are stored as a native byte order structured array, with
+        character columns converted to unicode. Rerun after replacing the
+        FITS table, as the cache takes precedence over it.
+    """
+
+    import pyfits
+    hdus = pyfits.open(fname)
+    names = [col.name for col in hdus[1].columns]
+    cols = [np.asarray(hdus[1].data[name]) for name in names]
+    cols = [(col.astype('U') if col.dtype.kind == 'S' else col)
+            for col in cols]
+    dtype = [(str(name), col.dtype.newbyteorder('='))
+             for name, col in zip(names, cols)]
+    tab = np.zeros(len(cols[0]), dtype=dtype)
+    for name, col in zip(names, cols):
+        tab[name] = col
+    hdus.close()
+    np.save(table_cache_name(fname), tab)
+
+def init_global():
+    """Read, or reread, the HEALPix lookup and tile index tables."""
+    for table in [com_pix_tile, com_tiles]:
+        table.loaded = False
+        table.load()
+    tile_consts.clear()